@@ -0,0 +1,592 @@
+"""
+    Benchmark how fast the classify_user_tweets pipeline moves users from
+    being queued to having UserTopic rows.
+
+    Synthetic users are seeded into a scratch sqlite database and the
+    ClassifyUsers workers are run against an in-process fake of the
+    twitter API and the local NLP backend, each with a configurable
+    latency and rate limit. When every user has been classified (or the
+    timeout expires) a JSON report is printed with per-stage throughput,
+    queue wait times, end-to-end latency percentiles and the number of
+    database and redis operations, so runs can be compared between
+    releases.
+
+    The redis database given by --redis-db is flushed before the run.
+    If the --database file already exists the run stops, unless
+    --overwrite-database is given to delete it first.
+
+    Example:
+
+        python applications/benchmark_pipeline.py --users 200 --tweets-per-user 20 \\
+            --nlp-latency 0.05 --output bench.json
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import json
+import os
+from pathlib import Path
+import random
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+from dotenv import load_dotenv
+from peewee import fn
+import redis
+from requests.models import Response
+
+from ec601_proj2 import google_nlp, models, twitter_utils, workers, LOGGER
+from ec601_proj2.local_nlp import LocalLanguageClient
+from ec601_proj2.workers import Queues
+
+from classify_user_tweets import ClassifyUsers, init_loging
+
+load_dotenv()
+
+ENTITY_WORDS = ["Obama", "Paris", "NASA", "Google", "Boston", "SpaceX",
+                "Netflix", "London", "Tesla", "Olympics", "Microsoft", "China"]
+
+TOPIC_WORDS = [
+    ["football", "team", "season", "coach", "score", "soccer"],
+    ["stock", "money", "bank", "invest", "economy", "crypto"],
+    ["music", "album", "concert", "song", "movie", "show"],
+    ["code", "software", "data", "cloud", "computer", "app"],
+    ["pizza", "coffee", "dinner", "recipe", "restaurant", "wine"],
+    ["space", "research", "science", "climate", "rocket", "study"],
+]
+
+# Queues each stage pops from and pushes to.
+STAGE_QUEUES = {
+    "database": ([Queues.SCRAPE_USER_TWEETS_RESULTS,
+                  Queues.ENTITY_ANALYSIS_RESULTS,
+                  Queues.CLASSIFICATION_RESULTS],
+                 [Queues.SCRAPE_USER_TWEETS_REQUEST,
+                  Queues.ENTITY_ANALYSIS_REQUEST,
+                  Queues.CLASSIFICATION_REQUESTS]),
+    "scrape": ([Queues.SCRAPE_USER_TWEETS_REQUEST], [Queues.SCRAPE_USER_TWEETS_RESULTS]),
+    "entity": ([Queues.ENTITY_ANALYSIS_REQUEST], [Queues.ENTITY_ANALYSIS_RESULTS]),
+    "classify": ([Queues.CLASSIFICATION_REQUESTS], [Queues.CLASSIFICATION_RESULTS]),
+}
+
+QUEUE_KEYS = [
+    Queues.SCRAPE_USER_TWEETS_REQUEST,
+    Queues.SCRAPE_USER_TWEETS_RESULTS,
+    Queues.ENTITY_ANALYSIS_REQUEST,
+    Queues.ENTITY_ANALYSIS_RESULTS,
+    Queues.CLASSIFICATION_REQUESTS,
+    Queues.CLASSIFICATION_RESULTS,
+]
+
+# Queues stored as redis sets rather than lists.
+SET_QUEUES = {Queues.SCRAPE_USER_TWEETS_REQUEST}
+
+
+def generate_user_tweets(rng: random.Random, user_id: str, num_tweets: int,
+                         duplicate_ratio: float, seen: list) -> list[dict]:
+    """
+        Tweets for one user in the format of the twitter API. Each one
+        mentions an entity and a few words of a topic. duplicate_ratio of
+        them copy an earlier tweet's text, like retweets and promos do.
+    """
+    start_date = datetime.now() - timedelta(days=7)
+    tweets = []
+    for _ in range(num_tweets):
+        tweet_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        if seen and rng.random() < duplicate_ratio:
+            text = rng.choice(seen)
+        else:
+            topic = rng.choice(TOPIC_WORDS)
+            text = "%s %s, tweet %s from user %s" % (
+                rng.choice(ENTITY_WORDS), " ".join(rng.sample(topic, 3)),
+                tweet_id[:8], user_id)
+            seen.append(text)
+
+        created_at = start_date + timedelta(seconds=rng.randrange(7 * 24 * 60 * 60))
+        tweets.append(dict(id=tweet_id,
+                           author_id=user_id,
+                           created_at=created_at.strftime(twitter_utils.DATE_FORMAT),
+                           text=text))
+    return tweets
+
+
+def _response(status_code: int, headers: dict, payload: dict) -> Response:
+    response = Response()
+    response.status_code = status_code
+    response.headers.update(headers)
+    response._content = json.dumps(payload).encode() #pylint: disable=protected-access
+    return response
+
+
+class FakeTwitterAPI:
+    """
+        Stands in for twitter_utils.V2_API. Serves users/:id/tweets from
+        pre-generated tweets after latency seconds, with x-rate-limit-*
+        headers for limit requests per window seconds. Requests over the
+        limit get a 429 like the real API.
+    """
+
+    def __init__(self, tweets_by_user: dict, latency: float, limit: int, window: float):
+        self.tweets_by_user = tweets_by_user
+        self.latency = latency
+        self.limit = limit
+        self.window = window
+        self.requests = 0
+        self.rate_limited = 0
+        self._remaining = limit
+        self._reset = time.time() + window
+
+
+    def request(self, endpoint: str, params: dict = None):
+        parts = endpoint.split("/")
+        if len(parts) != 3 or parts[0] != "users" or parts[2] != "tweets":
+            raise NotImplementedError("Fake twitter API can't serve %s" % endpoint)
+
+        time.sleep(self.latency)
+        self.requests += 1
+        now = time.time()
+        if now >= self._reset:
+            self._remaining = self.limit
+            self._reset = now + self.window
+
+        headers = {
+            "x-rate-limit-limit": str(self.limit),
+            "x-rate-limit-remaining": str(max(self._remaining - 1, 0)),
+            "x-rate-limit-reset": str(int(self._reset)),
+        }
+        if self._remaining <= 0:
+            self.rate_limited += 1
+            return _response(429, headers, {})
+
+        self._remaining -= 1
+        limit = (params or {}).get("max_results", 10)
+        tweets = self.tweets_by_user.get(parts[1].lstrip(":"), [])[:limit]
+        return _response(200, headers, dict(data=tweets, meta=dict(result_count=len(tweets))))
+
+
+class FakeLanguageClient:
+    """
+        local_nlp.LocalLanguageClient with latency seconds added to every
+        call and a quota of requests_per_minute per method. Calls over the
+        quota raise ResourceExhausted like Google's API.
+    """
+
+    def __init__(self, latency: float, requests_per_minute: float):
+        self.latency = latency
+        self.requests_per_minute = requests_per_minute
+        self.calls = defaultdict(int)
+        self.rejected = defaultdict(int)
+        self._client = LocalLanguageClient()
+        self._windows = {}
+
+
+    def _call(self, method: str, text: str, **kwargs):
+        time.sleep(self.latency)
+        now = time.time()
+        start, count = self._windows.get(method, (now, 0))
+        if now - start >= 60:
+            start, count = now, 0
+
+        if count >= self.requests_per_minute:
+            self.rejected[method] += 1
+            raise google_nlp.ResourceExhausted("Quota exceeded for %s." % method)
+
+        self._windows[method] = (start, count + 1)
+        self.calls[method] += 1
+        return getattr(self._client, method)(text, **kwargs)
+
+
+    def analyze_entities(self, text: str, **kwargs):
+        return self._call("analyze_entities", text, **kwargs)
+
+
+    def classify_text(self, text: str, **kwargs):
+        return self._call("classify_text", text, **kwargs)
+
+
+    def analyze_sentiment(self, text: str, **kwargs):
+        return self._call("analyze_sentiment", text, **kwargs)
+
+
+    def annotate_text(self, text: str, **kwargs):
+        return self._call("annotate_text", text, **kwargs)
+
+
+class CountingPipeline(redis.client.Pipeline):
+
+    counter = None
+
+    def execute(self, raise_on_error=True):
+        self.counter.round_trips += 1
+        for args, _ in self.command_stack:
+            self.counter.commands[str(args[0]).upper()] += 1
+        return super().execute(raise_on_error)
+
+
+class CountingRedis(redis.Redis):
+    """Redis client that counts the commands and round trips it sends."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.round_trips = 0
+        self.commands = defaultdict(int)
+
+
+    def execute_command(self, *args, **options):
+        self.round_trips += 1
+        self.commands[str(args[0]).upper()] += 1
+        return super().execute_command(*args, **options)
+
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = CountingPipeline(self.connection_pool, self.response_callbacks,
+                                transaction, shard_hint)
+        pipe.counter = self
+        return pipe
+
+
+class QueryCounter:
+    """Counts the statements database executes, by their first keyword."""
+
+    def __init__(self, database):
+        self.counts = defaultdict(int)
+        self.paused = False
+        self._execute_sql = database.execute_sql
+        database.execute_sql = self.execute_sql
+
+
+    def execute_sql(self, sql, *args, **kwargs):
+        if not self.paused:
+            self.counts[sql.split(None, 1)[0].upper()] += 1
+        return self._execute_sql(sql, *args, **kwargs)
+
+
+    @contextmanager
+    def pause(self):
+        """Don't count the benchmark's own queries."""
+        self.paused = True
+        try:
+            yield
+        finally:
+            self.paused = False
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {}
+
+    values = sorted(values)
+    def rank(p):
+        return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+    return dict(p50=rank(50), p90=rank(90), p99=rank(99), max=values[-1],
+                mean=sum(values) / len(values))
+
+
+class PipelineBenchmark:
+    """
+        Runs the ClassifyUsers stages in a loop, like the daemon does,
+        and measures each call. Queue lengths are sampled around every
+        stage call with a separate redis connection, so the benchmark's
+        own commands aren't counted. Queue wait times are estimated with
+        Little's law: the average queue length over the run divided by
+        the rate items left the queue.
+    """
+
+    # How long to sleep when no stage had anything to do.
+    IDLE_WAIT = 0.01
+
+    def __init__(self, app: ClassifyUsers, monitor: redis.Redis, queries: QueryCounter):
+        self.app = app
+        self.monitor = monitor
+        self.queries = queries
+        self.stages = {name: dict(calls=0, busy_seconds=0.0, consumed=0, produced=0)
+                       for name in STAGE_QUEUES}
+        self.queue_area = defaultdict(float)
+        self.departures = defaultdict(int)
+        self.arrivals = {}
+        self.latencies = {}
+        self._last_lengths = None
+        self._last_sample = None
+
+
+    def _queue_lengths(self) -> dict:
+        pipe = self.monitor.pipeline(transaction=False)
+        for key in QUEUE_KEYS:
+            if key in SET_QUEUES:
+                pipe.scard(key)
+            else:
+                pipe.llen(key)
+        lengths = dict(zip(QUEUE_KEYS, pipe.execute()))
+
+        now = time.time()
+        if self._last_lengths is not None:
+            for key, length in self._last_lengths.items():
+                self.queue_area[key] += length * (now - self._last_sample)
+        self._last_lengths = lengths
+        self._last_sample = now
+        return lengths
+
+
+    def _run_stage(self, name: str, worker) -> bool:
+        """Run one process() call of a stage. Returns True if it moved any items."""
+        inputs, outputs = STAGE_QUEUES[name]
+        before = self._queue_lengths()
+        start = time.perf_counter()
+        worker.process()
+        busy = time.perf_counter() - start
+        after = self._queue_lengths()
+
+        consumed = 0
+        for key in inputs:
+            departed = max(0, before[key] - after[key])
+            self.departures[key] += departed
+            consumed += departed
+        produced = sum(max(0, after[key] - before[key]) for key in outputs)
+
+        stats = self.stages[name]
+        stats["calls"] += 1
+        stats["busy_seconds"] += busy
+        stats["consumed"] += consumed
+        stats["produced"] += produced
+        return bool(consumed or produced)
+
+
+    def _record_finished_users(self):
+        now = time.time()
+        pending = [user_id for user_id in self.arrivals if user_id not in self.latencies]
+        unclassified = models.Tweet.select().where(
+            (models.Tweet.user == models.User.id) & (models.Tweet.classified >> False))
+        query = models.User.select(models.User.id).where(
+            (models.User.id << pending) &
+            models.User.last_scraped.is_null(False) &
+            ~fn.EXISTS(unclassified))
+        for user in query:
+            self.latencies[user.id] = now - self.arrivals[user.id]
+
+
+    def _add_users(self, users: list[dict]):
+        models.User.insert_many(users).execute()
+        now = time.time()
+        for user in users:
+            self.arrivals[user["id"]] = now
+
+
+    def run(self, users: list[dict], arrival_rate: float, timeout: float) -> float:
+        """
+            Run until every user is classified or timeout seconds pass.
+            Users are added all at once, or arrival_rate users per
+            second if it is set. Returns the elapsed time.
+        """
+        start = time.time()
+        added = 0
+        while len(self.latencies) < len(users) and time.time() - start < timeout:
+            due = len(users) if not arrival_rate else min(
+                len(users), int((time.time() - start) * arrival_rate) + 1)
+            if due > added:
+                with self.queries.pause():
+                    self._add_users(users[added:due])
+                added = due
+
+            progressed = self._run_stage("database", self.app.db_worker)
+            with self.queries.pause():
+                self._record_finished_users()
+
+            progressed |= self._run_stage("scrape", self.app.twitter_worker)
+            progressed |= self._run_stage("entity", self.app.entity_worker)
+            progressed |= self._run_stage("classify", self.app.classify_worker)
+            if not progressed:
+                time.sleep(self.IDLE_WAIT)
+
+        self._queue_lengths()
+        return time.time() - start
+
+
+    def report(self, elapsed: float) -> dict:
+        stages = {}
+        for name, stats in self.stages.items():
+            busy = stats["busy_seconds"]
+            stages[name] = dict(stats, items_per_busy_second=stats["consumed"] / busy if busy else 0)
+
+        queues = {}
+        for key in QUEUE_KEYS:
+            departures = self.departures[key]
+            queues[key] = dict(
+                avg_length=self.queue_area[key] / elapsed if elapsed else 0,
+                departures=departures,
+                avg_wait_seconds=self.queue_area[key] / departures if departures else None)
+
+        return dict(elapsed_seconds=elapsed,
+                    stages=stages,
+                    queues=queues,
+                    latency_seconds=percentiles(list(self.latencies.values())))
+
+
+def seed_users(num_users: int, tweets_per_user: int, duplicate_ratio: float, seed: int):
+    rng = random.Random(seed)
+    seen = []
+    users = []
+    tweets_by_user = {}
+    for i in range(num_users):
+        user_id = str(1000000 + i)
+        users.append(dict(id=user_id,
+                          name="Benchmark User %d" % i,
+                          username="benchmark_user_%d" % i,
+                          url="https://example.com",
+                          description="",
+                          verified=False,
+                          protected=False))
+        tweets_by_user[user_id] = generate_user_tweets(rng, user_id, tweets_per_user,
+                                                       duplicate_ratio, seen)
+    return users, tweets_by_user
+
+
+@contextmanager
+def fake_services(twitter: FakeTwitterAPI, nlp: FakeLanguageClient,
+                  nlp_requests_per_minute: float, redis_client: redis.Redis):
+    """
+        Point the modules the workers call at the fake APIs, and put the
+        real ones back on exit so the process can go on using them.
+    """
+    real_twitter = twitter_utils.V2_API
+    real_hook = twitter_utils._RATE_LIMIT_HOOK #pylint: disable=protected-access
+    # Read the module dict so the lazy Google client isn't created.
+    real_nlp = vars(google_nlp).get("LanguageClient")
+    real_limits = dict(workers.GOOGLE_NLP_REQUESTS_PER_MINUTE)
+
+    twitter_utils.V2_API = twitter
+    google_nlp.LanguageClient = nlp
+    for method in workers.GOOGLE_NLP_REQUESTS_PER_MINUTE:
+        workers.GOOGLE_NLP_REQUESTS_PER_MINUTE[method] = nlp_requests_per_minute
+    workers.track_twitter_rate_limits(redis_client)
+    try:
+        yield
+    finally:
+        twitter_utils.V2_API = real_twitter
+        twitter_utils.set_rate_limit_hook(real_hook)
+        if real_nlp is None:
+            del google_nlp.LanguageClient
+        else:
+            google_nlp.LanguageClient = real_nlp
+        workers.GOOGLE_NLP_REQUESTS_PER_MINUTE.update(real_limits)
+
+
+def run_benchmark(args) -> dict:
+    if args.tweets_per_user > 50:
+        raise ValueError("ClassifyUsers scrapes at most 50 tweets per user.")
+
+    monitor = redis.Redis(args.redis_host, args.redis_port, args.redis_db)
+    if monitor.dbsize() and not args.flush:
+        raise RuntimeError("Redis database %d is not empty. Pass --flush to clear it."
+                           % args.redis_db)
+    if args.database and args.database.exists():
+        if not args.overwrite_database:
+            raise RuntimeError("%s already exists. Pass --overwrite-database to replace it."
+                               % args.database)
+        for suffix in ("", "-wal", "-shm"):
+            Path(str(args.database) + suffix).unlink(missing_ok=True)
+    monitor.flushdb()
+
+    workdir = Path(tempfile.mkdtemp(prefix="benchmark_pipeline_"))
+    database = models.init_db(str(args.database or workdir / "benchmark.db"))
+    try:
+        users, tweets_by_user = seed_users(args.users, args.tweets_per_user,
+                                           args.duplicate_ratio, args.seed)
+
+        twitter = FakeTwitterAPI(tweets_by_user, args.twitter_latency,
+                                 args.twitter_limit, args.twitter_window)
+        nlp = FakeLanguageClient(args.nlp_latency, args.nlp_requests_per_minute)
+        client = CountingRedis(args.redis_host, args.redis_port, args.redis_db)
+        with fake_services(twitter, nlp, args.nlp_requests_per_minute, client):
+            app = ClassifyUsers(client, database)
+            queries = QueryCounter(database)
+            benchmark = PipelineBenchmark(app, monitor, queries)
+            elapsed = benchmark.run(users, args.arrival_rate, args.timeout)
+
+        report = benchmark.report(elapsed)
+        completed = len(benchmark.latencies)
+        tweets = sum(len(t) for t in tweets_by_user.values())
+        report.update(
+            config={k: (str(v) if isinstance(v, Path) else v) for k, v in vars(args).items()},
+            users=dict(seeded=len(users), completed=completed),
+            tweets=tweets,
+            throughput=dict(users_per_second=completed / elapsed,
+                            tweets_per_second=tweets * completed / len(users) / elapsed),
+            database=dict(queries=sum(queries.counts.values()),
+                          by_statement=dict(queries.counts)),
+            redis=dict(round_trips=client.round_trips,
+                       commands=sum(client.commands.values()),
+                       by_command=dict(client.commands)),
+            twitter=dict(requests=twitter.requests, rate_limited=twitter.rate_limited),
+            nlp=dict(calls=dict(nlp.calls), rejected=dict(nlp.rejected)),
+            user_topics=models.UserTopic.select().count(),
+        )
+        if app.entity_worker.nlp_cache is not None:
+            report["nlp"]["cache"] = app.entity_worker.nlp_cache.stats()
+        return report
+    finally:
+        database.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def parse_args(argv=None):
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="Benchmark the classify_user_tweets pipeline.")
+    parser.add_argument("-u", "--users", type=int, default=50)
+    parser.add_argument("-t", "--tweets-per-user", type=int, default=20)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.1,
+                        help="Fraction of tweets that repeat an earlier tweet's text.")
+    parser.add_argument("--arrival-rate", type=float, default=0,
+                        help="Users queued per second. By default all are queued at once.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--twitter-latency", type=float, default=0.02,
+                        help="Seconds per fake twitter request.")
+    parser.add_argument("--twitter-limit", type=int, default=1500,
+                        help="Fake twitter requests allowed per window.")
+    parser.add_argument("--twitter-window", type=float, default=15,
+                        help="Fake twitter rate limit window in seconds. Scaled down "
+                             "from twitter's 15 minutes so runs stay short.")
+    parser.add_argument("--nlp-latency", type=float, default=0.05,
+                        help="Seconds per fake NLP call.")
+    parser.add_argument("--nlp-requests-per-minute", type=float, default=600,
+                        help="Fake NLP quota per method. The workers are paced to it.")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--database", type=Path, default=None,
+                        help="SQLite file to use. Defaults to a temporary file.")
+    parser.add_argument("--overwrite-database", action="store_true", default=False,
+                        help="Delete the --database file if it already exists.")
+    parser.add_argument("--redis-host", default=os.getenv("REDIS_SERVER_HOST", "localhost"))
+    parser.add_argument("--redis-port", type=int,
+                        default=int(os.getenv("REDIS_SERVER_PORT", "6379")))
+    parser.add_argument("--redis-db", type=int, default=15,
+                        help="Redis database to run in. It is flushed.")
+    parser.add_argument("--flush", action="store_true", default=False,
+                        help="Flush the redis database even if it isn't empty.")
+    parser.add_argument("-o", "--output", type=Path, default=None,
+                        help="Write the JSON report here instead of stdout.")
+    parser.add_argument("-l", "--log-level", default="warning")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    log_file = Path(__file__).with_suffix(".log").name
+    init_loging(log_file, args.log_level.upper())
+
+    report = run_benchmark(args)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        args.output.write_text(output + "\n")
+    else:
+        print(output)
+
+    if report["users"]["completed"] < report["users"]["seeded"]:
+        LOGGER.error("Timed out with %d of %d users classified.",
+                     report["users"]["completed"], report["users"]["seeded"])
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
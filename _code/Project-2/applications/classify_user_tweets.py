@@ -1,4 +1,7 @@
+import asyncio
+import multiprocessing
 import os
+import signal
 import time
 import logging
 import sys
@@ -8,24 +11,52 @@ import peewee
 import redis
 
 from ec601_proj2 import models, twitter_utils, LOGGER
+from ec601_proj2.profiling import StageProfiler
+from ec601_proj2.topic_index import TopicIndex
 
 from ec601_proj2.workers import (
+    AsyncClassificationWorker,
+    AsyncEntityAnalysisWorker,
     DatabaseWorker,
     EntityAnalysisWorker,
     ClassificationWorker,
+    GOOGLE_NLP_CACHE_TTL,
+    GOOGLE_NLP_ENTITY_BATCH_CHARS,
+    NLPResponseCache,
     ScrapeUserTweetsWorker,
-    get_google_rate_limit_expires,
-    get_twitter_rate_limt_expires
+    Queues,
+    TOPICS_GENERATION_KEY,
+    track_twitter_rate_limits
 )
 
 load_dotenv()
 
-REDIS_SERVER_HOST = os.getenv("REDIS_SERVER_HOST")
-REDIS_SERVER_PORT = int(os.getenv("REDIS_SERVER_PORT"))
-REDIS_SERVER_DB = int(os.getenv("REDIS_SERVER_DB"))
+REDIS_SERVER_HOST = os.getenv("REDIS_SERVER_HOST", "localhost")
+REDIS_SERVER_PORT = int(os.getenv("REDIS_SERVER_PORT", "6379"))
+REDIS_SERVER_DB = int(os.getenv("REDIS_SERVER_DB", "0"))
 
 DB_FILE = os.getenv("SQLITE_DATABASE")
 
+def nlp_cache(redis_client: redis.Redis):
+    """The shared NLP response cache, or None if GOOGLE_NLP_CACHE_TTL is 0."""
+    if not GOOGLE_NLP_CACHE_TTL:
+        return None
+    return NLPResponseCache(redis_client)
+
+
+def create_profiler(profile_options: dict):
+    """
+        A StageProfiler for profile_options, or None if profiling is off.
+        SIGUSR1 makes it dump its stats.
+    """
+    if not profile_options:
+        return None
+
+    profiler = StageProfiler(**profile_options)
+    signal.signal(signal.SIGUSR1, lambda *_: profiler.request_dump())
+    return profiler
+
+
 def init_loging(filename, log_level):
     log_formatter = logging.Formatter("%(asctime)s %(levelname)-8s %(name)-15s %(message)s [%(module)s:%(lineno)s]")
     file_handler = logging.FileHandler(filename)
@@ -43,6 +74,26 @@ def init_loging(filename, log_level):
 
 class ClassifyUsers:
 
+    # Bounds for how long the event driven loop blocks waiting for
+    # work. The wait doubles each time it times out with nothing to do
+    # and drops back to the minimum as soon as an item arrives.
+    MIN_IDLE_WAIT = 0.1
+    MAX_IDLE_WAIT = 5.0
+
+    # Worker methods the run loops call directly, and so get profiled.
+    PROFILED_METHODS = {
+        "db_worker": ("process",
+                      "store_scraped_tweets",
+                      "store_entity_analysis_results",
+                      "store_classification_results",
+                      "queue_users_to_scrape",
+                      "queue_entity_analysis_requests",
+                      "queue_classification_requests"),
+        "twitter_worker": ("process",),
+        "entity_worker": ("process", "analyze_request"),
+        "classify_worker": ("process", "classify_request"),
+    }
+
     def __init__(self, redis_client: redis.Redis, database: peewee.Database):
 
         self.redis_client = redis_client
@@ -57,12 +108,20 @@ class ClassifyUsers:
 
 
         self.db_worker = DatabaseWorker(self.redis_client)
-        self.entity_worker = EntityAnalysisWorker(self.redis_client)
-        self.classify_worker = ClassificationWorker(self.redis_client)
+        models.warm_intern_caches()
+        cache = nlp_cache(self.redis_client)
+        self.entity_worker = EntityAnalysisWorker(self.redis_client, nlp_cache=cache,
+                                                  batch_chars=GOOGLE_NLP_ENTITY_BATCH_CHARS)
+        self.classify_worker = ClassificationWorker(self.redis_client, nlp_cache=cache)
         # Grab 50 tweets per user.
         self.twitter_worker = ScrapeUserTweetsWorker(self.redis_client, tweet_count=50)
 
 
+    def enable_profiling(self, profiler: StageProfiler):
+        for name, methods in self.PROFILED_METHODS.items():
+            profiler.profile(getattr(self, name), methods)
+
+
     def _run_forever(self):
         while True:
             LOGGER.debug("Process db_worker")
@@ -76,6 +135,94 @@ class ClassifyUsers:
             time.sleep(0.2)
 
 
+    def _blocking_keys(self):
+        """
+            Lists the event loop should block on. Queues feeding the
+            google workers are left out while that worker is rate limited
+            so their items stay put until it can call the API again.
+        """
+        keys = [
+            Queues.SCRAPE_USER_TWEETS_RESULTS,
+            Queues.ENTITY_ANALYSIS_RESULTS,
+            Queues.CLASSIFICATION_RESULTS,
+        ]
+        if self.entity_worker.wait_time() <= 0:
+            keys.append(Queues.ENTITY_ANALYSIS_REQUEST)
+        if self.classify_worker.wait_time() <= 0:
+            keys.append(Queues.CLASSIFICATION_REQUESTS)
+
+        return keys
+
+
+    def _dispatch(self, key, data):
+        """
+            Hand an item popped off one of the pipeline lists to the
+            worker that consumes it.
+        """
+        key = key.decode()
+        if key == Queues.ENTITY_ANALYSIS_REQUEST:
+            self.entity_worker.analyze_request(data)
+        elif key == Queues.CLASSIFICATION_REQUESTS:
+            self.classify_worker.classify_request(data)
+        else:
+            # Results are stored in batches, so put the item back and
+            # let the database worker drain the whole list.
+            self.redis_client.lpush(key, data)
+            if key == Queues.SCRAPE_USER_TWEETS_RESULTS:
+                self.db_worker.store_scraped_tweets()
+                self.db_worker.queue_entity_analysis_requests()
+            elif key == Queues.ENTITY_ANALYSIS_RESULTS:
+                # Queueing classification requests scans every unclassified
+                # tweet, so it's left to the database poll in the run loop.
+                self.db_worker.store_entity_analysis_results()
+            elif key == Queues.CLASSIFICATION_RESULTS:
+                self.db_worker.store_classification_results()
+
+
+    def _run_event_driven(self):
+        """
+            Block on the pipeline lists with BLPOP and process items as
+            soon as they arrive. When nothing arrives before the timeout
+            the database is polled for new work and the timeout backs
+            off. The timeout never runs past a rate limit expiring so
+            the rate limited workers resume right away.
+        """
+        idle_wait = self.MIN_IDLE_WAIT
+        poll_database = True
+        last_poll = 0
+        while True:
+            # Keep picking up new users even if the queues never go idle.
+            if poll_database or time.time() - last_poll > self.MAX_IDLE_WAIT:
+                LOGGER.debug("Process db_worker")
+                self.db_worker.process()
+                poll_database = False
+                last_poll = time.time()
+
+            # Users to scrape are kept in a set, which can't be blocked on.
+            scraped = self.twitter_worker.process() is True
+
+            timeout = idle_wait
+            for wait in (self.entity_worker.wait_time(),
+                         self.classify_worker.wait_time(),
+                         self.twitter_worker.wait_time()):
+                if wait > 0:
+                    timeout = min(timeout, wait)
+
+            if scraped:
+                timeout = 0.001
+
+            item = self.redis_client.blpop(self._blocking_keys(), timeout=timeout)
+            if item is None:
+                if not scraped:
+                    idle_wait = min(idle_wait * 2, self.MAX_IDLE_WAIT)
+                    poll_database = True
+                continue
+
+            idle_wait = self.MIN_IDLE_WAIT
+            key, data = item
+            self._dispatch(key, data)
+
+
     def _run_single(self):
         # Scrape Twitter
         self.db_worker.queue_users_to_scrape()
@@ -86,7 +233,7 @@ class ClassifyUsers:
 
             if rc == "wait":
                 LOGGER.info("Waiting for twitter rate limit to expire.")
-                time.sleep(get_twitter_rate_limt_expires(self.redis_client))
+                time.sleep(self.twitter_worker.wait_time())
         self.db_worker.store_scraped_tweets()
 
         # Entity Analysis
@@ -97,7 +244,7 @@ class ClassifyUsers:
                 break
 
             if rc == "wait":
-                tts = get_google_rate_limit_expires(self.redis_client)
+                tts = self.entity_worker.wait_time()
                 LOGGER.info("Waiting for google rate limit to expire: %s", tts)
                 time.sleep(tts)
         self.db_worker.store_entity_analysis_results()
@@ -110,21 +257,256 @@ class ClassifyUsers:
                 break
 
             if rc == "wait":
-                tts = get_google_rate_limit_expires(self.redis_client)
+                tts = self.classify_worker.wait_time()
                 LOGGER.info("Waiting for google rate limit to expire: %s", tts)
                 time.sleep(tts)
         self.db_worker.store_classification_results()
+        for worker in (self.db_worker, self.twitter_worker,
+                       self.entity_worker, self.classify_worker):
+            worker.metrics.flush()
         time.sleep(1)
 
 
 
-    def run(self, single=True):
+    def run(self, single=True, event_driven=False):
         if single:
             self._run_single()
+        elif event_driven:
+            self._run_event_driven()
         else:
             self._run_forever()
 
 
+def parse_worker_counts(spec: str) -> dict:
+    """
+        Parse a worker spec like "scrape=2,entity=8,classify=4" into
+        a dict of stage name to process count.
+    """
+    counts = {}
+    for part in spec.split(","):
+        stage, _, count = part.partition("=")
+        stage = stage.strip()
+        if stage not in WorkerSupervisor.STAGES:
+            raise ValueError("Unknown worker stage: %s. Must be one of: %s" %
+                             (stage, ", ".join(WorkerSupervisor.STAGES)))
+        try:
+            counts[stage] = int(count)
+        except ValueError as err:
+            raise ValueError("Invalid worker count for %s: %s" % (stage, count)) from err
+        if counts[stage] < 1:
+            raise ValueError("Worker count for %s must be at least 1: %s" % (stage, count))
+
+    return counts
+
+
+async def _run_async_stage_worker(worker):
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    await worker.run_async(stop=stop)
+
+
+def _run_stage_worker(stage: str, nlp_concurrency: int = None, profile_options: dict = None):
+    """
+        Entry point for a supervised worker process. Runs one stage's
+        worker until SIGTERM is received, finishing the item in
+        progress before exiting.
+
+        If nlp_concurrency is set, the NLP stages use the asyncio
+        workers with that many requests in flight.
+
+        If profile_options is set, the worker's process() calls are
+        profiled with a StageProfiler created with them.
+    """
+    # The supervisor forwards SIGUSR1 to every worker, and its default
+    # action would kill the ones that aren't profiling. This also
+    # replaces the supervisor's handler inherited through fork. SIGUSR1
+    # is blocked until then (see WorkerSupervisor._start_process).
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGUSR1})
+
+    if nlp_concurrency and stage in WorkerSupervisor.ASYNC_STAGES:
+        if profile_options:
+            LOGGER.warning("Profiling isn't supported for the asyncio %s workers.", stage)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        redis_client = redis.Redis(REDIS_SERVER_HOST,
+                                   REDIS_SERVER_PORT,
+                                   REDIS_SERVER_DB)
+        worker = WorkerSupervisor.ASYNC_STAGES[stage](redis_client,
+                                                      concurrency=nlp_concurrency,
+                                                      nlp_cache=nlp_cache(redis_client))
+        asyncio.run(_run_async_stage_worker(worker))
+        LOGGER.info("%s worker (pid %s) stopped.", stage, os.getpid())
+        return
+
+    stopping = False
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Connections must not be shared with the parent after forking, and
+    # that includes the one the inherited rate limit hook writes to.
+    redis_client = redis.Redis(REDIS_SERVER_HOST,
+                               REDIS_SERVER_PORT,
+                               REDIS_SERVER_DB)
+    track_twitter_rate_limits(redis_client)
+    models.init_db(DB_FILE)
+
+    worker = WorkerSupervisor.STAGES[stage](redis_client)
+    profiler = create_profiler(profile_options)
+    if profiler:
+        profiler.profile(worker)
+
+    idle_wait = ClassifyUsers.MIN_IDLE_WAIT
+    while not stopping:
+        rc = worker.process()
+        if rc is True:
+            idle_wait = ClassifyUsers.MIN_IDLE_WAIT
+            continue
+
+        if rc == "wait":
+            wait = worker.wait_time()
+        else:
+            wait = idle_wait
+            idle_wait = min(idle_wait * 2, ClassifyUsers.MAX_IDLE_WAIT)
+
+        # Sleep in short steps so SIGTERM is handled promptly.
+        deadline = time.time() + max(wait, 0)
+        while not stopping and time.time() < deadline:
+            time.sleep(min(0.5, deadline - time.time()))
+
+    worker.metrics.flush()
+    if profiler:
+        profiler.close()
+    LOGGER.info("%s worker (pid %s) stopped.", stage, os.getpid())
+
+
+class WorkerSupervisor:
+    """
+        Runs each pipeline stage in its own set of processes. The
+        supervisor process itself runs the DatabaseWorker so there is
+        still a single writer to the database. Worker processes that
+        exit unexpectedly are restarted and all of them are shut down
+        gracefully on SIGTERM or SIGINT.
+    """
+
+    STAGES = {
+        "scrape": lambda client: ScrapeUserTweetsWorker(client, tweet_count=50),
+        "entity": lambda client: EntityAnalysisWorker(client, nlp_cache=nlp_cache(client),
+                                                      batch_chars=GOOGLE_NLP_ENTITY_BATCH_CHARS),
+        "classify": lambda client: ClassificationWorker(client, nlp_cache=nlp_cache(client)),
+    }
+
+    ASYNC_STAGES = {
+        "entity": AsyncEntityAnalysisWorker,
+        "classify": AsyncClassificationWorker,
+    }
+
+    # Don't restart a crashing stage more often than this.
+    RESTART_DELAY = 5.0
+
+    # How long to wait for workers to finish their item on shutdown.
+    SHUTDOWN_TIMEOUT = 30.0
+
+    def __init__(self, redis_client: redis.Redis, database: peewee.Database, counts: dict,
+                 nlp_concurrency: int = None, profile_options: dict = None):
+        self.redis_client = redis_client
+        self.database = database
+        self.counts = counts
+        self.nlp_concurrency = nlp_concurrency
+        self.profile_options = profile_options
+        self.db_worker = DatabaseWorker(self.redis_client)
+        self._processes = {stage: [] for stage in counts}
+        self._last_start = {}
+        self._stopping = False
+
+
+    def _start_process(self, stage):
+        self._last_start[stage] = time.time()
+        proc = multiprocessing.Process(target=_run_stage_worker,
+                                       args=(stage, self.nlp_concurrency,
+                                             self.profile_options),
+                                       name="%s-worker" % stage,
+                                       daemon=True)
+        # Keep SIGUSR1 blocked in the child until it has replaced the
+        # inherited handler, which would signal this process's workers.
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGUSR1})
+        try:
+            proc.start()
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGUSR1})
+        LOGGER.info("Started %s worker (pid %s).", stage, proc.pid)
+        return proc
+
+
+    def _check_processes(self):
+        for stage, procs in self._processes.items():
+            alive = [p for p in procs if p.is_alive()]
+            for proc in procs:
+                if not proc.is_alive():
+                    LOGGER.error("%s worker (pid %s) exited with code %s.",
+                                 stage, proc.pid, proc.exitcode)
+
+            missing = self.counts[stage] - len(alive)
+            if missing and time.time() - self._last_start.get(stage, 0) >= self.RESTART_DELAY:
+                alive += [self._start_process(stage) for _ in range(missing)]
+            self._processes[stage] = alive
+
+
+    def _stop(self, *_):
+        self._stopping = True
+
+
+    def _dump_profiles(self, profiler):
+        profiler.request_dump()
+        for proc in [p for procs in self._processes.values() for p in procs]:
+            if proc.is_alive():
+                os.kill(proc.pid, signal.SIGUSR1)
+
+
+    def _shutdown(self):
+        procs = [p for procs in self._processes.values() for p in procs]
+        LOGGER.info("Stopping %d worker processes.", len(procs))
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+
+        deadline = time.time() + self.SHUTDOWN_TIMEOUT
+        for proc in procs:
+            proc.join(max(deadline - time.time(), 0))
+            if proc.is_alive():
+                LOGGER.warning("Killing %s worker (pid %s).", proc.name, proc.pid)
+                proc.kill()
+                proc.join()
+
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        profiler = create_profiler(self.profile_options)
+        if profiler:
+            profiler.profile(self.db_worker)
+            # Pass SIGUSR1 on to the workers so they dump too.
+            signal.signal(signal.SIGUSR1, lambda *_: self._dump_profiles(profiler))
+
+        for stage, count in self.counts.items():
+            self._processes[stage] = [self._start_process(stage) for _ in range(count)]
+
+        try:
+            while not self._stopping:
+                self.db_worker.process()
+                self._check_processes()
+                time.sleep(0.2)
+        finally:
+            self.db_worker.metrics.flush()
+            if profiler:
+                profiler.close()
+            self._shutdown()
+
+
 def queue_user(database, redis_client, username):
     try:
         user = models.User.get(models.User.username == username)
@@ -137,9 +519,36 @@ def queue_user(database, redis_client, username):
         user = models.create_user(twitter_user)
 
 
+def profiler_options_from_args(args) -> dict:
+    """StageProfiler arguments for the --profile options, or None."""
+    if not args.profile:
+        return None
+
+    return dict(output_dir=args.profile,
+                dump_interval=args.profile_interval,
+                duration=args.profile_duration,
+                sample_interval=args.profile_sample_interval)
+
+
 def run_worker_pipline_command(database, redis_client, args):
+    if args.workers:
+        models.warm_intern_caches()
+        supervisor = WorkerSupervisor(redis_client, database, args.workers,
+                                      nlp_concurrency=args.nlp_concurrency,
+                                      profile_options=profiler_options_from_args(args))
+        supervisor.run()
+        return
+
     app = ClassifyUsers(redis_client, database)
-    app.run(single=not args.as_daemon)
+    profiler = create_profiler(profiler_options_from_args(args))
+    if profiler:
+        app.enable_profiling(profiler)
+
+    try:
+        app.run(single=not args.as_daemon, event_driven=args.event_driven)
+    finally:
+        if profiler:
+            profiler.close()
 
 
 # TODO: Figure out if there's a better way to use subparsers
@@ -148,6 +557,13 @@ def queue_user_command(database, redis_client: redis.Redis, args):
     queue_user(database, redis_client, args.username)
 
 
+def rebuild_topic_index_command(database, redis_client: redis.Redis, args):
+    count = TopicIndex(redis_client).rebuild(batch_size=args.batch_size)
+    # Responses the web client cached from the old index are stale.
+    redis_client.incr(TOPICS_GENERATION_KEY)
+    LOGGER.info("Indexed %d user topics.", count)
+
+
 def main():
     from argparse import ArgumentParser
     from pathlib import Path
@@ -158,12 +574,43 @@ def main():
     subparsers = parser.add_subparsers()
     worker_parser = subparsers.add_parser("process")
     worker_parser.add_argument("-d", "--as-daemon", action="store_true", default=False)
+    worker_parser.add_argument("-e", "--event-driven", action="store_true", default=False,
+                               help="When running as a daemon, block on the work queues "
+                                    "instead of polling them.")
+    worker_parser.add_argument("-w", "--workers", type=parse_worker_counts, default=None,
+                               help="Run each stage in its own processes, e.g. "
+                                    "scrape=2,entity=8,classify=4. The database "
+                                    "worker runs in the supervising process.")
+    worker_parser.add_argument("-c", "--nlp-concurrency", type=int, default=None,
+                               help="With --workers, run the entity and classify stages "
+                                    "on asyncio with this many requests in flight "
+                                    "per process.")
+    worker_parser.add_argument("-p", "--profile", type=Path, default=None, metavar="DIR",
+                               help="Profile each stage and write <stage>.<pid>.pstats "
+                                    "and <stage>.<pid>.collapsed files to DIR. Send "
+                                    "SIGUSR1 to write them right away.")
+    worker_parser.add_argument("--profile-interval", type=float, default=60,
+                               help="Seconds between writing profiles (0 only writes "
+                                    "them on SIGUSR1 and exit).")
+    worker_parser.add_argument("--profile-duration", type=float, default=None,
+                               help="Stop profiling after this many seconds.")
+    worker_parser.add_argument("--profile-sample-interval", type=float, default=0.005,
+                               help="Seconds between stack samples for the collapsed "
+                                    "stack files (0 disables sampling).")
     worker_parser.set_defaults(func=run_worker_pipline_command)
 
     queue_user_parser = subparsers.add_parser("queue-user")
     queue_user_parser.add_argument("username")
     queue_user_parser.set_defaults(func=queue_user_command)
 
+    rebuild_index_parser = subparsers.add_parser(
+        "rebuild-topic-index",
+        help="Recreate the redis index of users by topic from the database. Stop "
+             "the pipeline while it runs.")
+    rebuild_index_parser.add_argument("--batch-size", type=int, default=5000,
+                                      help="User topics written to redis per round trip.")
+    rebuild_index_parser.set_defaults(func=rebuild_topic_index_command)
+
     args = parser.parse_args()
 
     try:
@@ -179,6 +626,7 @@ def main():
     redis_client = redis.Redis(REDIS_SERVER_HOST,
                                REDIS_SERVER_PORT,
                                REDIS_SERVER_DB)
+    track_twitter_rate_limits(redis_client)
 
     LOGGER.debug("Using database file: %s", DB_FILE)
     database = models.init_db(DB_FILE)
@@ -13,10 +13,16 @@ from ec601_proj2 import (
     models,
     LOGGER
 )
+from ec601_proj2.frontier import (
+    DEFAULT_PRIORITY_WEIGHTS,
+    Frontier,
+    parse_priority_weights
+)
 
 from ec601_proj2.workers import (
     set_twitter_rate_limit_expires,
-    get_twitter_rate_limt_expires
+    get_twitter_rate_limt_expires,
+    track_twitter_rate_limits
 )
 
 load_dotenv()
@@ -44,10 +50,19 @@ def init_loging(filename, log_level):
 
 class DiscoverUsers:
 
-    def __init__(self, redis_client: redis.Redis, database: peewee.Database):
+    TWITTER_ENDPOINT = "users/:id/following"
+
+    # Seconds to sleep when running forever and the frontier is empty.
+    IDLE_SLEEP = 10
+
+    def __init__(self, redis_client: redis.Redis, database: peewee.Database,
+                 max_depth: int = None, priority_weights: dict = None):
 
         self.redis_client = redis_client
         self.database = database
+        self.frontier = Frontier(redis_client, priority_weights, max_depth)
+        # Users up to this rowid have been offered to the frontier as seeds.
+        self._last_seed_rowid = 0
 
         try:
             self.redis_client.keys()
@@ -59,7 +74,7 @@ class DiscoverUsers:
 
     def wait_for_rate_limit(self, sleep_wait=False):
         while True:
-            wait_time = get_twitter_rate_limt_expires(self.redis_client)
+            wait_time = get_twitter_rate_limt_expires(self.redis_client, self.TWITTER_ENDPOINT)
 
             if wait_time <= 0:
                 break
@@ -78,40 +93,92 @@ class DiscoverUsers:
                 break
 
 
-    def scrape_user_following(self, user: models.User):
-        if get_twitter_rate_limt_expires(self.redis_client) > 0:
+    def scrape_user_following(self, user: models.User, depth: int = 0) -> bool:
+        """
+            Store the users user follows and add them to the frontier one
+            deeper than user. Returns False if the crawl was stopped by
+            the rate limit.
+        """
+        if get_twitter_rate_limt_expires(self.redis_client, self.TWITTER_ENDPOINT) > 0:
             LOGGER.info("Not sraping user because twitter rate limit has not expired.")
-            return
+            return False
 
         try:
-            for following in twitter_utils.iterate_following(user.id):
-                count = models.User.select().where(models.User.id == following.id).count()
-                if count > 0:
-                    continue
-
-                model = models.create_user(following)
-                LOGGER.debug("Added user: %s (id: %s)",
-                                model.username,
-                                model.id)
+            # Each page is stored in one transaction.
+            for page in twitter_utils.iterate_following_pages(user.id):
+                with models.atomic():
+                    new_users = models.add_users(page)
+                queued = self.frontier.add(page, depth + 1)
+                LOGGER.debug("Added %d new users of %d followed by %s, %d queued to crawl.",
+                             len(new_users), len(page), user.username, queued)
+                if not self.frontier.renew(user.id):
+                    LOGGER.warning("Claim on %s expired while crawling it.", user.username)
 
             user.scraped_following = True
             user.save()
+            return True
         except twitter_utils.TwitterRateLimitError as err:
-            set_twitter_rate_limit_expires(self.redis_client, err.reset_epoch_seconds)
+            set_twitter_rate_limit_expires(self.redis_client, err.reset_epoch_seconds,
+                                           endpoint=err.endpoint or self.TWITTER_ENDPOINT)
+            return False
+
+
+    def seed_frontier(self):
+        """
+            Offer the users that haven't been crawled and were added since
+            the last call to the frontier as seeds. Users it already knows
+            keep their depth.
+        """
+        query = (models.User.select(peewee.SQL("rowid"), models.User.id, models.User.verified)
+                            .where(peewee.SQL("rowid > ?", [self._last_seed_rowid]) &
+                                   (models.User.scraped_following == False))
+                            .order_by(peewee.SQL("rowid"))
+                            .tuples())
+        queued = 0
+        for rows in peewee.chunked(query.iterator(), twitter_utils.MAX_USERS_PER_PAGE):
+            users = [twitter_utils.TwitterUser(id=user_id, verified=verified)
+                     for _, user_id, verified in rows]
+            queued += self.frontier.seed(users)
+            self._last_seed_rowid = rows[-1][0]
+
+        if queued:
+            LOGGER.info("Queued %d seed users to crawl.", queued)
 
 
     def _run_forever(self):
         while True:
-            self._run_single(wait_if_limited=True)
+            if not self._run_single(wait_if_limited=True):
+                time.sleep(self.IDLE_SLEEP)
 
 
-    def _run_single(self, wait_if_limited=False):
+    def _run_single(self, wait_if_limited=False) -> bool:
+        """
+            Crawl the user with the highest priority in the frontier.
+            Returns False if there was no one to crawl.
+        """
         self.wait_for_rate_limit(wait_if_limited)
-
-        to_scrape_following = list(models.User.select().where(models.User.scraped_following == False).limit(1))
-        if to_scrape_following:
-            #print("Will scrape: ", to_scrape_following[0].username)
-            self.scrape_user_following(to_scrape_following[0])
+        if get_twitter_rate_limt_expires(self.redis_client, self.TWITTER_ENDPOINT) > 0:
+            return True
+
+        claimed = self.frontier.claim()
+        if claimed is None:
+            self.seed_frontier()
+            claimed = self.frontier.claim()
+            if claimed is None:
+                return False
+
+        user_id, depth = claimed
+        user = models.User.get_or_none(models.User.id == user_id)
+        if user is None or user.scraped_following:
+            self.frontier.complete(user_id)
+            return True
+
+        LOGGER.info("Crawling users followed by %s (depth %d).", user.username, depth)
+        if self.scrape_user_following(user, depth):
+            self.frontier.complete(user_id)
+        else:
+            self.frontier.release(user_id)
+        return True
 
 
     def run(self, single=True, wait=False):
@@ -133,6 +200,12 @@ def main():
                         action="store_true",
                         default=False,
                         help="Wait for sleep if rate limited. Always true when running as daemon")
+    parser.add_argument("--max-depth", type=int, default=None,
+                        help="Don't crawl users more than this many follows away from "
+                             "a seed user.")
+    parser.add_argument("--priority", type=parse_priority_weights, default=None,
+                        help="Weights of the frontier priority, e.g. %s." %
+                             ",".join("%s=%s" % w for w in DEFAULT_PRIORITY_WEIGHTS.items()))
 
     args = parser.parse_args()
 
@@ -148,11 +221,13 @@ def main():
     redis_client = redis.Redis(REDIS_SERVER_HOST,
                                REDIS_SERVER_PORT,
                                REDIS_SERVER_DB)
+    track_twitter_rate_limits(redis_client)
 
     LOGGER.debug("Using database file: %s", DB_FILE)
     database = models.init_db(DB_FILE)
 
-    app = DiscoverUsers(redis_client, database)
+    app = DiscoverUsers(redis_client, database, max_depth=args.max_depth,
+                        priority_weights=args.priority)
     app.run(single=not args.as_daemon, wait=args.wait)
 
 if __name__ == "__main__":
@@ -1,42 +1,302 @@
-from collections import defaultdict
+import base64
+from collections import OrderedDict, defaultdict
+from functools import wraps
+import hashlib
 import os
+import threading
 from flask import (
     Flask,
-    jsonify,
+    abort,
+    json,
     request,
-    render_template
+    render_template,
+    stream_with_context
 )
+import redis
 
-from ec601_proj2 import models
-from playhouse.shortcuts import model_to_dict
+from ec601_proj2 import metrics, models
+from ec601_proj2.search_index import SearchIndex
+from ec601_proj2.topic_index import TopicIndex
+from ec601_proj2.workers import Queues, TOPICS_GENERATION_KEY
 
 DB_FILE  = os.getenv("SQLITE_DATABASE")
 models.init_db(DB_FILE)
 
+REDIS_CLIENT = redis.Redis(os.getenv("REDIS_SERVER_HOST", "localhost"),
+                           int(os.getenv("REDIS_SERVER_PORT", "6379")),
+                           int(os.getenv("REDIS_SERVER_DB", "0")))
+
+TOPIC_INDEX = TopicIndex(REDIS_CLIENT)
+SEARCH_INDEX = SearchIndex()
+
 API = Flask(__name__, static_url_path="/static", static_folder="static/")
 
+# Total size of the response bodies kept by RESPONSE_CACHE.
+RESPONSE_CACHE_BYTES = int(os.getenv("RESPONSE_CACHE_BYTES", str(32 * 1024 * 1024)))
+
+
+class ResponseCache:
+    """
+        LRU of rendered responses, bounded by the total size of their
+        bodies rather than their number, since one unfiltered
+        /api/user-topics response can be larger than hundreds of
+        filtered ones. Bodies larger than the whole cache aren't kept.
+        Safe to share between request threads.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._responses = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self._responses)
+
+
+    def get(self, key):
+        """The (generation, body, etag) cached for key, or None."""
+        with self._lock:
+            cached = self._responses.get(key)
+            if cached is not None:
+                self._responses.move_to_end(key)
+            return cached
+
+
+    def put(self, key, generation: int, body: bytes, etag: str):
+        with self._lock:
+            old = self._responses.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            if len(body) > self.max_bytes:
+                return
+
+            self._responses[key] = (generation, body, etag)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (_, evicted, _) = self._responses.popitem(last=False)
+                self.size -= len(evicted)
+
+
+# Rendered topic responses by path and query string, with the topics
+# generation they were rendered at.
+RESPONSE_CACHE = ResponseCache(RESPONSE_CACHE_BYTES)
+
+def topics_generation() -> int:
+    return int(REDIS_CLIENT.get(TOPICS_GENERATION_KEY) or 0)
+
+
+def cached_json(view):
+    """
+        Cache the JSON rendered from the dict view returns until the
+        DatabaseWorker writes topics again. Responses carry an ETag so
+        clients that send If-None-Match get a 304 instead of the body.
+    """
+    @wraps(view)
+    def wrapper():
+        # Read the generation first. If topics are written while the view
+        # runs, the response is cached as stale and rendered again.
+        generation = topics_generation()
+        key = (request.path, tuple(sorted(request.args.items(multi=True))))
+        cached = RESPONSE_CACHE.get(key)
+        if cached is None or cached[0] != generation:
+            body = json.dumps(view()).encode()
+            etag = hashlib.sha1(body).hexdigest()
+            RESPONSE_CACHE.put(key, generation, body, etag)
+        else:
+            _, body, etag = cached
+
+        response = API.response_class(body, mimetype="application/json")
+        response.set_etag(etag)
+        # Let browsers keep it, but check the ETag on every use.
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+    return wrapper
+
+
 @API.get("/api/topics")
+@cached_json
 def get_topics():
-    topic_query = models.Topic.select()
-    return jsonify(topics=[model_to_dict(t) for t in topic_query])
+    query = models.Topic.select(models.Topic.id, models.Topic.name).dicts()
+    return dict(topics=list(query))
+
+
+# Page size of /api/user-topics when paging without a limit, and the
+# largest page it returns.
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+def encode_cursor(sort: str, row: dict) -> str:
+    """Opaque cursor for the page after row."""
+    key = [row["tweet_count"], row["user_topic_id"]] if sort == "tweet_count" \
+          else [row["user_topic_id"]]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(sort: str, cursor: str) -> list:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        abort(400, "Invalid cursor.")
+
+    if not isinstance(key, list) or len(key) != (2 if sort == "tweet_count" else 1):
+        abort(400, "Cursor doesn't match sort.")
+    return key
+
+
+def user_topics_query(topics: list, sort: str = None, cursor: str = None):
+    """
+        One joined query for the topic name, tweet count and user columns
+        of the user topics of topics, or all of them. Rows are ordered
+        by sort, "id" or "tweet_count" (highest first), and start after
+        cursor. Paging uses the sort key instead of an OFFSET, so every
+        page costs the same however deep it is.
+    """
+    user_topic = models.UserTopic
+    query = (user_topic.select(user_topic.id.alias("user_topic_id"),
+                               user_topic.tweet_count,
+                               models.Topic.name.alias("topic_name"),
+                               *models.User._meta.sorted_fields)
+                       .join(models.Topic)
+                       .switch(user_topic)
+                       .join(models.User)
+                       .dicts())
+    if topics:
+        query = query.where(models.Topic.name << topics)
+
+    if sort == "tweet_count":
+        query = query.order_by(user_topic.tweet_count.desc(), user_topic.id.desc())
+        if cursor:
+            tweet_count, user_topic_id = decode_cursor(sort, cursor)
+            query = query.where((user_topic.tweet_count < tweet_count) |
+                                ((user_topic.tweet_count == tweet_count) &
+                                 (user_topic.id < user_topic_id)))
+    elif sort == "id":
+        query = query.order_by(user_topic.id)
+        if cursor:
+            user_topic_id, = decode_cursor(sort, cursor)
+            query = query.where(user_topic.id > user_topic_id)
+
+    return query
+
+
+def limit_arg(default, maximum: int):
+    """The limit argument, or default if it isn't given."""
+    if "limit" not in request.args:
+        return default
+
+    try:
+        limit = int(request.args["limit"])
+    except ValueError:
+        limit = 0
+    if not 0 < limit <= maximum:
+        abort(400, "limit must be between 1 and %d." % maximum)
+    return limit
+
+
+def page_args():
+    """The sort, cursor and limit arguments, validated."""
+    sort = request.args.get("sort", "id")
+    if sort not in ("id", "tweet_count"):
+        abort(400, "sort must be id or tweet_count.")
+
+    return sort, request.args.get("cursor"), limit_arg(None, MAX_PAGE_SIZE)
 
 
 @API.get("/api/user-topics")
+@cached_json
 def get_user_topics():
+    """
+        Users of each topic, grouped by topic name. With a limit, cursor
+        or sort argument, one page of limit rows is returned along with
+        the next_cursor to pass for the following page (null on the last
+        one), and each user has the tweet_count of the topic.
+    """
     topics = request.args.getlist('topic')
-    topic_query = models.Topic.select()
-
-    if topics:
-        topic_query = models.Topic.select().where(models.Topic.name << topics)
+    paged = any(arg in request.args for arg in ("limit", "cursor", "sort"))
+    if not paged:
+        users_by_topic = defaultdict(list)
+        for row in user_topics_query(topics):
+            del row["user_topic_id"], row["tweet_count"]
+            users_by_topic[row.pop("topic_name")].append(row)
+        return dict(data=users_by_topic)
 
-    query = (models.UserTopic.select()
-                             .where(models.UserTopic.topic << topic_query))
+    sort, cursor, limit = page_args()
+    limit = limit or DEFAULT_PAGE_SIZE
+    rows = list(user_topics_query(topics, sort, cursor).limit(limit))
 
+    next_cursor = encode_cursor(sort, rows[-1]) if len(rows) == limit else None
     users_by_topic = defaultdict(list)
-    for ut in query:
-        users_by_topic[ut.topic.name].append(model_to_dict(ut.user))
+    for row in rows:
+        del row["user_topic_id"]
+        users_by_topic[row.pop("topic_name")].append(row)
+    return dict(data=users_by_topic, next_cursor=next_cursor)
+
+
+@API.get("/api/user-topics.ndjson")
+def stream_user_topics():
+    """
+        Every user topic as newline delimited JSON, one row per line
+        with the topic name, tweet count and user. Takes the same
+        arguments as /api/user-topics, but limit is optional. Rows are
+        streamed from the database cursor as they are read, so memory
+        use doesn't grow with the result. Each row has the cursor to
+        resume after it.
+    """
+    topics = request.args.getlist('topic')
+    sort, cursor, limit = page_args()
+    query = user_topics_query(topics, sort, cursor)
+    if limit:
+        query = query.limit(limit)
+
+    def generate():
+        for row in query.iterator():
+            row["cursor"] = encode_cursor(sort, row)
+            del row["user_topic_id"]
+            row["topic"] = row.pop("topic_name")
+            yield json.dumps(row) + "\n"
+
+    return API.response_class(stream_with_context(generate()),
+                              mimetype="application/x-ndjson")
+
+
+@API.get("/api/top-users")
+@cached_json
+def get_top_users():
+    """
+        The limit (default 10) users with the most tweets in each topic,
+        grouped by topic name. Served from the redis topic index, so it
+        doesn't read the database.
+    """
+    topics = request.args.getlist('topic')
+    if not topics:
+        abort(400, "topic is required.")
+
+    limit = limit_arg(10, MAX_PAGE_SIZE)
+    return dict(data=TOPIC_INDEX.top_users(topics, limit))
+
+
+@API.get("/api/search")
+def search():
+    """
+        Topics and users whose names start with prefix, case insensitive,
+        for suggestions as the user types. Up to limit (default 10) of
+        each are returned.
+    """
+    prefix = request.args.get("prefix", "")
+    if not prefix.strip():
+        abort(400, "prefix is required.")
+
+    limit = limit_arg(10, 100)
+    SEARCH_INDEX.refresh(topics_generation())
+    return SEARCH_INDEX.search(prefix.strip(), limit)
 
-    return jsonify(data=users_by_topic)
+@API.get("/metrics")
+def get_metrics():
+    """Pipeline metrics and queue depths for Prometheus to scrape."""
+    return API.response_class(metrics.render_prometheus(REDIS_CLIENT, Queues.all()),
+                              content_type="text/plain; version=0.0.4; charset=utf-8")
 
 @API.route("/")
 def index_rout():
@@ -1,35 +1,50 @@
 (function () {
-    let data = { topics: [] };
+    // Suggestions from the last search, users keyed by "@username".
+    let data = { topics: [], users: {} };
+    let pendingSearch = null;
 
-    async function loadDocument() {
-        let response = await window.fetch("/api/topics");
-        if (response.status != 200) {
-            console.error("Error loading topics.");
-            return;
-        }
-
-        let topics = (await response.json())['topics'];
-        data.topics = topics.map((t) => t.name);
+    function loadDocument() {
+        // The server already matched the suggestions, so show them all.
         $(".topics-search").typeahead({
-            source: data.topics
+            source: [],
+            items: 20,
+            matcher: () => true
         })
     }
 
-    async function search_for_users(topic) {
-        let query = "?topic=" + encodeURIComponent(topic)
-        let response = await window.fetch("/api/user-topics" + query);
+    async function suggest(prefix) {
+        let query = "?prefix=" + encodeURIComponent(prefix);
+        let response = await window.fetch("/api/search" + query);
         if (response.status != 200) {
-            console.error("Error querying for topic.");
+            console.error("Error searching.");
             return;
         }
 
-        let user_topics = (await response.json())['data'];
+        let results = await response.json();
+        let input = $(".topics-search");
+        if (input.val().trim() != prefix) {
+            // The user kept typing, so these are out of date.
+            return;
+        }
+
+        data.topics = results.topics;
+        data.users = {};
+        for (let user of results.users) {
+            data.users["@" + user.username] = user;
+        }
+
+        let typeahead = input.data("typeahead");
+        typeahead.source = data.topics.concat(Object.keys(data.users));
+        typeahead.lookup();
+    }
+
+    function show_users(users) {
         let results = document.querySelector(".results");
-        for (let child of results.childNodes) {
-            results.removeChild(child);
+        while (results.firstChild) {
+            results.removeChild(results.firstChild);
         }
 
-        for (let user of user_topics[topic]) {
+        for (let user of users) {
             let div = document.createElement("div");
             div.classList.add("result");
             div.innerHTML = `
@@ -44,11 +59,30 @@
         }
     }
 
+    async function search_for_users(topic) {
+        let query = "?topic=" + encodeURIComponent(topic)
+        let response = await window.fetch("/api/user-topics" + query);
+        if (response.status != 200) {
+            console.error("Error querying for topic.");
+            return;
+        }
+
+        let user_topics = (await response.json())['data'];
+        show_users(user_topics[topic] || []);
+    }
+
     document.addEventListener("DOMContentLoaded", loadDocument);
-    $(document).on('input', '.topics-search', function (evt) {
+    // Selecting a suggestion fires change rather than input.
+    $(document).on('input change', '.topics-search', function (evt) {
         let val = evt.target.value.trim()
+        clearTimeout(pendingSearch);
         if (data.topics.indexOf(val) > -1) {
             search_for_users(val);
+        } else if (val in data.users) {
+            show_users([data.users[val]]);
+        } else if (val && evt.type == "input") {
+            // Wait for a pause in typing before searching.
+            pendingSearch = setTimeout(() => suggest(val), 100);
         }
     });
 })();
@@ -0,0 +1,234 @@
+"""
+    Prioritized frontier of users whose following lists should be
+    crawled, shared through redis so several discovery processes can
+    work through it together.
+"""
+import os
+
+import redis
+
+from . import twitter_utils
+
+FRONTIER_KEY = "discovery:frontier"
+
+# Sorted set of claimed user id to the time its lease expires, and hash
+# of claimed user id to its priority, to requeue it with.
+FRONTIER_CLAIMED_KEY = "discovery:claimed"
+FRONTIER_CLAIMED_SCORES_KEY = "discovery:claimed_scores"
+
+# Hashes of user id to the fewest follows between a seed and the user,
+# and to how many crawled users follow them.
+FRONTIER_DEPTH_KEY = "discovery:depth"
+FRONTIER_SEEN_KEY = "discovery:seen"
+
+# Set of user ids whose following list has been crawled.
+FRONTIER_DONE_KEY = "discovery:done"
+
+KEYS = [FRONTIER_KEY, FRONTIER_CLAIMED_KEY, FRONTIER_CLAIMED_SCORES_KEY,
+        FRONTIER_DEPTH_KEY, FRONTIER_SEEN_KEY, FRONTIER_DONE_KEY]
+
+# Seconds a claim lasts without being renewed before another process
+# may take the user.
+DISCOVERY_LEASE_SECONDS = float(os.getenv("DISCOVERY_LEASE_SECONDS", "300"))
+
+# A user's priority is the sum of each weight times the user's value:
+# 1 if verified, their depth, and the number of times they were seen.
+DEFAULT_PRIORITY_WEIGHTS = dict(verified=10, depth=-5, seen=1)
+
+# ARGV is the verified, depth and seen weights, the depth limit (-1 for
+# none), 1 when seeding, then an id, verified flag and depth per user.
+# Seeds only have their depth recorded if it isn't known already and
+# don't count as being seen. Users beyond the depth limit have their
+# depth recorded but aren't queued. Claimed users keep their claim,
+# with their priority updated. Returns the number of users that weren't
+# queued before.
+_FRONTIER_ADD = """
+local verified_weight = tonumber(ARGV[1])
+local depth_weight = tonumber(ARGV[2])
+local seen_weight = tonumber(ARGV[3])
+local max_depth = tonumber(ARGV[4])
+local seed = ARGV[5] == '1'
+local queued = 0
+
+for i = 6, #ARGV, 3 do
+    local id = ARGV[i]
+    local depth = tonumber(ARGV[i + 2])
+    local known = tonumber(redis.call('HGET', KEYS[4], id))
+    if redis.call('SISMEMBER', KEYS[6], id) == 0 and not (seed and known) then
+        if known and known < depth then
+            depth = known
+        end
+        redis.call('HSET', KEYS[4], id, depth)
+
+        local seen
+        if seed then
+            seen = tonumber(redis.call('HGET', KEYS[5], id)) or 0
+        else
+            seen = redis.call('HINCRBY', KEYS[5], id, 1)
+        end
+
+        if max_depth < 0 or depth <= max_depth then
+            local score = verified_weight * tonumber(ARGV[i + 1]) +
+                          depth_weight * depth + seen_weight * seen
+            if redis.call('ZSCORE', KEYS[2], id) then
+                redis.call('HSET', KEYS[3], id, score)
+            else
+                -- Users already queued only have their priority updated.
+                queued = queued + redis.call('ZADD', KEYS[1], score, id)
+            end
+        end
+    end
+end
+return queued
+"""
+
+# Requeue the users whose lease ran out, then claim the user with the
+# highest priority for ARGV[1] seconds. Returns the id and depth, or nil.
+_FRONTIER_CLAIM = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)) do
+    redis.call('ZADD', KEYS[1], redis.call('HGET', KEYS[3], id) or 0, id)
+    redis.call('ZREM', KEYS[2], id)
+    redis.call('HDEL', KEYS[3], id)
+end
+
+local top = redis.call('ZPOPMAX', KEYS[1])
+if #top == 0 then
+    return nil
+end
+
+local id = top[1]
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[1]), id)
+redis.call('HSET', KEYS[3], id, top[2])
+return {id, redis.call('HGET', KEYS[4], id) or '0'}
+"""
+
+# Extend the lease on ARGV[1] by ARGV[2] seconds if it is still held.
+_FRONTIER_RENEW = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+return redis.call('ZADD', KEYS[2], 'XX', 'CH', now + tonumber(ARGV[2]), ARGV[1])
+"""
+
+# Put the claimed user ARGV[1] back in the frontier.
+_FRONTIER_RELEASE = """
+local score = redis.call('HGET', KEYS[3], ARGV[1])
+if redis.call('ZREM', KEYS[2], ARGV[1]) == 1 then
+    redis.call('ZADD', KEYS[1], score or 0, ARGV[1])
+end
+redis.call('HDEL', KEYS[3], ARGV[1])
+"""
+
+
+def parse_priority_weights(spec: str) -> dict:
+    """
+        Parse a priority spec like "verified=10,depth=-5,seen=1" into a
+        dict of weights. Weights that aren't given are 0.
+    """
+    weights = dict.fromkeys(DEFAULT_PRIORITY_WEIGHTS, 0.0)
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in weights:
+            raise ValueError("Unknown priority: %s. Must be one of: %s" %
+                             (name, ", ".join(weights)))
+        try:
+            weights[name] = float(weight)
+        except ValueError as err:
+            raise ValueError("Invalid weight for %s: %s" % (name, weight)) from err
+
+    return weights
+
+
+class Frontier:
+    """
+        Users waiting to have their following lists crawled, highest
+        priority first. Claims are atomic, so any number of processes
+        can share a frontier. A claim is a lease: if the process holding
+        it doesn't complete, release or renew it within lease seconds,
+        the user goes back in the frontier.
+
+        Followed users are one deeper than the user that follows them.
+        Users deeper than max_depth are recorded but never crawled.
+    """
+
+    def __init__(self, redis_client: redis.Redis, weights: dict = None,
+                 max_depth: int = None, lease: float = None):
+        self._client = redis_client
+        self.weights = dict(DEFAULT_PRIORITY_WEIGHTS, **(weights or {}))
+        self.max_depth = max_depth
+        self.lease = DISCOVERY_LEASE_SECONDS if lease is None else lease
+        self._add = redis_client.register_script(_FRONTIER_ADD)
+        self._claim = redis_client.register_script(_FRONTIER_CLAIM)
+        self._renew = redis_client.register_script(_FRONTIER_RENEW)
+        self._release = redis_client.register_script(_FRONTIER_RELEASE)
+
+
+    def _add_users(self, users: list[twitter_utils.TwitterUser], depth: int, seed: bool) -> int:
+        if not users:
+            return 0
+
+        args = [self.weights["verified"], self.weights["depth"], self.weights["seen"],
+                -1 if self.max_depth is None else self.max_depth, 1 if seed else 0]
+        for user in users:
+            args.extend((user.id, 1 if user.verified else 0, depth))
+        return self._add(keys=KEYS, args=args)
+
+
+    def add(self, users: list[twitter_utils.TwitterUser], depth: int) -> int:
+        """
+            Record that users were seen at depth and queue the ones that
+            haven't been crawled. Returns the number newly queued.
+        """
+        return self._add_users(users, depth, seed=False)
+
+
+    def seed(self, users: list[twitter_utils.TwitterUser]) -> int:
+        """
+            Queue users as seeds at depth 0, unless the frontier already
+            knows them. Returns the number newly queued.
+        """
+        return self._add_users(users, 0, seed=True)
+
+
+    def claim(self) -> tuple[str, int]:
+        """
+            Take the user with the highest priority. Returns their id and
+            depth, or None if the frontier is empty.
+        """
+        claimed = self._claim(keys=KEYS, args=[self.lease])
+        if claimed is None:
+            return None
+        user_id, depth = claimed
+        return user_id.decode(), int(depth)
+
+
+    def renew(self, user_id: str) -> bool:
+        """Extend the lease on a claim. False if it was lost."""
+        return bool(self._renew(keys=KEYS, args=[user_id, self.lease]))
+
+
+    def release(self, user_id: str):
+        """Give up a claim so the user can be crawled later."""
+        self._release(keys=KEYS, args=[user_id])
+
+
+    def complete(self, user_id: str):
+        """Mark a claimed user as crawled."""
+        pipe = self._client.pipeline()
+        pipe.zrem(FRONTIER_CLAIMED_KEY, user_id)
+        pipe.hdel(FRONTIER_CLAIMED_SCORES_KEY, user_id)
+        pipe.zrem(FRONTIER_KEY, user_id)
+        pipe.sadd(FRONTIER_DONE_KEY, user_id)
+        pipe.execute()
+
+
+    def stats(self) -> dict:
+        pipe = self._client.pipeline(transaction=False)
+        pipe.zcard(FRONTIER_KEY)
+        pipe.zcard(FRONTIER_CLAIMED_KEY)
+        pipe.scard(FRONTIER_DONE_KEY)
+        queued, claimed, done = pipe.execute()
+        return dict(queued=queued, claimed=claimed, done=done)
@@ -2,8 +2,11 @@
     Utilities to wrap the google cloud API for the actions
     performed in this repository.
 """
+from bisect import bisect_right
 import enum
 from functools import wraps
+import os
+from typing import Protocol
 
 #pylint: disable=unused-import
 from google.api_core.exceptions import InvalidArgument, ResourceExhausted
@@ -11,6 +14,8 @@ from google.api_core.exceptions import InvalidArgument, ResourceExhausted
 #pylint: disable=unused-import
 from google.cloud.language_v1.types.language_service import (
     Entity,
+    EntityMention,
+    EncodingType,
     ClassificationCategory
 )
 from google.cloud import language_v1
@@ -19,25 +24,33 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-def format_request(text, language="en"):
+def format_request(text, language="en", encoding_type=None, features=None):
     """
         Helper function to format a request object to make a
-        Google NLP query.
+        Google NLP query. encoding_type is only accepted by the
+        APIs that return text offsets, and features only by
+        annotate_text.
     """
     document = language_v1.Document(content=text,
                                     type_=language_v1.Document.Type.PLAIN_TEXT,
                                     language=language)
-    return dict(document=document)
+    request = dict(document=document)
+    if encoding_type is not None:
+        request["encoding_type"] = encoding_type
+    if features is not None:
+        request["features"] = features
+    return request
 
 
 def text_api(func):
     @wraps(func)
-    def inner(self, text, *args, **kwargs):
-        return func(self, format_request(text), *args, **kwargs)
+    def inner(self, text, *args, encoding_type=None, features=None, **kwargs):
+        request = format_request(text, encoding_type=encoding_type, features=features)
+        return func(self, request, *args, **kwargs)
     return inner
 
 
-def textapis(apis_to_wrap):
+def textapis(apis_to_wrap, client_class=language_v1.LanguageServiceClient):
     """
         I'm restricting my use cases to plain-text english documents, this class
         decorator is used to wrap all the client APIs so I can pass in a string of
@@ -45,23 +58,193 @@ def textapis(apis_to_wrap):
     """
     def wrapper(cls):
         for func in apis_to_wrap:
-            wrapped = text_api(getattr(language_v1.LanguageServiceClient, func))
+            wrapped = text_api(getattr(client_class, func))
             setattr(cls, func, wrapped)
         return cls
     return wrapper
 
 
+class NLPBackend(Protocol):
+    """
+        The text APIs the pipeline calls. Implemented by the Google
+        client and by local_nlp.LocalLanguageClient. Every method takes
+        a string of plain english text and returns the language_v1
+        response message for that API.
+    """
+
+    def analyze_entities(self, text: str, encoding_type=None):
+        ...
+
+    def classify_text(self, text: str):
+        ...
+
+    def analyze_sentiment(self, text: str, encoding_type=None):
+        ...
+
+    def annotate_text(self, text: str, features=None, encoding_type=None):
+        ...
+
+
 @textapis([
     "analyze_sentiment",
     "analyze_entity_sentiment",
     "analyze_entities",
+    "annotate_text",
     "classify_text"
 ])
 class EnglishTextLanguageClientService(language_v1.LanguageServiceClient):
     pass
 
 
-LanguageClient = EnglishTextLanguageClientService()
+# Response message returned by each API, used to serialize cached responses.
+RESPONSE_TYPES = {
+    "analyze_sentiment": language_v1.AnalyzeSentimentResponse,
+    "analyze_entity_sentiment": language_v1.AnalyzeEntitySentimentResponse,
+    "analyze_entities": language_v1.AnalyzeEntitiesResponse,
+    "annotate_text": language_v1.AnnotateTextResponse,
+    "classify_text": language_v1.ClassifyTextResponse,
+}
+
+
+@textapis([
+    "analyze_sentiment",
+    "analyze_entity_sentiment",
+    "analyze_entities",
+    "annotate_text",
+    "classify_text"
+], language_v1.LanguageServiceAsyncClient)
+class EnglishTextLanguageAsyncClientService(language_v1.LanguageServiceAsyncClient):
+    """
+        asyncio version of the client. The wrapped APIs return coroutines.
+        Create it from inside the event loop that will await them.
+    """
+
+
+def _google_backend():
+    return EnglishTextLanguageClientService, EnglishTextLanguageAsyncClientService
+
+
+def _local_backend():
+    #pylint: disable=import-outside-toplevel
+    from .local_nlp import LocalLanguageClient, LocalLanguageAsyncClient
+    return LocalLanguageClient, LocalLanguageAsyncClient
+
+
+# Backend name -> function returning its client and asyncio client classes.
+NLP_BACKENDS = {
+    "google": _google_backend,
+    "local": _local_backend,
+}
+
+def _backend_classes(backend: str = None):
+    backend = backend or os.getenv("NLP_BACKEND", "google")
+    try:
+        return NLP_BACKENDS[backend]()
+    except KeyError:
+        raise ValueError("Unknown NLP backend %r" % backend) from None
+
+
+def create_client(backend: str = None) -> NLPBackend:
+    """
+        Create a client for backend, which defaults to the NLP_BACKEND
+        environment variable, or google.
+    """
+    client_class, _ = _backend_classes(backend)
+    return client_class()
+
+
+def create_async_client(backend: str = None):
+    """
+        Create an asyncio client for backend. Call it from inside the
+        event loop that will await it.
+    """
+    _, client_class = _backend_classes(backend)
+    return client_class()
+
+
+_language_client = None
+
+def __getattr__(name):
+    # LanguageClient is created on first use, so importing this module
+    # doesn't need credentials when the local backend is used.
+    global _language_client #pylint: disable=global-statement
+    if name == "LanguageClient":
+        if _language_client is None:
+            _language_client = create_client()
+        return _language_client
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+# classify_text rejects documents with fewer tokens than this.
+CLASSIFY_MIN_TOKENS = 20
+
+# Put between texts packed into one document. A blank line keeps
+# sentences from running together across texts.
+DOCUMENT_SEPARATOR = "\n\n"
+
+def pack_texts(texts: list[str], max_chars: int, separator: str = DOCUMENT_SEPARATOR):
+    """
+        Group consecutive texts into documents of at most max_chars
+        characters, including separators. Yields (start, end) index
+        ranges into texts. A text longer than max_chars gets a document
+        to itself.
+    """
+    start = 0
+    size = 0
+    for i, text in enumerate(texts):
+        added = len(text) if i == start else len(separator) + len(text)
+        if i > start and size + added > max_chars:
+            yield start, i
+            start = i
+            added = len(text)
+            size = 0
+        size += added
+
+    if start < len(texts):
+        yield start, len(texts)
+
+
+def join_texts(texts: list[str], separator: str = DOCUMENT_SEPARATOR):
+    """
+        Join texts into one document. Returns the document and the
+        offset at which each text starts.
+    """
+    offsets = []
+    position = 0
+    for text in texts:
+        offsets.append(position)
+        position += len(text) + len(separator)
+    return separator.join(texts), offsets
+
+
+def split_entities(entities, offsets: list[int]) -> list[list[Entity]]:
+    """
+        Map the entities found in a document built by join_texts back to
+        the texts it was built from, using the offset of each mention.
+        The request must use EncodingType.UTF32 so offsets count code
+        points like python strings. An entity mentioned in several texts
+        is returned for each of them with only the mentions in that
+        text, rebased to the start of the text.
+    """
+    split = [[] for _ in offsets]
+    for entity in entities:
+        mentions = {}
+        for mention in entity.mentions:
+            index = bisect_right(offsets, mention.text.begin_offset) - 1
+            if index < 0:
+                continue
+            begin = mention.text.begin_offset - offsets[index]
+            mentions.setdefault(index, []).append(EntityMention(
+                text=dict(content=mention.text.content, begin_offset=begin),
+                type_=mention.type_))
+
+        for index, text_mentions in mentions.items():
+            split[index].append(Entity(name=entity.name,
+                                       type_=entity.type_,
+                                       metadata=entity.metadata,
+                                       mentions=text_mentions))
+    return split
+
 
 class SentimentCategory(enum.IntEnum):
     """
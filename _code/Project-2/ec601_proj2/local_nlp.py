@@ -0,0 +1,307 @@
+"""
+    A fast, deterministic stand-in for Google's NLP APIs. Entities come
+    from a few rules and a small dictionary, categories and sentiment
+    from keyword lists. Responses use the same language_v1 types as the
+    Google client, so the pipeline can be run without credentials or
+    quota for load testing and staging.
+
+    Select it by setting NLP_BACKEND=local.
+"""
+import re
+
+from google.api_core.exceptions import InvalidArgument
+from google.cloud import language_v1
+
+from .google_nlp import CLASSIFY_MIN_TOKENS
+
+EntityType = language_v1.Entity.Type
+MentionType = language_v1.EntityMention.Type
+Tag = language_v1.PartOfSpeech.Tag
+
+# Lower cased name -> entity type, for names the rules can't type.
+KNOWN_ENTITIES = {
+    "amazon": EntityType.ORGANIZATION,
+    "apple": EntityType.ORGANIZATION,
+    "facebook": EntityType.ORGANIZATION,
+    "google": EntityType.ORGANIZATION,
+    "microsoft": EntityType.ORGANIZATION,
+    "nasa": EntityType.ORGANIZATION,
+    "netflix": EntityType.ORGANIZATION,
+    "spacex": EntityType.ORGANIZATION,
+    "tesla": EntityType.ORGANIZATION,
+    "twitter": EntityType.ORGANIZATION,
+    "boston": EntityType.LOCATION,
+    "california": EntityType.LOCATION,
+    "china": EntityType.LOCATION,
+    "europe": EntityType.LOCATION,
+    "london": EntityType.LOCATION,
+    "new york": EntityType.LOCATION,
+    "paris": EntityType.LOCATION,
+    "united states": EntityType.LOCATION,
+    "biden": EntityType.PERSON,
+    "elon musk": EntityType.PERSON,
+    "obama": EntityType.PERSON,
+    "trump": EntityType.PERSON,
+    "christmas": EntityType.EVENT,
+    "olympics": EntityType.EVENT,
+    "super bowl": EntityType.EVENT,
+    "world cup": EntityType.EVENT,
+    "iphone": EntityType.CONSUMER_GOOD,
+}
+
+# Capitalized words that start sentences rather than names.
+STOPWORDS = {
+    "a", "after", "all", "also", "an", "and", "are", "as", "at", "be", "but",
+    "by", "can", "did", "do", "for", "from", "had", "has", "have", "he", "her",
+    "here", "his", "how", "i", "if", "in", "is", "it", "its", "just", "me",
+    "my", "no", "not", "now", "of", "on", "or", "our", "rt", "she", "so",
+    "some", "that", "the", "their", "then", "there", "these", "they", "this",
+    "those", "to", "today", "up", "us", "was", "we", "what", "when", "where",
+    "who", "why", "will", "with", "yes", "you", "your",
+}
+
+CATEGORY_KEYWORDS = {
+    "/Arts & Entertainment": {"movie", "movies", "film", "show", "music", "song",
+                              "album", "concert", "tv", "netflix", "art"},
+    "/Business & Industrial": {"business", "company", "ceo", "startup", "industry",
+                               "market", "marketing", "sales"},
+    "/Computers & Electronics": {"computer", "software", "code", "programming", "app",
+                                 "iphone", "laptop", "ai", "data", "tech", "cloud"},
+    "/Finance": {"stock", "stocks", "bank", "money", "crypto", "bitcoin", "invest",
+                 "investing", "economy", "price", "prices"},
+    "/Food & Drink": {"food", "pizza", "coffee", "dinner", "lunch", "recipe",
+                      "restaurant", "beer", "wine", "cooking"},
+    "/Games": {"game", "games", "gaming", "xbox", "playstation", "nintendo"},
+    "/Health": {"health", "covid", "vaccine", "doctor", "hospital", "fitness",
+                "workout", "diet"},
+    "/News/Politics": {"election", "vote", "president", "senate", "congress",
+                       "policy", "government", "biden", "trump", "obama"},
+    "/Science": {"science", "research", "space", "nasa", "climate", "physics",
+                 "biology", "study", "rocket"},
+    "/Sports": {"game", "team", "season", "win", "score", "football", "soccer",
+                "basketball", "baseball", "hockey", "olympics", "coach"},
+    "/Travel": {"travel", "flight", "trip", "hotel", "vacation", "beach",
+                "airport", "paris", "london"},
+}
+
+POSITIVE_WORDS = {"amazing", "awesome", "best", "excited", "fantastic", "good",
+                  "great", "happy", "love", "loved", "nice", "perfect", "thanks",
+                  "win", "wonderful"}
+
+NEGATIVE_WORDS = {"angry", "awful", "bad", "hate", "horrible", "lose", "lost",
+                  "sad", "terrible", "worse", "worst", "wrong"}
+
+_ENTITY_PATTERN = re.compile(
+    r"(?P<handle>@\w+)"
+    r"|(?P<hashtag>#\w+)"
+    r"|(?P<number>\b\d+(?:[.,]\d+)*\b)"
+    r"|(?P<name>\b[A-Z][\w'&-]*(?:[ \t]+[A-Z][\w'&-]*)*)"
+)
+
+_TOKEN_PATTERN = re.compile(r"[@#]?\w+(?:'\w+)?|[^\w\s]")
+
+_SENTENCE_PATTERN = re.compile(r"[^.!?\n]+[.!?]*")
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+_NAME_WORD_PATTERN = re.compile(r"\S+")
+
+
+def _offset(text: str, index: int, encoding_type) -> int:
+    """Convert a python string index to an offset in encoding_type."""
+    encoding_type = language_v1.EncodingType(encoding_type or 0)
+    if encoding_type == language_v1.EncodingType.UTF32:
+        return index
+    if encoding_type == language_v1.EncodingType.UTF16:
+        return len(text[:index].encode("utf-16-le")) // 2
+    if encoding_type == language_v1.EncodingType.UTF8:
+        return len(text[:index].encode("utf-8"))
+    return -1
+
+
+def _span(text: str, start: int, content: str, encoding_type):
+    return language_v1.TextSpan(content=content,
+                                begin_offset=_offset(text, start, encoding_type))
+
+
+def _sentences(text: str):
+    """Yield (start, sentence) for each sentence in text."""
+    for match in _SENTENCE_PATTERN.finditer(text):
+        sentence = match.group().strip()
+        if sentence:
+            yield match.start() + match.group().index(sentence[0]), sentence
+
+
+def _sentiment(text: str) -> language_v1.Sentiment:
+    words = [w.lower() for w in _WORD_PATTERN.findall(text)]
+    positive = sum(w in POSITIVE_WORDS for w in words)
+    negative = sum(w in NEGATIVE_WORDS for w in words)
+    if not positive + negative:
+        return language_v1.Sentiment(score=0, magnitude=0)
+    return language_v1.Sentiment(score=(positive - negative) / (positive + negative),
+                                 magnitude=0.5 * (positive + negative))
+
+
+def _find_entities(text: str):
+    """
+        Yield (start, content, name, entity type, mention type) for each
+        entity mention in text.
+    """
+    for match in _ENTITY_PATTERN.finditer(text):
+        kind = match.lastgroup
+        start = match.start()
+        content = match.group()
+        if kind == "handle":
+            entity_type = KNOWN_ENTITIES.get(content[1:].lower(), EntityType.PERSON)
+            yield start, content, content[1:], entity_type, MentionType.PROPER
+        elif kind == "hashtag":
+            entity_type = KNOWN_ENTITIES.get(content[1:].lower(), EntityType.OTHER)
+            yield start, content, content[1:], entity_type, MentionType.PROPER
+        elif kind == "number":
+            yield start, content, content, EntityType.NUMBER, MentionType.TYPE_UNKNOWN
+        else:
+            # Drop leading words that are only capitalized because they
+            # start a sentence.
+            words = list(_NAME_WORD_PATTERN.finditer(content))
+            while words and words[0].group().lower() in STOPWORDS:
+                words.pop(0)
+            if not words:
+                continue
+            name = content[words[0].start():]
+            entity_type = KNOWN_ENTITIES.get(name.lower(), EntityType.OTHER)
+            yield start + words[0].start(), name, name, entity_type, MentionType.PROPER
+
+
+class LocalLanguageClient:
+    """
+        Offline implementation of google_nlp.NLPBackend. The same text
+        always gets the same response.
+    """
+
+    def analyze_entities(self, text: str, encoding_type=None, **_):
+        # Build plain dicts and convert them to messages in one go, which
+        # is much cheaper than appending to proto-plus fields.
+        mentions = {}
+        for start, content, name, entity_type, mention_type in _find_entities(text):
+            mentions.setdefault((name, entity_type), []).append(dict(
+                text=dict(content=content,
+                          begin_offset=_offset(text, start, encoding_type)),
+                type_=mention_type))
+
+        total = sum(len(m) for m in mentions.values())
+        entities = [dict(name=name, type_=entity_type, mentions=entity_mentions,
+                         salience=len(entity_mentions) / total)
+                    for (name, entity_type), entity_mentions in mentions.items()]
+        entities.sort(key=lambda e: -e["salience"])
+        return language_v1.AnalyzeEntitiesResponse(entities=entities, language="en")
+
+
+    def analyze_entity_sentiment(self, text: str, encoding_type=None, **_):
+        response = self.analyze_entities(text, encoding_type=language_v1.EncodingType.UTF32)
+        sentences = list(_sentences(text))
+        entities = []
+        for entity in response.entities:
+            # Each entity gets the sentiment of the sentences it's in.
+            mentioned = {s for start, s in sentences for m in entity.mentions
+                         if start <= m.text.begin_offset < start + len(s)}
+            entity.sentiment = _sentiment(" ".join(sorted(mentioned)))
+            for mention in entity.mentions:
+                mention.text.begin_offset = _offset(text, mention.text.begin_offset,
+                                                    encoding_type)
+            entities.append(entity)
+        return language_v1.AnalyzeEntitySentimentResponse(entities=entities, language="en")
+
+
+    def analyze_sentiment(self, text: str, encoding_type=None, **_):
+        sentences = [language_v1.Sentence(text=_span(text, start, sentence, encoding_type),
+                                          sentiment=_sentiment(sentence))
+                     for start, sentence in _sentences(text)]
+        scores = [s.sentiment.score for s in sentences]
+        document = language_v1.Sentiment(
+            score=sum(scores) / len(scores) if scores else 0,
+            magnitude=sum(s.sentiment.magnitude for s in sentences))
+        return language_v1.AnalyzeSentimentResponse(document_sentiment=document,
+                                                    language="en",
+                                                    sentences=sentences)
+
+
+    def classify_text(self, text: str, **_):
+        words = [w.lower() for w in _WORD_PATTERN.findall(text)]
+        if len(text.split()) < CLASSIFY_MIN_TOKENS:
+            raise InvalidArgument("Invalid text content: too few tokens (words) to process.")
+
+        hits = {name: sum(w in keywords for w in words)
+                for name, keywords in CATEGORY_KEYWORDS.items()}
+        total = sum(hits.values())
+        categories = [language_v1.ClassificationCategory(name=name, confidence=count / total)
+                      for name, count in sorted(hits.items(), key=lambda h: -h[1])
+                      if count and count / total >= 0.1]
+        return language_v1.ClassifyTextResponse(categories=categories)
+
+
+    def annotate_text(self, text: str, features=None, encoding_type=None, **_):
+        features = language_v1.AnnotateTextRequest.Features(features or {})
+        response = language_v1.AnnotateTextResponse(language="en")
+
+        if features.extract_syntax:
+            for start, sentence in _sentences(text):
+                response.sentences.append(
+                    language_v1.Sentence(text=_span(text, start, sentence, encoding_type)))
+            for match in _TOKEN_PATTERN.finditer(text):
+                token = match.group()
+                if token[0].isdigit():
+                    tag = Tag.NUM
+                elif not token[0].isalnum() and token[0] not in "@#":
+                    tag = Tag.PUNCT
+                else:
+                    tag = Tag.UNKNOWN
+                response.tokens.append(language_v1.Token(
+                    text=_span(text, match.start(), token, encoding_type),
+                    part_of_speech=language_v1.PartOfSpeech(tag=tag),
+                    lemma=token.lower()))
+
+        if features.extract_entity_sentiment:
+            response.entities = self.analyze_entity_sentiment(text, encoding_type).entities
+        elif features.extract_entities:
+            response.entities = self.analyze_entities(text, encoding_type).entities
+
+        if features.extract_document_sentiment:
+            sentiment = self.analyze_sentiment(text, encoding_type)
+            response.document_sentiment = sentiment.document_sentiment
+            if not features.extract_syntax:
+                response.sentences = sentiment.sentences
+
+        if features.classify_text:
+            try:
+                response.categories = self.classify_text(text).categories
+            except InvalidArgument:
+                pass
+
+        return response
+
+
+class LocalLanguageAsyncClient:
+    """asyncio version of LocalLanguageClient."""
+
+    def __init__(self):
+        self._client = LocalLanguageClient()
+
+
+    async def analyze_entities(self, text: str, **kwargs):
+        return self._client.analyze_entities(text, **kwargs)
+
+
+    async def analyze_entity_sentiment(self, text: str, **kwargs):
+        return self._client.analyze_entity_sentiment(text, **kwargs)
+
+
+    async def analyze_sentiment(self, text: str, **kwargs):
+        return self._client.analyze_sentiment(text, **kwargs)
+
+
+    async def classify_text(self, text: str, **kwargs):
+        return self._client.classify_text(text, **kwargs)
+
+
+    async def annotate_text(self, text: str, **kwargs):
+        return self._client.annotate_text(text, **kwargs)
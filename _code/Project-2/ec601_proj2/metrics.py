@@ -0,0 +1,225 @@
+"""
+    Pipeline metrics, aggregated in redis so the counts from every worker
+    process add up, and rendered in the Prometheus text format.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+import os
+import re
+import time
+
+import redis
+
+# Hash of series name (with labels) to value, shared by all workers.
+METRICS_KEY = "metrics:series"
+
+# Seconds a worker buffers updates before writing them to redis.
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "1"))
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Name to (type, help) of every metric.
+METRICS = {
+    "pipeline_items_processed_total":
+        ("counter", "Items a pipeline step finished processing."),
+    "pipeline_api_calls_total":
+        ("counter", "Calls made to an external API."),
+    "pipeline_api_failures_total":
+        ("counter", "External API calls that raised an error."),
+    "pipeline_api_latency_seconds":
+        ("histogram", "Latency of external API calls."),
+    "pipeline_step_seconds":
+        ("histogram", "Time spent in a worker step."),
+    "pipeline_rate_limit_wait_seconds":
+        ("gauge", "Seconds until a stage may call its API again."),
+    "pipeline_queue_depth":
+        ("gauge", "Items waiting in a redis queue."),
+}
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def series_name(name: str, labels: dict) -> str:
+    """The Prometheus series for name with labels, e.g. 'name{a="b"}'."""
+    if not labels:
+        return name
+    pairs = ",".join('%s="%s"' % (k, _escape(v)) for k, v in sorted(labels.items()))
+    return "%s{%s}" % (name, pairs)
+
+
+class Metrics:
+    """
+        Buffers counter increments, gauge values and histogram
+        observations and writes them to METRICS_KEY at most every
+        flush_interval seconds, in one pipelined round trip. Counters
+        are added with HINCRBYFLOAT so updates from several processes
+        are combined. Gauges are overwritten.
+    """
+
+    def __init__(self, redis_client: redis.Redis, flush_interval: float = None):
+        self._client = redis_client
+        self.flush_interval = (METRICS_FLUSH_INTERVAL if flush_interval is None
+                               else flush_interval)
+        self._counts = defaultdict(float)
+        self._gauges = {}
+        self._last_flush = time.monotonic()
+
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self._counts[series_name(name, labels)] += value
+        self._maybe_flush()
+
+
+    def set(self, name: str, value: float, **labels):
+        self._gauges[series_name(name, labels)] = value
+        self._maybe_flush()
+
+
+    def observe(self, name: str, value: float, **labels):
+        """
+            Add value to the histogram name. Buckets are cumulative and
+            every one is written, even while it is still 0.
+        """
+        for bound in LATENCY_BUCKETS:
+            series = series_name(name + "_bucket", dict(labels, le=bound))
+            self._counts[series] += 1 if value <= bound else 0
+        self._counts[series_name(name + "_bucket", dict(labels, le="+Inf"))] += 1
+        self._counts[series_name(name + "_sum", labels)] += value
+        self._counts[series_name(name + "_count", labels)] += 1
+        self._maybe_flush()
+
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observe how long the block takes in the histogram name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+
+    @contextmanager
+    def api_call(self, api: str, method: str):
+        """
+            Count a call to an external API and time it. Errors raised in
+            the block are counted as failures, by exception type, and
+            re-raised.
+        """
+        self.inc("pipeline_api_calls_total", api=api, method=method)
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as err:
+            self.inc("pipeline_api_failures_total", api=api, method=method,
+                     error=type(err).__name__)
+            raise
+        finally:
+            self.observe("pipeline_api_latency_seconds", time.perf_counter() - start,
+                         api=api, method=method)
+
+
+    def _maybe_flush(self):
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+
+    def flush(self):
+        """Write the buffered updates to redis."""
+        self._last_flush = time.monotonic()
+        if not self._counts and not self._gauges:
+            return
+
+        pipe = self._client.pipeline(transaction=False)
+        for series, value in self._counts.items():
+            pipe.hincrbyfloat(METRICS_KEY, series, value)
+        if self._gauges:
+            pipe.hset(METRICS_KEY, mapping=self._gauges)
+        pipe.execute()
+        self._counts.clear()
+        self._gauges.clear()
+
+
+def timed(step: str = None):
+    """
+        Decorator for worker methods that observes how long each call
+        takes in pipeline_step_seconds, labelled with the worker's STAGE
+        and the step name (the method name by default).
+    """
+    def decorator(func):
+        name = step or func.__name__
+
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.timer("pipeline_step_seconds", stage=self.STAGE, step=name):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def queue_depths(redis_client: redis.Redis, queues: list[str]) -> dict:
+    """Number of items in each queue, whether it is a list or a set."""
+    pipe = redis_client.pipeline(transaction=False)
+    for key in queues:
+        pipe.type(key)
+    types = pipe.execute()
+
+    pipe = redis_client.pipeline(transaction=False)
+    for key, key_type in zip(queues, types):
+        if key_type == b"set":
+            pipe.scard(key)
+        else:
+            # LLEN of a missing key is 0.
+            pipe.llen(key)
+    return dict(zip(queues, pipe.execute()))
+
+
+def _family(series: str) -> str:
+    name = series.split("{", 1)[0]
+    if name not in METRICS:
+        for suffix in ("_bucket", "_sum", "_count"):
+            if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+                return name[:-len(suffix)]
+    return name
+
+
+_LE_LABEL = re.compile(r'le="([^"]*)"')
+
+def _series_order(series: str):
+    """Sort histogram buckets by their numeric upper bound."""
+    match = _LE_LABEL.search(series)
+    if match is None:
+        return (series, 0)
+    return (_LE_LABEL.sub("", series), float(match.group(1)))
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def render_prometheus(redis_client: redis.Redis, queues: list[str]) -> str:
+    """
+        All metrics in the Prometheus text exposition format, with the
+        current depth of each of queues.
+    """
+    values = {k.decode(): float(v) for k, v in redis_client.hgetall(METRICS_KEY).items()}
+    for queue, depth in queue_depths(redis_client, queues).items():
+        values[series_name("pipeline_queue_depth", dict(queue=queue))] = float(depth)
+
+    families = defaultdict(list)
+    for series in sorted(values, key=_series_order):
+        families[_family(series)].append(series)
+
+    lines = []
+    for family in sorted(families):
+        if family in METRICS:
+            metric_type, help_text = METRICS[family]
+            lines.append("# HELP %s %s" % (family, help_text))
+            lines.append("# TYPE %s %s" % (family, metric_type))
+        for series in families[family]:
+            lines.append("%s %s" % (series, _format_value(values[series])))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,110 @@
+"""
+    Versioned schema migrations for database files created by older
+    versions. The schema version is kept in SQLite's user_version
+    pragma. Database files from before migrations existed are at
+    version 0.
+
+    New files are created from the models and start at the latest
+    version, so every migration must leave an existing file with the
+    same schema the models create. Migrations are written in SQL
+    rather than against the models so they don't change when the
+    models do.
+"""
+from . import LOGGER
+
+
+def _unique_topics(database):
+    """
+        Topic names and (user, topic) pairs became unique. Merge the
+        duplicates older versions could create before adding the
+        indexes.
+    """
+    # Point user topics at the first topic with the same name.
+    database.execute_sql("""
+        UPDATE "usertopic" SET "topic_id" = (
+            SELECT MIN("t2"."id") FROM "topic" AS "t1"
+            JOIN "topic" AS "t2" ON "t2"."name" = "t1"."name"
+            WHERE "t1"."id" = "usertopic"."topic_id")""")
+    database.execute_sql("""
+        DELETE FROM "topic" WHERE "id" NOT IN (
+            SELECT MIN("id") FROM "topic" GROUP BY "name")""")
+
+    # Keep the first row of each user topic, with the counts summed.
+    database.execute_sql("""
+        UPDATE "usertopic" SET
+            "tweet_count" = (
+                SELECT SUM("u2"."tweet_count") FROM "usertopic" AS "u2"
+                WHERE "u2"."user_id" = "usertopic"."user_id"
+                  AND "u2"."topic_id" = "usertopic"."topic_id"),
+            "user_identified" = (
+                SELECT MAX("u2"."user_identified") FROM "usertopic" AS "u2"
+                WHERE "u2"."user_id" = "usertopic"."user_id"
+                  AND "u2"."topic_id" = "usertopic"."topic_id")
+        WHERE "id" IN (
+            SELECT MIN("id") FROM "usertopic"
+            GROUP BY "user_id", "topic_id" HAVING COUNT(*) > 1)""")
+    database.execute_sql("""
+        DELETE FROM "usertopic" WHERE "id" NOT IN (
+            SELECT MIN("id") FROM "usertopic" GROUP BY "user_id", "topic_id")""")
+
+    # Files created since the indexes were added to the models have them.
+    database.execute_sql(
+        'CREATE UNIQUE INDEX IF NOT EXISTS "topic_name" ON "topic" ("name")')
+    database.execute_sql(
+        'CREATE UNIQUE INDEX IF NOT EXISTS "usertopic_user_id_topic_id" '
+        'ON "usertopic" ("user_id", "topic_id")')
+
+
+def _worker_query_indexes(database):
+    """Index the columns the workers and web client filter on."""
+    database.execute_sql('CREATE INDEX "tweet_analyzed" ON "tweet" ("analyzed")')
+    database.execute_sql('CREATE INDEX "tweet_classified" ON "tweet" ("classified")')
+    database.execute_sql('CREATE INDEX "user_last_scraped" ON "user" ("last_scraped")')
+    database.execute_sql(
+        'CREATE INDEX "user_scraped_following" ON "user" ("scraped_following")')
+    database.execute_sql(
+        'CREATE INDEX "usertopic_topic_id_user_id" ON "usertopic" ("topic_id", "user_id")')
+
+
+def _user_topic_ranking_index(database):
+    """Index for paging through a topic's users by tweet count."""
+    database.execute_sql(
+        'CREATE INDEX "usertopic_topic_id_tweet_count" ON "usertopic" ("topic_id", "tweet_count")')
+
+
+# Migration n upgrades a file from version n - 1 to version n.
+MIGRATIONS = [
+    (1, "Unique topic names and user topics", _unique_topics),
+    (2, "Indexes for worker queries", _worker_query_indexes),
+    (3, "Index user topics by tweet count", _user_topic_ranking_index),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def migrate(database, tables) -> int:
+    """
+        Create tables in a new database file, or run the migrations an
+        existing one is missing. Each migration is committed with its
+        version number, so an interrupted upgrade resumes where it
+        stopped. Returns the number of migrations run.
+    """
+    if not database.get_tables():
+        with database.atomic():
+            database.create_tables(tables)
+            database.user_version = SCHEMA_VERSION
+        return 0
+
+    version = database.user_version
+    if version > SCHEMA_VERSION:
+        raise RuntimeError("Database schema version %d is newer than this code (%d)." %
+                           (version, SCHEMA_VERSION))
+
+    pending = [m for m in MIGRATIONS if m[0] > version]
+    for number, description, migration in pending:
+        LOGGER.info("Migrating database to version %d: %s.", number, description)
+        with database.atomic():
+            migration(database)
+            database.user_version = number
+
+    return len(pending)
@@ -6,9 +6,11 @@
     the ORM will generate a primary key field and use it for
     building the model relations.
 """
-import os
+from collections import OrderedDict
+from contextlib import contextmanager
 
 from peewee import (
+    EXCLUDED,
     Model,
     DateTimeField,
     CharField,
@@ -16,9 +18,11 @@ from peewee import (
     ForeignKeyField,
     IntegerField,
     FloatField,
-    SqliteDatabase
+    SqliteDatabase,
+    chunked
 )
 
+from . import migrations
 from . import twitter_utils
 
 class BaseModel(Model):
@@ -32,8 +36,8 @@ class User(BaseModel):
     url = CharField(null=True)
     description = CharField(null=True)
     verified = BooleanField()
-    last_scraped = DateTimeField(null=True)
-    scraped_following = BooleanField(default=False)
+    last_scraped = DateTimeField(null=True, index=True)
+    scraped_following = BooleanField(default=False, index=True)
     protected = BooleanField()
 
 
@@ -42,8 +46,8 @@ class Tweet(BaseModel):
     user = ForeignKeyField(User, backref='tweets')
     created_at = DateTimeField()
     text = CharField()
-    analyzed = BooleanField(default=False)
-    classified = BooleanField(default=False)
+    analyzed = BooleanField(default=False, index=True)
+    classified = BooleanField(default=False, index=True)
 
 
 class Topic(BaseModel):
@@ -51,7 +55,7 @@ class Topic(BaseModel):
         Stored list of topic names that come back from
         Google's NLP classifcations.
     """
-    name = CharField()
+    name = CharField(unique=True)
 
 
 class UserTopic(BaseModel):
@@ -70,6 +74,13 @@ class UserTopic(BaseModel):
     user_identified = BooleanField(default=False)
 
 
+UserTopic.add_index(UserTopic.index(UserTopic.user, UserTopic.topic, unique=True))
+# For listing the users of a topic.
+UserTopic.add_index(UserTopic.index(UserTopic.topic, UserTopic.user))
+# For paging through the users of a topic by tweet count.
+UserTopic.add_index(UserTopic.index(UserTopic.topic, UserTopic.tweet_count))
+
+
 class Entity(BaseModel):
     """Store entitiy results from Google"""
     name = CharField()
@@ -120,15 +131,282 @@ def add_tweet(tweet: twitter_utils.Tweet):
 
     return tweet_model
 
+## Bulk helpers used by the DatabaseWorker. These expect to be
+## called inside a transaction (see atomic()) so a whole batch of
+## queue results is committed with a single write.
+
+# Keep the number of bound parameters per statement well under
+# SQLite's SQLITE_MAX_VARIABLE_NUMBER.
+MAX_ROWS_PER_INSERT = 100
+
+class InternCache:
+    """
+        Bounded LRU mapping of a natural key (e.g. an entity's name and
+        type) to the id of the row that stores it. Lookups that hit the
+        cache skip the SELECT. Misses are resolved in bulk by the loader
+        passed to resolve().
+    """
+
+    def __init__(self, maxsize=50000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._ids = OrderedDict()
+
+
+    def __len__(self):
+        return len(self._ids)
+
+
+    def get(self, key):
+        try:
+            self._ids.move_to_end(key)
+        except KeyError:
+            return None
+        return self._ids[key]
+
+
+    def put(self, key, row_id):
+        self._ids[key] = row_id
+        self._ids.move_to_end(key)
+        while len(self._ids) > self.maxsize:
+            self._ids.popitem(last=False)
+
+
+    def resolve(self, keys, loader) -> dict:
+        """
+            Map every key to its id. loader is called once with the
+            list of keys that weren't cached and must return a dict
+            with an id for each of them.
+        """
+        ids = {}
+        missing = []
+        for key in keys:
+            row_id = self.get(key)
+            if row_id is None:
+                missing.append(key)
+            else:
+                ids[key] = row_id
+
+        self.hits += len(ids)
+        self.misses += len(missing)
+        if missing:
+            loaded = loader(missing)
+            for key in missing:
+                self.put(key, loaded[key])
+                ids[key] = loaded[key]
+
+        return ids
+
+
+    def clear(self):
+        self._ids.clear()
+
+
+    def stats(self) -> dict:
+        return dict(hits=self.hits, misses=self.misses, size=len(self._ids))
+
+
+# (name, type) -> Entity.id
+ENTITY_IDS = InternCache()
+
+# name -> Topic.id
+TOPIC_IDS = InternCache()
+
+
+def clear_intern_caches():
+    ENTITY_IDS.clear()
+    TOPIC_IDS.clear()
+
+
+def warm_intern_caches():
+    """
+        Load the most recently created entities and topics into
+        the intern caches.
+    """
+    query = (Entity.select(Entity.id, Entity.name, Entity.type)
+                   .order_by(Entity.id.desc())
+                   .limit(ENTITY_IDS.maxsize))
+    # Insert oldest first so the newest rows are the last evicted.
+    for ent in reversed(list(query)):
+        ENTITY_IDS.put((ent.name, ent.type), ent.id)
+
+    query = (Topic.select(Topic.id, Topic.name)
+                  .order_by(Topic.id.desc())
+                  .limit(TOPIC_IDS.maxsize))
+    for topic in reversed(list(query)):
+        TOPIC_IDS.put(topic.name, topic.id)
+
+
+@contextmanager
+def atomic():
+    """
+        Transaction context manager for the database the models
+        are bound to.
+    """
+    try:
+        with Tweet._meta.database.atomic():
+            yield
+    except Exception:
+        # Ids interned inside a rolled back transaction may not exist.
+        clear_intern_caches()
+        raise
+
+
+def add_tweets(tweets: list[twitter_utils.Tweet]) -> set[str]:
+    """
+        Insert many tweets, ignoring any that already exist. Tweets whose
+        author is not in the database are skipped.
+
+        Returns the set of user ids the stored tweets belong to.
+    """
+    author_ids = {t.author_id for t in tweets}
+    known_ids = {u.id for u in User.select(User.id).where(User.id << list(author_ids))}
+
+    rows = []
+    for tweet in tweets:
+        if tweet.author_id not in known_ids:
+            continue
+        data = tweet.to_dict()
+        data['user'] = data.pop("author_id")
+        rows.append(data)
+
+    for batch in chunked(rows, MAX_ROWS_PER_INSERT):
+        Tweet.insert_many(batch).on_conflict_ignore().execute()
+
+    return known_ids
+
+
+def add_users(twitter_users: list[twitter_utils.TwitterUser]) -> list[twitter_utils.TwitterUser]:
+    """
+        Insert many users, ignoring any that already exist. Existing
+        users are found with one query, so this is cheap for a page of
+        users that are mostly known.
+
+        Returns the users that were new.
+    """
+    user_ids = list({u.id for u in twitter_users})
+    known_ids = {u.id for u in User.select(User.id).where(User.id << user_ids)}
+
+    new_users = {}
+    for twitter_user in twitter_users:
+        if twitter_user.id not in known_ids:
+            new_users.setdefault(twitter_user.id, twitter_user)
+
+    rows = [u.to_dict() for u in new_users.values()]
+    for batch in chunked(rows, MAX_ROWS_PER_INSERT):
+        User.insert_many(batch).on_conflict_ignore().execute()
+
+    return list(new_users.values())
+
+
+def add_tweet_entities(rows: list[tuple[str, int]]):
+    """
+        Insert (tweet_id, entity_id) pairs.
+    """
+    fields = [TweetEntity.tweet, TweetEntity.entity]
+    for batch in chunked(rows, MAX_ROWS_PER_INSERT):
+        TweetEntity.insert_many(batch, fields=fields).execute()
+
+
+def _upsert_entities(keys):
+    for batch in chunked(keys, MAX_ROWS_PER_INSERT):
+        (Entity.insert_many(batch, fields=[Entity.name, Entity.type])
+               .on_conflict_ignore()
+               .execute())
+
+    ids = {}
+    for batch in chunked(keys, MAX_ROWS_PER_INSERT):
+        names = {name for name, _ in batch}
+        for ent in Entity.select().where(Entity.name << list(names)):
+            ids[(ent.name, ent.type)] = ent.id
+
+    return ids
+
+
+def get_entity_ids(keys: set[tuple[str, int]]) -> dict[tuple[str, int], int]:
+    """
+        Map (name, type) pairs to Entity ids, creating the
+        entities that don't exist yet.
+    """
+    return ENTITY_IDS.resolve(keys, _upsert_entities)
+
+
+def _upsert_topics(names):
+    rows = [{"name": n} for n in names]
+    for batch in chunked(rows, MAX_ROWS_PER_INSERT):
+        Topic.insert_many(batch).on_conflict_ignore().execute()
+
+    ids = {}
+    for batch in chunked(names, MAX_ROWS_PER_INSERT):
+        for topic in Topic.select().where(Topic.name << batch):
+            ids[topic.name] = topic.id
+
+    return ids
+
+
+def get_topic_ids(names: set[str]) -> dict[str, int]:
+    """
+        Map topic names to Topic ids, creating the topics that
+        don't exist yet.
+    """
+    return TOPIC_IDS.resolve(names, _upsert_topics)
+
+
+def increment_user_topics(counts: dict[tuple[str, int], int]):
+    """
+        Add tweet counts to UserTopic rows keyed by (user_id, topic_id),
+        creating the rows that don't exist yet.
+    """
+    rows = [
+        {"user": user_id, "topic": topic_id, "tweet_count": count}
+        for (user_id, topic_id), count in counts.items()
+    ]
+    for batch in chunked(rows, MAX_ROWS_PER_INSERT):
+        (UserTopic.insert_many(batch)
+                  .on_conflict(
+                      conflict_target=[UserTopic.user, UserTopic.topic],
+                      update={UserTopic.tweet_count: UserTopic.tweet_count +
+                                                     EXCLUDED.tweet_count})
+                  .execute())
+
+
+def update_tweets(tweet_ids, **values):
+    """
+        Set field values on many tweets at once.
+    """
+    for batch in chunked(list(tweet_ids), MAX_ROWS_PER_INSERT):
+        Tweet.update(**values).where(Tweet.id << batch).execute()
+
+
+def update_users(user_ids, **values):
+    """
+        Set field values on many users at once.
+    """
+    for batch in chunked(list(user_ids), MAX_ROWS_PER_INSERT):
+        User.update(**values).where(User.id << batch).execute()
+
+
 TABLES = [User, Tweet, Topic, UserTopic, Entity, TweetEntity]
 
+# Applied to every connection. WAL lets the web client read while the
+# DatabaseWorker writes, and with WAL synchronous=NORMAL only risks
+# losing the last transactions on power loss, not corruption.
+PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    # Negative sizes are in KiB, so 64MB of page cache.
+    "cache_size": -64 * 1024,
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "memory",
+}
+
 def init_db(filename):
     #pylint: disable=global-statement
-    existed = os.path.exists(filename)
-    database = SqliteDatabase(filename)
+    database = SqliteDatabase(filename, pragmas=PRAGMAS)
     database.bind(TABLES)
     database.connect()
-    if not existed:
-        database.create_tables(TABLES)
+    clear_intern_caches()
+    migrations.migrate(database, TABLES)
 
     return database
@@ -0,0 +1,160 @@
+"""
+    Per-stage profiling for the pipeline workers.
+"""
+from collections import defaultdict
+import cProfile
+from functools import wraps
+import os
+from pathlib import Path
+import pstats
+import sys
+import threading
+import time
+
+from . import LOGGER
+
+
+class StageProfiler:
+    """
+        Profiles calls to worker methods, keeping one cProfile.Profile per
+        stage. A sampling thread also records the stack of the profiled
+        call every sample_interval seconds, which is written out as
+        collapsed stacks for flame graph tools.
+
+        Stats are written to output_dir as <stage>.<pid>.pstats and
+        <stage>.<pid>.collapsed every dump_interval seconds, when
+        request_dump() is called (e.g. from a SIGUSR1 handler) and on
+        close(). Each dump has everything since profiling started. After
+        duration seconds profiling stops and the workers run unprofiled.
+
+        Nothing is wrapped unless profile() is called, so workers that
+        aren't profiled have no overhead.
+    """
+
+    def __init__(self, output_dir, dump_interval: float = None, duration: float = None,
+                 sample_interval: float = 0.005):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.dump_interval = dump_interval
+        self.duration = duration
+        self.sample_interval = sample_interval
+
+        self.profiles = defaultdict(cProfile.Profile)
+        self.stacks = defaultdict(lambda: defaultdict(int))
+        self._started = time.time()
+        self._next_dump = self._started + dump_interval if dump_interval else None
+        self._dump_requested = False
+        self._wrapped = []
+        self._stopped = False
+
+        # Stage and thread of the call being profiled, if any.
+        self._active = None
+        self._sampler = None
+        if sample_interval:
+            self._sampler = threading.Thread(target=self._sample, name="profile-sampler",
+                                             daemon=True)
+            self._sampler.start()
+
+
+    def profile(self, worker, methods=("process",)):
+        """
+            Profile calls to methods of worker under the worker's STAGE.
+            Calls made while another profiled call is running are counted
+            in the outer call only.
+        """
+        stage = worker.STAGE
+        for name in methods:
+            method = getattr(worker, name)
+            setattr(worker, name, self._wrap(stage, method))
+            self._wrapped.append((worker, name))
+
+
+    def _wrap(self, stage, method):
+        @wraps(method)
+        def profiled(*args, **kwargs):
+            if self._active is not None or self._stopped:
+                return method(*args, **kwargs)
+
+            profile = self.profiles[stage]
+            self._active = (stage, threading.get_ident())
+            profile.enable()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                profile.disable()
+                self._active = None
+                self._after_call()
+        return profiled
+
+
+    def _after_call(self):
+        now = time.time()
+        if self.duration and now - self._started >= self.duration:
+            LOGGER.info("Profiling finished after %s seconds.", self.duration)
+            self.close()
+        elif self._dump_requested or (self._next_dump and now >= self._next_dump):
+            self.dump()
+
+
+    @staticmethod
+    def _is_wrapper(code) -> bool:
+        return code.co_name == "profiled" and code.co_filename == __file__
+
+
+    def _sample(self):
+        while not self._stopped:
+            time.sleep(self.sample_interval)
+            active = self._active
+            if active is None:
+                continue
+
+            stage, thread_id = active
+            frame = sys._current_frames().get(thread_id) #pylint: disable=protected-access
+            stack = []
+            # Only keep the frames below the profiled call.
+            while frame is not None and not self._is_wrapper(frame.f_code):
+                code = frame.f_code
+                stack.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[stage][";".join(reversed(stack))] += 1
+
+
+    def request_dump(self):
+        """
+            Dump after the profiled call in progress returns. Safe to call
+            from a signal handler.
+        """
+        self._dump_requested = True
+
+
+    def dump(self):
+        """Write the stats of every stage to output_dir."""
+        self._dump_requested = False
+        if self.dump_interval:
+            self._next_dump = time.time() + self.dump_interval
+
+        pid = os.getpid()
+        for stage, profile in list(self.profiles.items()):
+            path = self.output_dir / ("%s.%d.pstats" % (stage, pid))
+            pstats.Stats(profile).dump_stats(path)
+
+            stacks = dict(self.stacks[stage])
+            path = self.output_dir / ("%s.%d.collapsed" % (stage, pid))
+            with path.open("w") as f:
+                for stack, count in sorted(stacks.items()):
+                    f.write("%s;%s %d\n" % (stage, stack, count))
+        LOGGER.info("Wrote profiles for %s to %s.", ", ".join(self.profiles) or "no stages",
+                    self.output_dir)
+
+
+    def close(self):
+        """Stop profiling, restore the wrapped methods and write the stats."""
+        if self._stopped:
+            return
+
+        self._stopped = True
+        for worker, name in self._wrapped:
+            delattr(worker, name)
+        self._wrapped = []
+        self.dump()
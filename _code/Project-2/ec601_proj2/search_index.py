@@ -0,0 +1,181 @@
+"""
+    In-memory prefix search over topic names and users, for the web
+    client's search box.
+"""
+from bisect import bisect_left, insort
+import os
+import threading
+import time
+
+from peewee import SQL
+
+from . import models
+from . import LOGGER
+
+# Seconds between checks for new users. Topics are also reloaded when
+# the topics generation changes.
+SEARCH_REFRESH_INTERVAL = float(os.getenv("SEARCH_REFRESH_INTERVAL", "10"))
+
+# Separates the searchable text of a key from the id it refers to. It
+# sorts before every other character, so a key sorts with its text.
+_SEPARATOR = "\0"
+
+# Batches of at least this many keys are merged with a sort instead of
+# inserted one at a time.
+_MERGE_SIZE = 64
+
+
+def normalize(text: str) -> str:
+    return text.casefold().replace(_SEPARATOR, "")
+
+
+class PrefixIndex:
+    """
+        Sorted list of "<text>\\0<ref>" keys. The keys starting with a
+        prefix are found with a binary search and are next to each
+        other, so a search costs O(log n + limit).
+
+        The list is never changed in place. add() builds a new one and
+        swaps it in, so searches don't need to lock.
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self._keys)
+
+
+    def add(self, entries):
+        """Add (text, ref) pairs. Matching is case insensitive."""
+        keys = ["%s%s%s" % (normalize(text), _SEPARATOR, ref) for text, ref in entries if text]
+        if not keys:
+            return
+
+        with self._lock:
+            if len(keys) < _MERGE_SIZE:
+                merged = self._keys.copy()
+                for key in keys:
+                    insort(merged, key)
+            else:
+                # Timsort merges the two sorted runs in linear time.
+                keys.sort()
+                merged = self._keys + keys
+                merged.sort()
+            self._keys = merged
+
+
+    def search(self, prefix: str, limit: int) -> list[str]:
+        """
+            Up to limit distinct refs with text starting with prefix, in
+            order of the text.
+        """
+        prefix = normalize(prefix)
+        refs = []
+        seen = set()
+        keys = self._keys
+        for i in range(bisect_left(keys, prefix), len(keys)):
+            key = keys[i]
+            if not key.startswith(prefix):
+                break
+            ref = key.rsplit(_SEPARATOR, 1)[1]
+            if ref not in seen:
+                seen.add(ref)
+                refs.append(ref)
+                if len(refs) == limit:
+                    break
+        return refs
+
+
+class SearchIndex:
+    """
+        Prefix indexes of topic names (and each part of their path) and
+        of usernames and display names. The first search loads every
+        row. After that, refresh() only loads the rows added since the
+        last one, by id for topics and by rowid for users. Users that
+        change their names keep being found by the old ones until the
+        process restarts.
+    """
+
+    def __init__(self, refresh_interval: float = None):
+        self.refresh_interval = (SEARCH_REFRESH_INTERVAL if refresh_interval is None
+                                 else refresh_interval)
+        self.topics = PrefixIndex()
+        self.users = PrefixIndex()
+        self.topic_names = {}
+        self._last_topic_id = 0
+        self._last_user_rowid = 0
+        self._generation = None
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+
+
+    def _stale(self, generation) -> bool:
+        return (self._refreshed_at is None or generation != self._generation or
+                time.monotonic() - self._refreshed_at >= self.refresh_interval)
+
+
+    def refresh(self, generation=None):
+        """
+            Load new topics and users if generation (the topics
+            generation) has changed or refresh_interval has passed.
+        """
+        if not self._stale(generation):
+            return
+
+        with self._lock:
+            # Another thread may have refreshed while this one waited.
+            if not self._stale(generation):
+                return
+            self._generation = generation
+            self._refreshed_at = time.monotonic()
+
+            query = (models.Topic.select(models.Topic.id, models.Topic.name)
+                                 .where(models.Topic.id > self._last_topic_id)
+                                 .order_by(models.Topic.id)
+                                 .tuples())
+            entries = []
+            for topic_id, name in query:
+                self.topic_names[str(topic_id)] = name
+                entries.append((name, topic_id))
+                entries.extend((part, topic_id) for part in name.split("/")[1:])
+                self._last_topic_id = topic_id
+            self.topics.add(entries)
+
+            query = (models.User.select(SQL("rowid"), models.User.id, models.User.username,
+                                        models.User.name)
+                                .where(SQL("rowid > ?", [self._last_user_rowid]))
+                                .order_by(SQL("rowid"))
+                                .tuples())
+            entries = []
+            for rowid, user_id, username, name in query.iterator():
+                entries.append((username, user_id))
+                entries.append((name, user_id))
+                self._last_user_rowid = rowid
+            self.users.add(entries)
+
+            if entries:
+                LOGGER.debug("Search index has %d topic and %d user keys.",
+                             len(self.topics), len(self.users))
+
+
+    def search(self, prefix: str, limit: int) -> dict:
+        """
+            Up to limit topic names and users (id, username, name and
+            description) matching prefix.
+        """
+        topics = [self.topic_names[ref] for ref in self.topics.search(prefix, limit)]
+
+        user_ids = self.users.search(prefix, limit)
+        users = []
+        if user_ids:
+            query = (models.User.select(models.User.id, models.User.username,
+                                        models.User.name, models.User.description)
+                                .where(models.User.id << user_ids)
+                                .dicts())
+            by_id = {user["id"]: user for user in query}
+            users = [by_id[user_id] for user_id in user_ids if user_id in by_id]
+
+        return dict(topics=topics, users=users)
@@ -0,0 +1,138 @@
+"""
+    Ranked index of the users of each topic, kept in redis so the web
+    client can answer "top users for a topic" without reading the
+    database. The DatabaseWorker updates it as it stores classification
+    results, and rebuild() recreates it from the UserTopic table.
+"""
+import json
+
+from peewee import chunked
+import redis
+
+from . import models
+from . import LOGGER
+
+# Sorted set per topic name of user id, scored by the user's tweet
+# count for the topic.
+TOPIC_USERS_KEY = "topic_index:users:%s"
+
+# Hash of user id to the JSON of the user's PROFILE_FIELDS.
+USER_PROFILES_KEY = "topic_index:profiles"
+
+PROFILE_FIELDS = (models.User.id, models.User.name, models.User.username, models.User.url,
+                  models.User.description, models.User.verified, models.User.protected)
+
+
+class TopicIndex:
+    """
+        Reads and writes the per topic sorted sets and the user profiles
+        they point to.
+    """
+
+    def __init__(self, redis_client: redis.Redis):
+        self._client = redis_client
+
+
+    @staticmethod
+    def profile_query(user_ids):
+        """The PROFILE_FIELDS of user_ids, as dicts."""
+        return (models.User.select(*PROFILE_FIELDS)
+                           .where(models.User.id << list(user_ids))
+                           .dicts())
+
+
+    @staticmethod
+    def _add(pipe, counts: dict[tuple[str, str], int], profiles: list[dict], increment: bool):
+        for (user_id, topic_name), count in counts.items():
+            key = TOPIC_USERS_KEY % topic_name
+            if increment:
+                pipe.zincrby(key, count, user_id)
+            else:
+                pipe.zadd(key, {user_id: count})
+        if profiles:
+            pipe.hset(USER_PROFILES_KEY,
+                      mapping={p["id"]: json.dumps(p) for p in profiles})
+
+
+    def increment(self, counts: dict[tuple[str, str], int], profiles: list[dict]):
+        """
+            Add tweet counts keyed by (user_id, topic_name), the same
+            increments just written to UserTopic, and store the profiles
+            of the users, in one round trip.
+        """
+        pipe = self._client.pipeline(transaction=False)
+        self._add(pipe, counts, profiles, increment=True)
+        pipe.execute()
+
+
+    def top_users(self, topic_names: list[str], limit: int) -> dict[str, list[dict]]:
+        """
+            The profiles of the limit users with the most tweets in each
+            topic, highest first, with their tweet_count. Topics that
+            aren't in the index are left out.
+        """
+        pipe = self._client.pipeline(transaction=False)
+        for name in topic_names:
+            pipe.zrevrange(TOPIC_USERS_KEY % name, 0, limit - 1, withscores=True)
+        ranked = dict(zip(topic_names, pipe.execute()))
+
+        user_ids = list({user_id for members in ranked.values() for user_id, _ in members})
+        profiles = {}
+        if user_ids:
+            profiles = dict(zip(user_ids, self._client.hmget(USER_PROFILES_KEY, user_ids)))
+
+        users_by_topic = {}
+        for name, members in ranked.items():
+            if not members:
+                continue
+            users = []
+            for user_id, score in members:
+                profile = profiles[user_id]
+                user = json.loads(profile) if profile else dict(id=user_id.decode())
+                user["tweet_count"] = int(score)
+                users.append(user)
+            users_by_topic[name] = users
+        return users_by_topic
+
+
+    def clear(self) -> int:
+        """Delete the index. Returns the number of topics it had."""
+        keys = list(self._client.scan_iter(match=TOPIC_USERS_KEY % "*", count=1000))
+        for batch in chunked(keys, 1000):
+            self._client.delete(*batch)
+        self._client.delete(USER_PROFILES_KEY)
+        return len(keys)
+
+
+    def rebuild(self, batch_size: int = 5000) -> int:
+        """
+            Replace the index with the tweet counts in UserTopic. Rows
+            are read with a cursor and written batch_size at a time, so
+            memory use doesn't grow with the table. Counts stored by a
+            DatabaseWorker while this runs may be lost, so stop the
+            pipeline first. Returns the number of user topics indexed.
+        """
+        self.clear()
+        query = (models.UserTopic.select(models.Topic.name.alias("topic_name"),
+                                         models.UserTopic.tweet_count,
+                                         *PROFILE_FIELDS)
+                                 .join(models.Topic)
+                                 .switch(models.UserTopic)
+                                 .join(models.User)
+                                 .order_by(models.UserTopic.id)
+                                 .dicts())
+
+        total = 0
+        for batch in chunked(query.iterator(), batch_size):
+            counts = {}
+            profiles = {}
+            for row in batch:
+                counts[(row["id"], row.pop("topic_name"))] = row.pop("tweet_count")
+                profiles[row["id"]] = row
+
+            pipe = self._client.pipeline(transaction=False)
+            self._add(pipe, counts, list(profiles.values()), increment=False)
+            pipe.execute()
+            total += len(batch)
+            LOGGER.debug("Indexed %d user topics.", total)
+        return total
@@ -45,9 +45,56 @@ V11_API = TwitterAPI(TWITTER_CONSUMER_KEY,
 
 class TwitterRateLimitError(TwitterError):
 
-    def __init__(self, reset_time, *args, **kwargs):
+    def __init__(self, reset_time, *args, endpoint=None, **kwargs):
         super().__init__(reset_time)
         self.reset_epoch_seconds = float(reset_time)
+        # Endpoint family (see endpoint_family) that was rate limited.
+        self.endpoint = endpoint
+
+
+@dataclass
+class RateLimit:
+    """
+        Rate limit state for an endpoint family as reported by the
+        x-rate-limit-* headers of its last response.
+    """
+    endpoint: str
+    limit: int
+    remaining: int
+    reset_epoch_seconds: float
+
+    @classmethod
+    def from_headers(cls, endpoint, headers):
+        try:
+            return cls(endpoint=endpoint,
+                       limit=int(headers['x-rate-limit-limit']),
+                       remaining=int(headers['x-rate-limit-remaining']),
+                       reset_epoch_seconds=float(headers['x-rate-limit-reset']))
+        except (KeyError, ValueError):
+            return None
+
+
+# Called with a RateLimit every time a response has rate limit headers.
+_RATE_LIMIT_HOOK = None
+
+def set_rate_limit_hook(hook):
+    """
+        Register a callable to receive the RateLimit of every response,
+        e.g. to share the remaining budget between processes. Pass None
+        to remove it.
+    """
+    global _RATE_LIMIT_HOOK #pylint: disable=global-statement
+    _RATE_LIMIT_HOOK = hook
+
+
+def endpoint_family(endpoint: str) -> str:
+    """
+        Twitter budgets requests per endpoint, not per resource, so
+        replace path parameters: "users/:1234/following" becomes
+        "users/:id/following".
+    """
+    return "/".join(":id" if part.startswith(":") else part
+                    for part in endpoint.split("/"))
 
 
 class TweetCount:
@@ -184,7 +231,8 @@ def search(query, start_date=None, end_date=None, max_results=10):
     }
 
     _add_payload_dates(payload, start_date, end_date)
-    response = _check_response(V2_API.request("tweets/search/recent", payload))
+    response = _check_response(V2_API.request("tweets/search/recent", payload),
+                               "tweets/search/recent")
 
     payload = response.json()
     count = payload['meta']['result_count']
@@ -209,7 +257,8 @@ def counts(query, granularity="hour", start_time=None, end_time=None) -> list[Tw
     }
 
     _add_payload_dates(payload, start_time, end_time)
-    response = _check_response(V2_API.request("tweets/counts/recent", payload))
+    response = _check_response(V2_API.request("tweets/counts/recent", payload),
+                               "tweets/counts/recent")
 
     payload = response.json()
     return [TweetCount(query, **count) for count in payload['data']]
@@ -218,7 +267,8 @@ def counts(query, granularity="hour", start_time=None, end_time=None) -> list[Tw
 def home_timeline(count=5) -> list[Tweet]:
     params = { "count": count }
 
-    resp = _check_response(V11_API.request("statuses/home_timeline", params))
+    resp = _check_response(V11_API.request("statuses/home_timeline", params),
+                           "statuses/home_timeline")
 
     data = resp.json()
     tweets = []
@@ -241,10 +291,17 @@ def get_user_by_id(user_id):
     return V2_API.request(f"users/{user_id}")
 
 
-def _check_response(response):
+def _check_response(response, endpoint=None):
+    family = endpoint_family(endpoint) if endpoint else None
+    if family and _RATE_LIMIT_HOOK is not None:
+        rate_limit = RateLimit.from_headers(family, response.headers)
+        if rate_limit:
+            _RATE_LIMIT_HOOK(rate_limit)
+
     if response.status_code != 200:
         if response.status_code == 429:
-            raise TwitterRateLimitError(response.headers['x-rate-limit-reset'])
+            raise TwitterRateLimitError(response.headers['x-rate-limit-reset'],
+                                        endpoint=family)
         else:
             raise TwitterRequestError(status_code=response.status_code,
                                       msg=response.text)
@@ -256,21 +313,27 @@ def _check_response(response):
     return response
 
 
-def _user_list_result(endpoint, pagination) -> Tuple[ResponseMetadata, list[TwitterUser]]:
+# Largest page the user list endpoints return.
+MAX_USERS_PER_PAGE = 1000
+
+def _user_list_result(endpoint, pagination,
+                      max_results=None) -> Tuple[ResponseMetadata, list[TwitterUser]]:
     params = {
         "user.fields": "verified,description,protected",
     }
     if pagination:
         params["pagination_token"] = pagination
+    if max_results:
+        params["max_results"] = max_results
 
-    response = _check_response(V2_API.request(endpoint, params=params))
+    response = _check_response(V2_API.request(endpoint, params=params), endpoint)
 
     json = response.json()
     metadata = ResponseMetadata(**json['meta'])
     count = metadata.result_count
 
     if count == 0:
-        return []
+        return metadata, []
 
     data = json['data']
     return metadata, [TwitterUser(**user) for user in data]
@@ -281,7 +344,7 @@ def _tweets_list_result(endpoint, limit):
         "max_results": limit,
         "tweet.fields": "id,author_id,created_at,text"
     }
-    response = _check_response(V2_API.request(endpoint, params=params))
+    response = _check_response(V2_API.request(endpoint, params=params), endpoint)
     json = response.json()
     if 'meta' not in json:
         print("???")
@@ -305,7 +368,8 @@ def get_user_by_username(username) -> TwitterUser:
     params = {
         "user.fields": "description,url,id,username,name,verified"
     }
-    response = _check_response(V2_API.request(f"users/by/username/:{username}", params=params))
+    endpoint = f"users/by/username/:{username}"
+    response = _check_response(V2_API.request(endpoint, params=params), endpoint)
     body = response.json()
     if not body.get('data'):
         return None
@@ -313,8 +377,8 @@ def get_user_by_username(username) -> TwitterUser:
     return TwitterUser(**body['data'])
 
 
-def get_following(user_id: str, pagination=None):
-    return _user_list_result(f"users/:{user_id}/following", pagination)
+def get_following(user_id: str, pagination=None, max_results=None):
+    return _user_list_result(f"users/:{user_id}/following", pagination, max_results)
 
 
 def get_followers(user_id: str, pagination=None):
@@ -332,17 +396,24 @@ def get_user_tweets(user_id: str, limit=10):
     _, tweets = _tweets_list_result(f"users/:{user_id}/tweets", limit)
     return tweets
 
-def iterate_following(user_id: str):
+def iterate_following_pages(user_id: str, page_size=MAX_USERS_PER_PAGE):
+    """
+        Yield the users user_id follows a page (a list of up to page_size
+        users) at a time.
+    """
     page = None
 
     while True:
-        meta, users = get_following(user_id, pagination=page)
+        meta, users = get_following(user_id, pagination=page, max_results=page_size)
         if meta.result_count == 0:
             return
 
-        for user in users:
-            yield user
+        yield users
 
         page = meta.next_token
         if not page:
             return
+
+def iterate_following(user_id: str):
+    for users in iterate_following_pages(user_id):
+        yield from users
@@ -1,21 +1,31 @@
 """
     Defines workers for scraping and analyzing twitter data.
 """
-from collections import defaultdict
+import abc
+import asyncio
+from collections import OrderedDict, defaultdict
 
 from dataclasses import dataclass
 from datetime import datetime, timedelta
+import functools
+import hashlib
 import json
+import os
 import time
 import logging
+import unicodedata
 
 import dateparser
+import msgpack
+from peewee import JOIN, chunked
 from playhouse.shortcuts import dict_to_model, model_to_dict
 import redis
 
+from . import metrics
 from . import models
 from . import twitter_utils
 from . import google_nlp
+from .topic_index import TopicIndex
 from . import LOGGER
 
 TWITTER_RATE_LIMIT_EXPIRES_KEY = "twitter:rate_limit_up"
@@ -35,14 +45,271 @@ def set_google_rate_limit_expires(redis_client: redis.Redis, exp: float):
     redis_client.set(GOOGLE_RATE_LIMIT_EXPIRES_KEY, exp)
 
 
-def get_twitter_rate_limt_expires(redis_client: redis.Redis):
-    return _get_rate_limit_time(redis_client, TWITTER_RATE_LIMIT_EXPIRES_KEY)
+# Hash of limit, remaining, reset and updated (when the state was last
+# recorded) per twitter endpoint family, e.g. "users/:id/tweets".
+TWITTER_ENDPOINT_RATE_LIMIT_KEY = "twitter:rate_limit:%s"
 
+def record_twitter_rate_limit(redis_client: redis.Redis, rate_limit: twitter_utils.RateLimit):
+    key = TWITTER_ENDPOINT_RATE_LIMIT_KEY % rate_limit.endpoint
+    pipe = redis_client.pipeline()
+    pipe.hset(key, mapping=dict(limit=rate_limit.limit,
+                                remaining=rate_limit.remaining,
+                                reset=rate_limit.reset_epoch_seconds,
+                                updated=time.time()))
+    pipe.expireat(key, int(rate_limit.reset_epoch_seconds) + 1)
+    pipe.execute()
 
-def set_twitter_rate_limit_expires(redis_client: redis.Redis, exp: float):
-    redis_client.set(TWITTER_RATE_LIMIT_EXPIRES_KEY, exp)
+
+def track_twitter_rate_limits(redis_client: redis.Redis):
+    """
+        Record the rate limit headers of every twitter response in redis
+        so all processes see each endpoint's remaining budget. The hook
+        is global, so applications install it once per process with the
+        process's own client.
+    """
+    twitter_utils.set_rate_limit_hook(
+        lambda rate_limit: record_twitter_rate_limit(redis_client, rate_limit))
+
+
+def get_twitter_rate_limt_expires(redis_client: redis.Redis, endpoint: str = None,
+                                  pace: bool = False):
+    """
+        Seconds until a request may be sent. Without an endpoint only the
+        global rate limit is checked. With an endpoint family, its budget
+        is checked too. If pace is True, the remaining requests are spread
+        evenly until the window resets rather than sent in a burst.
+    """
+    wait = _get_rate_limit_time(redis_client, TWITTER_RATE_LIMIT_EXPIRES_KEY)
+    if endpoint is None:
+        return wait
+
+    state = redis_client.hgetall(TWITTER_ENDPOINT_RATE_LIMIT_KEY % endpoint)
+    if not state:
+        return wait
+
+    now = time.time()
+    reset = float(state[b'reset'])
+    remaining = int(state[b'remaining'])
+    if reset <= now:
+        return wait
+
+    if remaining <= 0:
+        return max(wait, reset - now)
+
+    if pace:
+        updated = float(state[b'updated'])
+        return max(wait, updated + (reset - updated) / remaining - now)
+
+    return wait
+
+
+def set_twitter_rate_limit_expires(redis_client: redis.Redis, exp: float, endpoint: str = None):
+    """
+        Block requests until exp. If an endpoint family is given, only
+        requests to that family are blocked.
+    """
+    if endpoint is None:
+        redis_client.set(TWITTER_RATE_LIMIT_EXPIRES_KEY, exp)
+        return
+
+    key = TWITTER_ENDPOINT_RATE_LIMIT_KEY % endpoint
+    pipe = redis_client.pipeline()
+    pipe.hset(key, mapping=dict(remaining=0, reset=exp, updated=time.time()))
+    pipe.expireat(key, int(exp) + 1)
+    pipe.execute()
+
+
+# Google NLP quota per method. Every worker process draws from the
+# same bucket in redis so together they stay under the quota.
+GOOGLE_NLP_REQUESTS_PER_MINUTE = {
+    "analyze_entities": float(os.getenv("GOOGLE_NLP_ENTITIES_PER_MINUTE", "600")),
+    "classify_text": float(os.getenv("GOOGLE_NLP_CLASSIFY_PER_MINUTE", "600")),
+}
+
+# Characters of tweets packed into each analyze_entities call by the
+# pipeline (0 sends one tweet per call). Google bills per 1000 characters.
+GOOGLE_NLP_ENTITY_BATCH_CHARS = int(os.getenv("GOOGLE_NLP_ENTITY_BATCH_CHARS", "1000"))
+
+GOOGLE_NLP_BUCKET_KEY = "google:token_bucket:%s"
+
+# Refill the bucket for the time elapsed since it was last updated, then
+# take up to ARGV[3] whole tokens. Returns the number of tokens granted
+# and, if fewer were granted than requested, the seconds until the next
+# token is available. Redis' clock is used so all hosts agree.
+_TOKEN_BUCKET_ACQUIRE = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+
+local granted = math.min(math.floor(tokens), requested)
+tokens = tokens - granted
+local wait = 0
+if granted < requested then
+    wait = (1 - tokens) / rate
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return {granted, tostring(wait)}
+"""
+
+_TOKEN_BUCKET_DRAIN = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+redis.call('HSET', KEYS[1], 'tokens', '0', 'updated', tostring(now))
+"""
+
+
+class TokenBucket:
+    """
+        A token bucket shared through redis. It refills at rate tokens per
+        second up to capacity, which defaults to one second of refill.
+    """
+
+    def __init__(self, redis_client: redis.Redis, key: str, rate: float, capacity: float = None):
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self._acquire = redis_client.register_script(_TOKEN_BUCKET_ACQUIRE)
+        self._drain = redis_client.register_script(_TOKEN_BUCKET_DRAIN)
+
+
+    def acquire(self, tokens: int = 1) -> tuple[int, float]:
+        """
+            Take up to tokens tokens. Returns how many were granted and
+            how many seconds until another one is available (0 if all
+            were granted).
+        """
+        granted, wait = self._acquire(keys=[self.key],
+                                      args=[self.rate, self.capacity, tokens])
+        return int(granted), float(wait)
+
+
+    def drain(self):
+        """Empty the bucket, e.g. after the API rejected a request."""
+        self._drain(keys=[self.key])
 
 
+def google_nlp_bucket(redis_client: redis.Redis, method: str,
+                      requests_per_minute: float = None) -> TokenBucket:
+    if requests_per_minute is None:
+        requests_per_minute = GOOGLE_NLP_REQUESTS_PER_MINUTE[method]
+
+    return TokenBucket(redis_client,
+                       GOOGLE_NLP_BUCKET_KEY % method,
+                       requests_per_minute / 60)
+
+
+GOOGLE_NLP_CACHE_KEY = "google:nlp_cache:%s"
+
+# Hash of "<method>:hits" and "<method>:misses" counts across all workers.
+GOOGLE_NLP_CACHE_STATS_KEY = "google:nlp_cache_stats"
+
+GOOGLE_NLP_CACHE_TTL = int(os.getenv("GOOGLE_NLP_CACHE_TTL", str(7 * 24 * 60 * 60)))
+
+
+class NLPResponseCache:
+    """
+        Content addressed cache of Google NLP responses, so identical text
+        (retweets, promos, re-scraped tweets) is only sent to the API once.
+        Responses are keyed by a hash of the method, language and
+        normalized text. They are stored in redis for ttl seconds with a
+        local LRU in front of it. With a ttl of 0 they are only kept in
+        the local LRU.
+    """
+
+    def __init__(self, redis_client: redis.Redis, ttl: int = None, local_size: int = 10000):
+        self._client = redis_client
+        self.ttl = GOOGLE_NLP_CACHE_TTL if ttl is None else ttl
+        self.local_size = local_size
+        self._local = OrderedDict()
+        # Counts not yet written to GOOGLE_NLP_CACHE_STATS_KEY. They are
+        # sent along with the next redis round trip.
+        self._pending_counts = defaultdict(int)
+
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+    def key(self, method: str, text: str, language: str = "en") -> str:
+        content = "|".join((method, language, self.normalize(text)))
+        return GOOGLE_NLP_CACHE_KEY % hashlib.sha256(content.encode()).hexdigest()
+
+
+    def _count(self, method: str, outcome: str):
+        self._pending_counts["%s:%s" % (method, outcome)] += 1
+
+
+    def _flush_counts(self, pipe):
+        for field, count in self._pending_counts.items():
+            pipe.hincrby(GOOGLE_NLP_CACHE_STATS_KEY, field, count)
+        self._pending_counts.clear()
+
+
+    def _local_put(self, key: str, response):
+        self._local[key] = response
+        self._local.move_to_end(key)
+        while len(self._local) > self.local_size:
+            self._local.popitem(last=False)
+
+
+    def get(self, method: str, text: str, language: str = "en"):
+        """Return the cached response, or None if text hasn't been seen."""
+        key = self.key(method, text, language)
+        if key in self._local:
+            self._local.move_to_end(key)
+            self._count(method, "hits")
+            return self._local[key]
+
+        pipe = self._client.pipeline(transaction=False)
+        pipe.get(key)
+        self._flush_counts(pipe)
+        data = pipe.execute()[0]
+        if data is None:
+            self._count(method, "misses")
+            return None
+
+        response = google_nlp.RESPONSE_TYPES[method].deserialize(data)
+        self._local_put(key, response)
+        self._count(method, "hits")
+        return response
+
+
+    def put(self, method: str, text: str, response, language: str = "en"):
+        key = self.key(method, text, language)
+        self._local_put(key, response)
+        pipe = self._client.pipeline(transaction=False)
+        if self.ttl:
+            pipe.set(key, google_nlp.RESPONSE_TYPES[method].serialize(response), ex=self.ttl)
+        self._flush_counts(pipe)
+        pipe.execute()
+
+
+    def stats(self) -> dict:
+        """Hits, misses and hit ratio per method, across all workers."""
+        pipe = self._client.pipeline(transaction=False)
+        self._flush_counts(pipe)
+        pipe.hgetall(GOOGLE_NLP_CACHE_STATS_KEY)
+        counts = pipe.execute()[-1]
+
+        stats = defaultdict(lambda: dict(hits=0, misses=0))
+        for field, count in counts.items():
+            method, outcome = field.decode().rsplit(":", 1)
+            stats[method][outcome] = int(count)
+        for method_stats in stats.values():
+            total = method_stats["hits"] + method_stats["misses"]
+            method_stats["hit_ratio"] = method_stats["hits"] / total if total else 0.0
+        return dict(stats)
+
 
 class Queues:
     """Namespace for redis queue names used by workers."""
@@ -59,21 +326,129 @@ class Queues:
     # Contains JSON serialized twitter_utils.Tweet objects
     ENTITY_ANALYSIS_REQUEST = "worker:analyze_tweet_entities"
 
-    # Contains JSON serialized EntityAnalysisResult objects
+    # Contains encoded EntityAnalysisResult payloads
     ENTITY_ANALYSIS_RESULTS = "db:store_entity_analysis_results"
 
+    # Contains encoded ClassificationRequest payloads
     CLASSIFICATION_REQUESTS = "worker:classify_user_tweets"
 
+    # Contains encoded ClassificationResult payloads
     CLASSIFICATION_RESULTS = "db:store_classification_results"
 
+    @classmethod
+    def all(cls) -> list[str]:
+        return [v for k, v in vars(cls).items() if k.isupper()]
+
+
+# Incremented by the DatabaseWorker every time it writes topics, so
+# readers can tell when what they cached from the database is stale.
+TOPICS_GENERATION_KEY = "db:topics_generation"
+
+
+# Queue payloads are written as PAYLOAD_MAGIC, a schema version byte and
+# a msgpack body. 0xc1 is never used by msgpack and can't start a JSON
+# document, so payloads queued before the codec existed still decode.
+#
+# Version 2: classification payloads carry tweet ids instead of tweets.
+PAYLOAD_MAGIC = b"\xc1"
+PAYLOAD_VERSION = 2
+
+
+class JsonCodec:
+    """Legacy JSON encoding, kept so mixed deployments can drain queues."""
+
+    name = "json"
+
+    def encode(self, payload) -> str:
+        return payload.to_json()
+
+    def decode(self, cls, data):
+        return cls.from_json(data)
+
+
+class MsgpackCodec:
+    """
+        Versioned msgpack encoding. Only stores the fields the
+        DatabaseWorker and NLP workers actually read.
+    """
+
+    name = "msgpack"
+
+    def encode(self, payload) -> bytes:
+        header = PAYLOAD_MAGIC + bytes([PAYLOAD_VERSION])
+        return header + msgpack.packb(payload.pack(), use_bin_type=True)
+
+    def decode(self, cls, data: bytes):
+        version = data[1]
+        if version > PAYLOAD_VERSION:
+            raise ValueError("Unsupported %s payload version %d" % (cls.__name__, version))
+        return cls.unpack(msgpack.unpackb(data[2:], raw=False), version)
+
+
+PAYLOAD_CODECS = {codec.name: codec for codec in (JsonCodec(), MsgpackCodec())}
+
+def get_payload_codec(name=None):
+    """
+        Return the codec used to write queue payloads. Defaults to the
+        QUEUE_PAYLOAD_CODEC environment variable, or msgpack.
+    """
+    name = name or os.environ.get("QUEUE_PAYLOAD_CODEC", MsgpackCodec.name)
+    try:
+        return PAYLOAD_CODECS[name]
+    except KeyError:
+        raise ValueError("Unknown queue payload codec %r" % name) from None
+
+def decode_payload(cls, data):
+    """Decode a queue payload written by any codec, detected from its first byte."""
+    if isinstance(data, str):
+        data = data.encode()
+
+    if data[:1] == PAYLOAD_MAGIC:
+        return PAYLOAD_CODECS[MsgpackCodec.name].decode(cls, data)
+    return PAYLOAD_CODECS[JsonCodec.name].decode(cls, data)
+
+
+class QueuePayload(abc.ABC):
+    """
+        Mixin for dataclasses passed between workers on redis queues.
+        Subclasses implement pack/unpack for the compact format and
+        to_json/from_json for the legacy one.
+    """
+
+    @abc.abstractmethod
+    def pack(self) -> list:
+        """The payload's fields as a list of msgpack-able values."""
+
+    @classmethod
+    @abc.abstractmethod
+    def unpack(cls, fields: list, version: int):
+        """Build a payload from fields packed by the given version."""
+
+    def encode(self, codec=None):
+        return get_payload_codec(codec).encode(self)
+
+    @classmethod
+    def decode(cls, data):
+        return decode_payload(cls, data)
+
 
 @dataclass
-class EntityAnalysisResult:
+class EntityAnalysisResult(QueuePayload):
     tweet: models.Tweet
     entities: list[google_nlp.Entity]
 
+    def pack(self):
+        return [self.tweet.id, [[e.name, int(e.type_)] for e in self.entities]]
+
+    @classmethod
+    def unpack(cls, fields, version):
+        tweet_id, entities = fields
+        return cls(tweet=models.Tweet(id=tweet_id),
+                   entities=[google_nlp.Entity(name=name, type_=type_)
+                             for name, type_ in entities])
+
     def to_json(self):
-        data = dict(tweet=model_to_dict(self.tweet, backrefs=True),
+        data = dict(tweet=model_to_dict(self.tweet, recurse=False),
                     entities=[google_nlp.Entity.to_dict(e) for e in self.entities])
 
         return json.dumps(data)
@@ -87,47 +462,215 @@ class EntityAnalysisResult:
 
 
 @dataclass
-class ClassificationRequest:
+class ClassificationRequest(QueuePayload):
+    """
+        A group of a user's tweets to classify together. Tweets are passed
+        by id along with their joined text, so a tweet that belongs to
+        several groups isn't copied into the queue several times.
+    """
     user_id: str
-    tweets: list[models.Tweet]
+    tweet_ids: list[str]
+    text: str
+
+    @classmethod
+    def from_tweets(cls, user_id: str, tweets: list[models.Tweet]):
+        return cls(user_id=user_id,
+                   tweet_ids=[t.id for t in tweets],
+                   text=" ".join([t.text for t in tweets]))
+
+    def pack(self):
+        return [self.user_id, self.tweet_ids, self.text]
+
+    @classmethod
+    def unpack(cls, fields, version):
+        if version == 1:
+            user_id, tweets = fields
+            return cls(user_id=user_id,
+                       tweet_ids=[tweet_id for tweet_id, _ in tweets],
+                       text=" ".join([text for _, text in tweets]))
+
+        user_id, tweet_ids, text = fields
+        return cls(user_id=user_id, tweet_ids=tweet_ids, text=text)
 
     def to_json(self):
-        data = dict(user_id=self.user_id,
-                    tweets=[model_to_dict(t) for t in self.tweets])
-        return json.dumps(data)
+        return json.dumps(dict(user_id=self.user_id,
+                               tweet_ids=self.tweet_ids,
+                               text=self.text))
 
     @classmethod
     def from_json(cls, data):
         data = json.loads(data)
-        tweets = [dict_to_model(models.Tweet, t) for t in data['tweets']]
-        user_id = data['user_id']
-        return cls(user_id=user_id, tweets=tweets)
+        if 'tweets' in data:
+            # Queued before tweets were passed by reference.
+            tweets = [dict_to_model(models.Tweet, t) for t in data['tweets']]
+            return cls.from_tweets(data['user_id'], tweets)
+
+        return cls(user_id=data['user_id'],
+                   tweet_ids=data['tweet_ids'],
+                   text=data['text'])
 
 
 @dataclass
-class ClassificationResult:
+class ClassificationResult(QueuePayload):
     user_id: str
     categories: list[google_nlp.ClassificationCategory]
-    tweets: list[models.Tweet]
+    tweet_ids: list[str]
+
+    def pack(self):
+        return [self.user_id,
+                [[c.name, c.confidence] for c in self.categories],
+                self.tweet_ids]
+
+    @classmethod
+    def unpack(cls, fields, version):
+        user_id, categories, tweet_ids = fields
+        cats = [google_nlp.ClassificationCategory(name=name, confidence=confidence)
+                for name, confidence in categories]
+        return cls(user_id=user_id, categories=cats, tweet_ids=tweet_ids)
 
     def to_json(self):
         cats = [google_nlp.ClassificationCategory.to_dict(c) for c in self.categories]
         return json.dumps(dict(user_id=self.user_id,
                                categories=cats,
-                               tweets=[model_to_dict(t) for t in self.tweets]))
+                               tweet_ids=self.tweet_ids))
 
     @classmethod
     def from_json(cls, data: str):
         data = json.loads(data)
         cats = [google_nlp.ClassificationCategory(**c) for c in data['categories']]
-        tweets = [dict_to_model(models.Tweet, t) for t in data['tweets']]
-        return cls(user_id=data['user_id'], categories=cats, tweets=tweets)
+        if 'tweets' in data:
+            # Queued before tweets were passed by reference.
+            tweet_ids = [t['id'] for t in data['tweets']]
+        else:
+            tweet_ids = data['tweet_ids']
+        return cls(user_id=data['user_id'], categories=cats, tweet_ids=tweet_ids)
 
 
 class RedisWorker:
+    """
+        Base class for workers that communicate over redis.
+
+        chunk_size bounds how many items are sent in one pipelined
+        round trip (or one multi-value command) when a worker queues
+        many items at once.
+
+        Metrics are labelled with the worker's STAGE.
+    """
 
-    def __init__(self, redis_client: redis.Redis):
+    STAGE = None
+
+    def __init__(self, redis_client: redis.Redis, chunk_size: int = 500):
         self._client = redis_client
+        self.chunk_size = chunk_size
+        self.metrics = metrics.Metrics(redis_client)
+
+
+    def wait_time(self) -> float:
+        """Seconds until this worker may call its API again."""
+        return 0
+
+
+    def rate_limit_wait(self) -> float:
+        """wait_time(), also recorded in the rate limit wait gauge."""
+        wait = max(self.wait_time(), 0)
+        self.metrics.set("pipeline_rate_limit_wait_seconds", wait, stage=self.STAGE)
+        return wait
+
+
+    def _processed(self, count: int, step: str):
+        """Count items a step finished with."""
+        if count:
+            self.metrics.inc("pipeline_items_processed_total", count,
+                             stage=self.STAGE, step=step)
+
+
+    def _pop_batch(self, key: str, count: int) -> list[bytes]:
+        """
+            Atomically remove and return up to count items from the
+            head of a list. LRANGE + LTRIM run in one MULTI/EXEC so
+            no other client can see or pop the same items.
+        """
+        pipe = self._client.pipeline()
+        pipe.lrange(key, 0, count - 1)
+        pipe.ltrim(key, count, -1)
+        items, _ = pipe.execute()
+        return items
+
+
+    def _drain_queue(self, key: str, count: int):
+        """
+            Generator yielding batches of up to count items from a
+            list until it is empty.
+        """
+        while True:
+            items = self._pop_batch(key, count)
+            if not items:
+                break
+            yield items
+
+
+def count_tokens(text: str) -> int:
+    """
+        Estimate the tokens Google counts in text. Punctuation counts as
+        tokens to Google, so this never overestimates.
+    """
+    return len(text.split())
+
+
+def plan_classification_documents(groups: dict, tokens: dict,
+                                  min_tokens: int = google_nlp.CLASSIFY_MIN_TOKENS):
+    """
+        Plan the classify_text calls for one user's tweets.
+
+        groups maps an entity name to the ids of the tweets that mention
+        it, in order, and tokens maps each tweet id to its token count.
+        Groups overlap when a tweet mentions several entities, so a
+        greedy set cover repeatedly picks the group with the most tweets
+        that aren't planned yet and makes a document of those tweets.
+        Documents under min_tokens are merged together until they reach
+        it. Whatever is left over is added to the last document.
+
+        Returns the documents as lists of tweet ids, and the ids of the
+        tweets that couldn't be put in a document that reaches
+        min_tokens. Tweets are only left out when all of them together
+        are under min_tokens.
+    """
+    position = {}
+    for ids in groups.values():
+        for tweet_id in ids:
+            position.setdefault(tweet_id, len(position))
+
+    remaining = {name: set(ids) for name, ids in groups.items() if ids}
+    documents = []
+    while remaining:
+        name = max(remaining, key=lambda n: len(remaining[n]))
+        ids = remaining.pop(name)
+        documents.append(sorted(ids, key=position.get))
+        for other in remaining.values():
+            other -= ids
+        remaining = {n: other for n, other in remaining.items() if other}
+
+    planned = []
+    merged = []
+    merged_tokens = 0
+    for doc in documents:
+        doc_tokens = sum(tokens[t] for t in doc)
+        if doc_tokens >= min_tokens:
+            planned.append(doc)
+            continue
+
+        merged.extend(doc)
+        merged_tokens += doc_tokens
+        if merged_tokens >= min_tokens:
+            planned.append(merged)
+            merged = []
+            merged_tokens = 0
+
+    if merged and planned:
+        planned[-1].extend(merged)
+        merged = []
+
+    return planned, merged
 
 
 class DatabaseWorker(RedisWorker):
@@ -135,13 +678,25 @@ class DatabaseWorker(RedisWorker):
         To avoid threading/race contention isuses, this single
         worker will handle all of the database operations that the
         other workers use queues to manage.
+
+        Results are drained from redis batch_size items at a time and
+        each batch is written to the database in a single transaction.
     """
 
+    STAGE = "database"
+
+    def __init__(self, *args, **kwargs):
+        self.batch_size = kwargs.pop("batch_size", 500)
+        super().__init__(*args, **kwargs)
+        self.topic_index = TopicIndex(self._client)
+
+
     def _get_pending_tweets_query(self):
         pending_tweet_ids = self._client.smembers(Queues.DB_TWEET_PROCESSING_PENDING)
         return models.Tweet.select().where(models.Tweet.id << pending_tweet_ids)
 
 
+    @metrics.timed()
     def store_scraped_tweets(self):
         """
             Store scraped user tweets in the database.
@@ -152,22 +707,30 @@ class DatabaseWorker(RedisWorker):
             After this is finished the last scraped time for the user should
             be updated.
         """
-        while True:
-            data = self._client.lpop(Queues.SCRAPE_USER_TWEETS_RESULTS)
-            if not data:
-                LOGGER.debug("No user tweets to store.")
-                break
+        stored = False
+        for batch in self._drain_queue(Queues.SCRAPE_USER_TWEETS_RESULTS, self.batch_size):
+            stored = True
+            tweets = [ScrapeUserTweetsWorker.deserialize_result(d) for d in batch]
+            LOGGER.debug("Storing %d scraped tweets.", len(tweets))
+
+            with models.atomic():
+                user_ids = models.add_tweets(tweets)
+                last_scraped = datetime.now().strftime(twitter_utils.DATE_FORMAT)
+                models.update_users(user_ids, last_scraped=last_scraped)
 
-            tweet = ScrapeUserTweetsWorker.deserialize_result(data)
-            LOGGER.debug("Storing tweet %s for user: %s", tweet.id, tweet.author_id)
+            unknown = {t.author_id for t in tweets} - user_ids
+            if unknown:
+                LOGGER.warning("Dropped tweets from unknown users: %s", ", ".join(unknown))
 
-            models.add_tweet(tweet)
-            user = models.User.get_by_id(tweet.author_id)
-            user.last_scraped = datetime.now().strftime(twitter_utils.DATE_FORMAT)
-            user.save()
-            self._client.srem(Queues.DB_USER_PROCESSING_PENDING, user.id)
+            if user_ids:
+                self._client.srem(Queues.DB_USER_PROCESSING_PENDING, *user_ids)
+            self._processed(len(tweets), "store_scraped_tweets")
 
+        if not stored:
+            LOGGER.debug("No user tweets to store.")
 
+
+    @metrics.timed()
     def queue_users_to_scrape(self):
         """
             Poll the database for users that should be scraped. Users should not
@@ -178,118 +741,195 @@ class DatabaseWorker(RedisWorker):
         last_week = datetime.now() - timedelta(days=7)
 
         pending_query = models.User.select().where(models.User.id.in_(pending_user_ids))
-        query = models.User.select().where(
+        query = models.User.select(models.User.id).where(
             ((models.User.last_scraped.is_null()) |
              (models.User.last_scraped <= last_week)) &
              ~(models.User.id << pending_query)
         )
-        for user in query: #pylint: disable=not-an-iterable
-            LOGGER.debug("Queuing user to scrape %s",  user.id)
-            data =  ScrapeUserTweetsWorker.serialize_request(user)
-            self._client.sadd(Queues.SCRAPE_USER_TWEETS_REQUEST, data)
-            self._client.sadd(Queues.DB_USER_PROCESSING_PENDING, user.id)
+        for users in chunked(query, self.chunk_size):
+            LOGGER.debug("Queuing %d users to scrape.", len(users))
+            pipe = self._client.pipeline(transaction=False)
+            pipe.sadd(Queues.SCRAPE_USER_TWEETS_REQUEST,
+                      *[ScrapeUserTweetsWorker.serialize_request(u) for u in users])
+            pipe.sadd(Queues.DB_USER_PROCESSING_PENDING, *[u.id for u in users])
+            pipe.execute()
+            self._processed(len(users), "queue_users_to_scrape")
 
 
+    @metrics.timed()
     def store_entity_analysis_results(self):
-        while True:
-            data = self._client.lpop(Queues.ENTITY_ANALYSIS_RESULTS)
-            if not data:
-                LOGGER.debug("No entity analysis results to store.")
-                break
+        stored = False
+        for batch in self._drain_queue(Queues.ENTITY_ANALYSIS_RESULTS, self.batch_size):
+            stored = True
+            results = [EntityAnalysisWorker.deserialize_result(d) for d in batch]
+            LOGGER.debug("Storing entity analysis for %d tweets.", len(results))
+
+            with models.atomic():
+                tweet_ids = {r.tweet.id for r in results}
+                query = models.Tweet.select(models.Tweet.id).where(
+                    models.Tweet.id << list(tweet_ids))
+                known_ids = {t.id for t in query}
 
-            result = EntityAnalysisWorker.deserialize_result(data)
-            tweet = models.Tweet.get_by_id(result.tweet.id)
-            LOGGER.debug("Storing entity analysis for tweet: %s", tweet.id)
-            for entity in result.entities:
-                ent_model, _ = models.Entity.get_or_create(name=entity.name,
-                                                           type=entity.type_.value)
-                models.TweetEntity.create(tweet=tweet, entity=ent_model)
-            self._client.srem(Queues.DB_TWEET_PROCESSING_PENDING, tweet.id)
-            tweet.analyzed = True
-            tweet.save()
+                keys = {(e.name, e.type_.value)
+                        for r in results if r.tweet.id in known_ids
+                        for e in r.entities}
+                entity_ids = models.get_entity_ids(keys) if keys else {}
 
+                rows = [(r.tweet.id, entity_ids[(e.name, e.type_.value)])
+                        for r in results if r.tweet.id in known_ids
+                        for e in r.entities]
+                models.add_tweet_entities(rows)
+                models.update_tweets(known_ids, analyzed=True)
 
+            self._client.srem(Queues.DB_TWEET_PROCESSING_PENDING, *tweet_ids)
+            self._processed(len(results), "store_entity_analysis_results")
+
+        if not stored:
+            LOGGER.debug("No entity analysis results to store.")
+
+
+    @metrics.timed()
     def queue_entity_analysis_requests(self):
         tweets = models.Tweet.select().where(
             (models.Tweet.analyzed >> False)
         )
-        for tweet in tweets: #pylint: disable=not-an-iterable
-            if self._client.sismember(Queues.DB_TWEET_PROCESSING_PENDING, tweet.id):
+        for batch in chunked(tweets, self.chunk_size):
+            pending = self._client.smismember(Queues.DB_TWEET_PROCESSING_PENDING,
+                                              [t.id for t in batch])
+            batch = [t for t, is_pending in zip(batch, pending) if not is_pending]
+            if not batch:
                 continue
-            LOGGER.debug("Queue tweet for entity analysis: %s", tweet.id)
-            request = EntityAnalysisWorker.serialize_request(tweet)
-            self._client.rpush(Queues.ENTITY_ANALYSIS_REQUEST, request)
-            self._client.sadd(Queues.DB_TWEET_PROCESSING_PENDING, tweet.id)
 
+            LOGGER.debug("Queue %d tweets for entity analysis.", len(batch))
+            pipe = self._client.pipeline(transaction=False)
+            pipe.rpush(Queues.ENTITY_ANALYSIS_REQUEST,
+                       *[EntityAnalysisWorker.serialize_request(t) for t in batch])
+            pipe.sadd(Queues.DB_TWEET_PROCESSING_PENDING, *[t.id for t in batch])
+            pipe.execute()
+            self._processed(len(batch), "queue_entity_analysis_requests")
 
-    def store_classification_results(self):
-        while True:
-            result = self._client.lpop(Queues.CLASSIFICATION_RESULTS)
-            if not result:
-                LOGGER.debug("No classification results to store.")
-                break
 
-            result = ClassificationResult.from_json(result)
-            LOGGER.debug("Storing classification results for user: %s", result.user_id)
-            user_model = models.User.get_by_id(result.user_id)
-            if result.categories:
-                for cat in result.categories:
-                    topic_model, created = models.Topic.get_or_create(name=cat.name)
-                    ut, created = models.UserTopic.get_or_create(user=user_model,
-                                                                 topic=topic_model)
-                    if not created:
-                        # We've detected this user's topic before,
-                        # increment the count
-                        ut.tweet_count += len(result.tweets)
-                    else:
-                        ut.tweet_count = len(result.tweets)
-
-                    ut.save()
-
-            ## Mark these tweets as classified so they don't get used
-            ## again.
-            for tweet in result.tweets:
-                self._client.srem(Queues.DB_TWEET_PROCESSING_PENDING, tweet.id)
-                t = models.Tweet.get_by_id(tweet.id)
-                t.classified = True
-                t.save()
+    @metrics.timed()
+    def store_classification_results(self):
+        stored = False
+        for batch in self._drain_queue(Queues.CLASSIFICATION_RESULTS, self.batch_size):
+            stored = True
+            results = [ClassificationResult.decode(d) for d in batch]
+            LOGGER.debug("Storing %d classification results.", len(results))
+
+            with models.atomic():
+                user_ids = {r.user_id for r in results}
+                profiles = list(TopicIndex.profile_query(user_ids))
+                known_ids = {p["id"] for p in profiles}
+
+                names = {c.name for r in results for c in r.categories}
+                topic_ids = models.get_topic_ids(names) if names else {}
+
+                # Sum counts per user topic so each row is written once
+                # per batch.
+                counts = defaultdict(int)
+                for result in results:
+                    if result.user_id not in known_ids:
+                        continue
+                    for cat in result.categories:
+                        key = (result.user_id, topic_ids[cat.name])
+                        counts[key] += len(result.tweet_ids)
+                models.increment_user_topics(counts)
+
+                ## Mark these tweets as classified so they don't get used
+                ## again.
+                tweet_ids = {i for r in results for i in r.tweet_ids}
+                models.update_tweets(tweet_ids, classified=True)
+
+            # Mirror the committed counts into the ranked index.
+            topic_names = {topic_id: name for name, topic_id in topic_ids.items()}
+            counted_ids = {user_id for user_id, _ in counts}
+            self.topic_index.increment(
+                {(user_id, topic_names[topic_id]): count
+                 for (user_id, topic_id), count in counts.items()},
+                [p for p in profiles if p["id"] in counted_ids])
+
+            if tweet_ids:
+                self._client.srem(Queues.DB_TWEET_PROCESSING_PENDING, *tweet_ids)
+            self._processed(len(results), "store_classification_results")
+
+        if stored:
+            self._client.incr(TOPICS_GENERATION_KEY)
+        else:
+            LOGGER.debug("No classification results to store.")
 
 
+    @metrics.timed()
     def queue_classification_requests(self):
         """
             Build the queue of twweets that should be classified to determine
             user's topics.
         """
 
-        ## Grab all the tweets and their entities.
+        ## Grab all the tweets and their entities in one query. A tweet
+        ## comes back once per entity (or once with no entity name).
         pending_tweet_ids = {s.decode() for s in self._client.smembers(Queues.DB_TWEET_PROCESSING_PENDING)}
-        query = models.Tweet.select().where(models.Tweet.classified >> False)
-
-        tweets_by_user = defaultdict(list)
-        for tweet in query: #pylint: disable=not-an-iterable
-            tweets_by_user[tweet.user_id].append(tweet)
-
-        mapping = defaultdict(list)
+        query = (models.Tweet.select(models.Tweet, models.Entity.name.alias("entity_name"))
+                             .join(models.TweetEntity, JOIN.LEFT_OUTER)
+                             .join(models.Entity, JOIN.LEFT_OUTER)
+                             .where(models.Tweet.classified >> False)
+                             .objects())
+
+        tweets_by_user = defaultdict(dict)
+        entities_by_tweet = defaultdict(list)
+        for row in query: #pylint: disable=not-an-iterable
+            tweets_by_user[row.user_id].setdefault(row.id, row)
+            if row.entity_name is not None:
+                entities_by_tweet[row.id].append(row.entity_name)
+
+        planned = []
+        claimed_tweet_ids = []
+        skipped_tweet_ids = []
+        naive_calls = 0
         for user_id, tweets in tweets_by_user.items():
-            all_analyzed = all([t.analyzed for t in tweets])
-            all_free = all([t.id not in pending_tweet_ids for t in tweets])
+            all_analyzed = all([t.analyzed for t in tweets.values()])
+            all_free = all([t.id not in pending_tweet_ids for t in tweets.values()])
 
             if all_analyzed and all_free:
-                for tweet in tweets:
-                    for tweet_entity in tweet.tweet_entities:
-                        key = (tweet.user_id, tweet_entity.entity.name)
-                        mapping[key].append(tweet)
-
-                    self._client.sadd(Queues.DB_TWEET_PROCESSING_PENDING, tweet.id)
+                groups = defaultdict(list)
+                for tweet in tweets.values():
+                    for entity_name in entities_by_tweet[tweet.id]:
+                        groups[entity_name].append(tweet.id)
+                naive_calls += len(groups)
+
+                tokens = {t.id: count_tokens(t.text) for t in tweets.values()}
+                documents, _ = plan_classification_documents(groups, tokens)
+                for doc in documents:
+                    planned.append((user_id, [tweets[t] for t in doc]))
+                    claimed_tweet_ids.extend(doc)
+
+                # Tweets without entities, or a user's tweets that are
+                # too short to classify, never will be, so mark them done
+                # without an API call.
+                skipped_tweet_ids.extend(set(tokens).difference(*documents))
             else:
                 LOGGER.debug("Not querying user tweets. Outstanding opreations required.")
 
-        for (user_id, _), tweets in mapping.items():
-            LOGGER.debug("Queuing classification request for user: %s", user_id)
-            request = ClassificationRequest(user_id=user_id, tweets=tweets)
-            self._client.rpush(Queues.CLASSIFICATION_REQUESTS,
-                               ClassificationWorker.serialize_request(request))
+        if naive_calls:
+            LOGGER.info("Planned %d classification calls (%d naive), skipped %d tweets.",
+                        len(planned), naive_calls, len(skipped_tweet_ids))
+
+        if skipped_tweet_ids:
+            models.update_tweets(skipped_tweet_ids, classified=True)
+
+        for ids in chunked(claimed_tweet_ids, self.chunk_size):
+            self._client.sadd(Queues.DB_TWEET_PROCESSING_PENDING, *ids)
 
+        for groups in chunked(planned, self.chunk_size):
+            requests = []
+            for user_id, tweets in groups:
+                LOGGER.debug("Queuing classification request for user: %s", user_id)
+                request = ClassificationRequest.from_tweets(user_id, tweets)
+                requests.append(ClassificationWorker.serialize_request(request))
+            self._client.rpush(Queues.CLASSIFICATION_REQUESTS, *requests)
+            self._processed(len(requests), "queue_classification_requests")
+
+    @metrics.timed()
     def process(self):
         self.store_scraped_tweets()
         self.store_entity_analysis_results()
@@ -299,6 +939,9 @@ class DatabaseWorker(RedisWorker):
         self.queue_entity_analysis_requests()
         self.queue_classification_requests()
 
+        LOGGER.debug("Intern cache stats. Entities: %s, Topics: %s",
+                     models.ENTITY_IDS.stats(), models.TOPIC_IDS.stats())
+
 
 class ScrapeUserTweetsWorker(RedisWorker):
     """
@@ -306,8 +949,14 @@ class ScrapeUserTweetsWorker(RedisWorker):
         scraped, this worker should queue the up for entity analysis.
     """
 
+    TWITTER_ENDPOINT = "users/:id/tweets"
+    STAGE = "scrape"
+
     def __init__(self, *args, **kwargs):
         self.tweet_count_per_fetch = kwargs.pop("tweet_count", 10)
+        # Spread requests over the rate limit window instead of
+        # using the whole budget up front.
+        self.pace = kwargs.pop("pace", True)
         super().__init__(*args, **kwargs)
 
 
@@ -322,7 +971,7 @@ class ScrapeUserTweetsWorker(RedisWorker):
 
 
     def scrape_user_tweets(self, user_id: str):
-        if get_twitter_rate_limt_expires(self._client) > 0:
+        if self.wait_time() > 0:
             ## Can't do anything waiting for the rate limit.
             LOGGER.debug("Not scraping user tweets. Waiting for rate limit to reset.")
             self._client.sadd(Queues.SCRAPE_USER_TWEETS_REQUEST, user_id)
@@ -337,14 +986,17 @@ class ScrapeUserTweetsWorker(RedisWorker):
         try:
             # TODO: Limit by last scraped date range.
             LOGGER.debug("Querying tweets for user.")
-            tweets = twitter_utils.get_user_tweets(user.id, limit=self.tweet_count_per_fetch)
+            with self.metrics.api_call("twitter", self.TWITTER_ENDPOINT):
+                tweets = twitter_utils.get_user_tweets(user.id, limit=self.tweet_count_per_fetch)
             for tweet in tweets:
                 self._client.rpush(
                     Queues.SCRAPE_USER_TWEETS_RESULTS,
                     json.dumps(tweet.to_dict())
                 )
+            self._processed(1, "scrape_user_tweets")
         except twitter_utils.TwitterRateLimitError as err:
-            set_twitter_rate_limit_expires(self._client, err.reset_epoch_seconds)
+            set_twitter_rate_limit_expires(self._client, err.reset_epoch_seconds,
+                                           endpoint=err.endpoint or self.TWITTER_ENDPOINT)
             self._client.sadd(Queues.SCRAPE_USER_TWEETS_REQUEST, user_id)
             LOGGER.debug("Rate limit hit.")
         except twitter_utils.TwitterRequestError as err:
@@ -352,8 +1004,14 @@ class ScrapeUserTweetsWorker(RedisWorker):
                          err.status_code, err.msg)
 
 
+    def wait_time(self) -> float:
+        """Seconds until this worker may call the API again."""
+        return get_twitter_rate_limt_expires(self._client, self.TWITTER_ENDPOINT, self.pace)
+
+
+    @metrics.timed()
     def process(self):
-        if get_twitter_rate_limt_expires(self._client) > 0:
+        if self.rate_limit_wait() > 0:
             ## Can't do anything waiting for the rate limit.
             LOGGER.debug("Not scraping user tweets. Waiting for rate limit to reset.")
             return "wait"
@@ -366,15 +1024,84 @@ class ScrapeUserTweetsWorker(RedisWorker):
             return False
 
 
-class EntityAnalysisWorker(RedisWorker):
+class GoogleNLPWorker(RedisWorker):
+    """
+        Base class for workers that call one of Google's NLP methods.
+        Calls are paced by the shared token bucket for NLP_METHOD.
+        When the API still rejects a call for exceeding the quota, the
+        bucket is drained so every worker backs off until it refills.
+    """
+
+    NLP_METHOD = None
+
+    def __init__(self, *args, **kwargs):
+        requests_per_minute = kwargs.pop("requests_per_minute", None)
+        self.nlp_cache = kwargs.pop("nlp_cache", None)
+        super().__init__(*args, **kwargs)
+        self.bucket = google_nlp_bucket(self._client, self.NLP_METHOD, requests_per_minute)
+        self._bucket_wait_until = 0
+
+
+    def _cached_response(self, text: str):
+        if self.nlp_cache is None:
+            return None
+        return self.nlp_cache.get(self.NLP_METHOD, text)
+
+
+    def _cache_response(self, text: str, response):
+        if self.nlp_cache is not None:
+            self.nlp_cache.put(self.NLP_METHOD, text, response)
+
+
+    def _api_call(self):
+        return self.metrics.api_call("google", self.NLP_METHOD)
+
+
+    def _acquire(self, count: int = 1) -> int:
+        """Take up to count tokens, returning the number granted."""
+        granted, wait = self.bucket.acquire(count)
+        if granted < count:
+            self._bucket_wait_until = time.time() + wait
+        return granted
+
+
+    def _quota_exceeded(self):
+        LOGGER.warning("Hit google rate limit calling %s.", self.NLP_METHOD)
+        self.bucket.drain()
+        self._bucket_wait_until = time.time() + 1 / self.bucket.rate
+
+
+    def wait_time(self) -> float:
+        """Seconds until this worker may call the API again."""
+        return max(get_google_rate_limit_expires(self._client),
+                   self._bucket_wait_until - time.time())
+
+
+class EntityAnalysisWorker(GoogleNLPWorker):
     """
         Peform entity analysis on tweets and stash the
         results for storage.
     """
 
+    NLP_METHOD = "analyze_entities"
+    STAGE = "entity"
+
+    # Requests popped at once in batch mode. They are packed into as
+    # many documents of batch_chars as needed.
+    MAX_BATCH_REQUESTS = 50
+
+    def __init__(self, *args, **kwargs):
+        # If set, pack as many tweets as fit in this many characters into
+        # each analyze_entities call. Google bills per 1000 characters
+        # and rate limits per request, so a 1000 character batch costs
+        # the same as a single tweet.
+        self.batch_chars = kwargs.pop("batch_chars", None)
+        super().__init__(*args, **kwargs)
+
+
     @classmethod
     def serialize_request(cls, tweet: models.Tweet) -> str:
-        return json.dumps(model_to_dict(tweet))
+        return json.dumps(model_to_dict(tweet, recurse=False))
 
 
     @classmethod
@@ -384,58 +1111,175 @@ class EntityAnalysisWorker(RedisWorker):
 
     @classmethod
     def deserialize_result(cls, data: str) -> EntityAnalysisResult:
-        return EntityAnalysisResult.from_json(data)
+        return EntityAnalysisResult.decode(data)
 
 
     def analyze_tweet(self, tweet: models.Tweet) -> EntityAnalysisResult:
+        response = self._cached_response(tweet.text)
+        if response is None:
+            if not self._acquire():
+                return False
+
+            try:
+                with self._api_call():
+                    response = google_nlp.LanguageClient.analyze_entities(tweet.text)
+            except google_nlp.InvalidArgument as err:
+                LOGGER.warning("Could not analyze tweet text: %s", err)
+                return EntityAnalysisResult(tweet=tweet, entities=[])
+            except google_nlp.ResourceExhausted:
+                self._quota_exceeded()
+                return False
+            self._cache_response(tweet.text, response)
+
+        return EntityAnalysisResult(tweet=tweet, entities=list(response.entities))
+
+
+    def analyze_request(self, tweet_req: bytes):
+        """
+            Analyze a request that has already been popped from
+            ENTITY_ANALYSIS_REQUEST. It is put back at the head of the
+            queue if the rate limit is hit.
+        """
+        if self.batch_chars:
+            # Batch it with whatever else is waiting.
+            more = self._client.lpop(Queues.ENTITY_ANALYSIS_REQUEST,
+                                     self.MAX_BATCH_REQUESTS - 1)
+            return self.analyze_requests([tweet_req] + (more or []))
+
+        tweet = self.deserialize_request(tweet_req)
+        LOGGER.debug("Analysing tweet: %s", tweet.id)
+        result = self.analyze_tweet(tweet)
+        if result is False:
+            self._client.lpush(Queues.ENTITY_ANALYSIS_REQUEST, tweet_req)
+            return "wait"
+
+        self._client.lpush(Queues.ENTITY_ANALYSIS_RESULTS, result.encode())
+        self._processed(1, "analyze_request")
+        return True
+
+
+    def analyze_tweets(self, tweets: list[models.Tweet]) -> list[EntityAnalysisResult]:
+        """
+            Analyze several tweets with a single analyze_entities call and
+            map the entities back to the tweet they were found in. Returns
+            a result for every tweet, or False if the rate limit was hit.
+
+            If the API rejects the document, the tweets are retried one at
+            a time so a single bad tweet only loses its own entities.
+        """
+        if not self._acquire():
+            return False
+
+        text, offsets = google_nlp.join_texts([t.text for t in tweets])
         try:
-            response = google_nlp.LanguageClient.analyze_entities(tweet.text)
-            return EntityAnalysisResult(tweet=tweet,
-                                        entities=list(response.entities))
-        except google_nlp.ResourceExhausted as err:
-            LOGGER.warning("Hit google rate limit when analyzing tweets.")
-            set_google_rate_limit_expires(self._client, time.time() + 60*15)
+            with self._api_call():
+                response = google_nlp.LanguageClient.analyze_entities(
+                    text, encoding_type=google_nlp.EncodingType.UTF32)
+        except google_nlp.InvalidArgument as err:
+            if len(tweets) == 1:
+                LOGGER.warning("Could not analyze tweet text: %s", err)
+                return [EntityAnalysisResult(tweet=tweets[0], entities=[])]
+
+            LOGGER.warning("Could not analyze %d tweets together, retrying them one "
+                           "at a time: %s", len(tweets), err)
+            results = []
+            for tweet in tweets:
+                result = self.analyze_tweets([tweet])
+                if result is False:
+                    # The tweets analyzed so far are in the response cache,
+                    # so they don't cost another call when they're retried.
+                    return False
+                results.extend(result)
+            return results
+        except google_nlp.ResourceExhausted:
+            self._quota_exceeded()
             return False
 
+        results = []
+        for tweet, entities in zip(tweets, google_nlp.split_entities(response.entities, offsets)):
+            self._cache_response(tweet.text, google_nlp.language_v1.AnalyzeEntitiesResponse(
+                entities=entities, language=response.language))
+            results.append(EntityAnalysisResult(tweet=tweet, entities=entities))
+        return results
+
+
+    def analyze_requests(self, tweet_reqs: list[bytes]):
+        """
+            Analyze requests that have already been popped from
+            ENTITY_ANALYSIS_REQUEST, packing up to batch_chars characters
+            of tweets into each API call. Requests that couldn't be sent
+            because of the rate limit or an error are put back at the head
+            of the queue in their original order.
+        """
+        results = []
+        unsent = list(tweet_reqs)
+        rc = True
+        try:
+            pending = []
+            for req in tweet_reqs:
+                tweet = self.deserialize_request(req)
+                response = self._cached_response(tweet.text)
+                if response is None:
+                    pending.append((req, tweet))
+                else:
+                    results.append(EntityAnalysisResult(tweet=tweet,
+                                                        entities=list(response.entities)))
+            unsent = [req for req, _ in pending]
+
+            texts = [tweet.text for _, tweet in pending]
+            for start, end in google_nlp.pack_texts(texts, self.batch_chars):
+                batch = [tweet for _, tweet in pending[start:end]]
+                LOGGER.debug("Analysing %d tweets in one request.", len(batch))
+                batch_results = self.analyze_tweets(batch)
+                if batch_results is False:
+                    rc = "wait"
+                    break
+                results.extend(batch_results)
+                unsent = [req for req, _ in pending[end:]]
+        finally:
+            if unsent:
+                self._client.lpush(Queues.ENTITY_ANALYSIS_REQUEST, *reversed(unsent))
+            if results:
+                self._client.lpush(Queues.ENTITY_ANALYSIS_RESULTS,
+                                   *[r.encode() for r in results])
+                self._processed(len(results), "analyze_request")
+        return rc
+
 
     def analyze_queue(self):
         # TODO: Rate limit checks
         tweet_req = self._client.lpop(Queues.ENTITY_ANALYSIS_REQUEST)
         if tweet_req:
-            tweet = dict_to_model(models.Tweet, json.loads(tweet_req))
-            LOGGER.debug("Analysing tweet: %s", tweet.id)
-            result = self.analyze_tweet(tweet)
-            if result is False:
-                self._client.lpush(Queues.ENTITY_ANALYSIS_REQUEST, tweet_req)
-                return "wait"
-            else:
-                self._client.lpush(Queues.ENTITY_ANALYSIS_RESULTS, result.to_json())
-                return True
+            return self.analyze_request(tweet_req)
         else:
             return False
 
 
+    @metrics.timed()
     def process(self):
-        if get_google_rate_limit_expires(self._client) > 0:
+        if self.rate_limit_wait() > 0:
             return "wait"
 
         return self.analyze_queue()
 
 
-class ClassificationWorker(RedisWorker):
+class ClassificationWorker(GoogleNLPWorker):
     """
         Service classification jobs and stash results
         for persistance
     """
 
+    NLP_METHOD = "classify_text"
+    STAGE = "classify"
+
     @classmethod
     def serialize_request(cls, request: ClassificationRequest):
-        return request.to_json()
+        return request.encode()
 
 
     @classmethod
     def deserialize_result(cls, data: str):
-        return ClassificationResult.from_json(data)
+        return ClassificationResult.decode(data)
 
 
     def classify_user_tweets(self):
@@ -443,33 +1287,292 @@ class ClassificationWorker(RedisWorker):
         if not req:
             return False
 
-        request = ClassificationRequest.from_json(req)
+        return self.classify_request(req)
+
+
+    def classify_request(self, req: bytes):
+        """
+            Classify a request that has already been popped from
+            CLASSIFICATION_REQUESTS. It is put back at the head of the
+            queue if the rate limit is hit.
+        """
+        request = ClassificationRequest.decode(req)
+        results = self._cached_response(request.text)
+        if results is not None:
+            cr = ClassificationResult(user_id=request.user_id,
+                                      categories=results.categories,
+                                      tweet_ids=request.tweet_ids)
+            self._client.rpush(Queues.CLASSIFICATION_RESULTS, cr.encode())
+            self._processed(1, "classify_request")
+            return True
+
+        if not self._acquire():
+            self._client.lpush(Queues.CLASSIFICATION_REQUESTS, req)
+            return "wait"
 
         LOGGER.debug("Classifying tweets from user: %s", request.user_id)
-        tweet_text = " ".join([t.text for t in request.tweets])
         try:
-            results = google_nlp.LanguageClient.classify_text(tweet_text)
+            with self._api_call():
+                results = google_nlp.LanguageClient.classify_text(request.text)
+            self._cache_response(request.text, results)
             cr = ClassificationResult(user_id = request.user_id,
                                         categories=results.categories,
-                                        tweets=request.tweets)
+                                        tweet_ids=request.tweet_ids)
         except google_nlp.InvalidArgument as err:
             LOGGER.warning("Could not classify tweet text: %s", err)
             cr = ClassificationResult(user_id=request.user_id,
                                       categories=[],
-                                      tweets=request.tweets)
-        except google_nlp.ResourceExhausted as err:
-            LOGGER.warning("Hit google rate limit when classifying tweets.")
+                                      tweet_ids=request.tweet_ids)
+        except google_nlp.ResourceExhausted:
             self._client.lpush(Queues.CLASSIFICATION_REQUESTS, req)
-            set_google_rate_limit_expires(self._client, time.time() + 60*15)
+            self._quota_exceeded()
             return "wait"
 
 
-        self._client.rpush(Queues.CLASSIFICATION_RESULTS, cr.to_json())
+        self._client.rpush(Queues.CLASSIFICATION_RESULTS, cr.encode())
+        self._processed(1, "classify_request")
         return True
 
 
+    @metrics.timed()
     def process(self):
-        if get_google_rate_limit_expires(self._client) > 0:
+        if self.rate_limit_wait() > 0:
             return "wait"
 
         return self.classify_user_tweets()
+
+
+
+class AsyncNLPWorker(GoogleNLPWorker, abc.ABC):
+    """
+        Base class for asyncio workers that keep up to concurrency NLP
+        requests in flight at once. Requests are popped from
+        REQUEST_QUEUE in batches with LPOP key count, and subclasses
+        implement handle_request_async() to service one of them.
+
+        Redis is still accessed with the blocking client. Those calls are
+        short compared to the NLP round trips being overlapped.
+    """
+
+    REQUEST_QUEUE = None
+
+    # How long to sleep when there is no work in the queue.
+    IDLE_WAIT = 0.5
+
+    # Times a request that raised is tried before it is given up on.
+    MAX_REQUEST_ATTEMPTS = 3
+
+    def __init__(self, *args, **kwargs):
+        self.concurrency = kwargs.pop("concurrency", 10)
+        super().__init__(*args, **kwargs)
+        # Failed attempts of requests that are being retried.
+        self._failures = {}
+
+
+    def create_client(self):
+        return google_nlp.create_async_client()
+
+
+    @abc.abstractmethod
+    async def handle_request_async(self, client, req: bytes):
+        """Send req to the NLP API and push its result."""
+
+
+    @abc.abstractmethod
+    def handle_cached(self, req: bytes) -> bool:
+        """
+            Answer req from the NLP response cache. Returns False if the
+            response isn't cached and the API has to be called.
+        """
+
+
+    @abc.abstractmethod
+    def handle_failed(self, req: bytes):
+        """
+            Push an empty result for a request that kept failing, so it
+            is still stored and doesn't stay pending.
+        """
+
+
+    def _request_done(self, req: bytes, err: BaseException):
+        if err is None:
+            self._failures.pop(req, None)
+            return
+
+        attempts = self._failures.pop(req, 0) + 1
+        if attempts < self.MAX_REQUEST_ATTEMPTS:
+            LOGGER.warning("NLP request failed, retrying (attempt %d): %s", attempts, err)
+            self._failures[req] = attempts
+            self._client.rpush(self.REQUEST_QUEUE, req)
+        else:
+            LOGGER.error("NLP request failed %d times, giving up: %s", attempts, err)
+            self.handle_failed(req)
+
+
+    async def run_async(self, client=None, drain=False, stop: asyncio.Event = None):
+        """
+            Service requests until stop is set, then wait for the requests
+            in flight and return. If drain is True, also return once the
+            queue is empty and every request in flight is done.
+        """
+        if client is None:
+            client = self.create_client()
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        in_flight = set()
+
+        def done(req, task):
+            in_flight.discard(task)
+            semaphore.release()
+            if not task.cancelled():
+                self._request_done(req, task.exception())
+
+        while True:
+            if stop is not None and stop.is_set():
+                if in_flight:
+                    await asyncio.wait(in_flight)
+                self.metrics.flush()
+                return
+
+            wait = self.rate_limit_wait()
+            if wait > 0:
+                LOGGER.debug("Waiting %s for the google rate limit to expire.", wait)
+                await asyncio.sleep(min(wait, self.IDLE_WAIT))
+                continue
+
+            # Only pop as many requests as there are free slots.
+            free = self.concurrency - len(in_flight)
+            reqs = self._client.lpop(self.REQUEST_QUEUE, free) if free else None
+            if not reqs:
+                if in_flight:
+                    await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                elif drain:
+                    self.metrics.flush()
+                    return
+                else:
+                    await asyncio.sleep(self.IDLE_WAIT)
+                continue
+
+            # Answer what we can from the cache without spending tokens.
+            if self.nlp_cache is not None:
+                reqs = [req for req in reqs if not self.handle_cached(req)]
+                if not reqs:
+                    continue
+
+            # Put back whatever the token bucket won't let us send yet.
+            granted = self._acquire(len(reqs))
+            if granted < len(reqs):
+                self._client.lpush(self.REQUEST_QUEUE, *reversed(reqs[granted:]))
+                reqs = reqs[:granted]
+
+            for req in reqs:
+                await semaphore.acquire()
+                task = asyncio.create_task(self.handle_request_async(client, req))
+                in_flight.add(task)
+                task.add_done_callback(functools.partial(done, req))
+
+
+class AsyncEntityAnalysisWorker(AsyncNLPWorker):
+    """
+        asyncio version of the EntityAnalysisWorker. Results are pushed
+        to ENTITY_ANALYSIS_RESULTS in the same format.
+    """
+
+    REQUEST_QUEUE = Queues.ENTITY_ANALYSIS_REQUEST
+    NLP_METHOD = "analyze_entities"
+    STAGE = "entity"
+
+    def handle_cached(self, req: bytes) -> bool:
+        tweet = EntityAnalysisWorker.deserialize_request(req)
+        response = self._cached_response(tweet.text)
+        if response is None:
+            return False
+
+        result = EntityAnalysisResult(tweet=tweet, entities=list(response.entities))
+        self._client.lpush(Queues.ENTITY_ANALYSIS_RESULTS, result.encode())
+        self._processed(1, "analyze_request")
+        return True
+
+
+    async def handle_request_async(self, client, req: bytes):
+        tweet = EntityAnalysisWorker.deserialize_request(req)
+        LOGGER.debug("Analysing tweet: %s", tweet.id)
+        try:
+            with self._api_call():
+                response = await client.analyze_entities(tweet.text)
+            self._cache_response(tweet.text, response)
+            entities = list(response.entities)
+        except google_nlp.InvalidArgument as err:
+            LOGGER.warning("Could not analyze tweet text: %s", err)
+            entities = []
+        except google_nlp.ResourceExhausted:
+            self._client.lpush(self.REQUEST_QUEUE, req)
+            self._quota_exceeded()
+            return "wait"
+
+        result = EntityAnalysisResult(tweet=tweet, entities=entities)
+        self._client.lpush(Queues.ENTITY_ANALYSIS_RESULTS, result.encode())
+        self._processed(1, "analyze_request")
+        return True
+
+
+    def handle_failed(self, req: bytes):
+        tweet = EntityAnalysisWorker.deserialize_request(req)
+        result = EntityAnalysisResult(tweet=tweet, entities=[])
+        self._client.lpush(Queues.ENTITY_ANALYSIS_RESULTS, result.encode())
+
+
+class AsyncClassificationWorker(AsyncNLPWorker):
+    """
+        asyncio version of the ClassificationWorker. Results are pushed
+        to CLASSIFICATION_RESULTS in the same format.
+    """
+
+    REQUEST_QUEUE = Queues.CLASSIFICATION_REQUESTS
+    NLP_METHOD = "classify_text"
+    STAGE = "classify"
+
+    def handle_cached(self, req: bytes) -> bool:
+        request = ClassificationRequest.decode(req)
+        response = self._cached_response(request.text)
+        if response is None:
+            return False
+
+        cr = ClassificationResult(user_id=request.user_id,
+                                  categories=response.categories,
+                                  tweet_ids=request.tweet_ids)
+        self._client.rpush(Queues.CLASSIFICATION_RESULTS, cr.encode())
+        self._processed(1, "classify_request")
+        return True
+
+
+    async def handle_request_async(self, client, req: bytes):
+        request = ClassificationRequest.decode(req)
+        LOGGER.debug("Classifying tweets from user: %s", request.user_id)
+        try:
+            with self._api_call():
+                response = await client.classify_text(request.text)
+            self._cache_response(request.text, response)
+            categories = response.categories
+        except google_nlp.InvalidArgument as err:
+            LOGGER.warning("Could not classify tweet text: %s", err)
+            categories = []
+        except google_nlp.ResourceExhausted:
+            self._client.lpush(self.REQUEST_QUEUE, req)
+            self._quota_exceeded()
+            return "wait"
+
+        cr = ClassificationResult(user_id=request.user_id,
+                                  categories=categories,
+                                  tweet_ids=request.tweet_ids)
+        self._client.rpush(Queues.CLASSIFICATION_RESULTS, cr.encode())
+        self._processed(1, "classify_request")
+        return True
+
+
+    def handle_failed(self, req: bytes):
+        request = ClassificationRequest.decode(req)
+        cr = ClassificationResult(user_id=request.user_id,
+                                  categories=[],
+                                  tweet_ids=request.tweet_ids)
+        self._client.rpush(Queues.CLASSIFICATION_RESULTS, cr.encode())
@@ -0,0 +1,72 @@
+"""
+    Smoke test for the pipeline benchmark.
+"""
+from pathlib import Path
+import sys
+import tempfile
+import unittest
+
+from ec601_proj2 import google_nlp, twitter_utils, workers
+
+from .test_workers import RedisServerHelper
+
+# The benchmark imports classify_user_tweets as a script next to it.
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent / "applications"))
+import benchmark_pipeline # pylint: disable=wrong-import-position
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        RedisServerHelper.start()
+
+
+    @classmethod
+    def tearDownClass(cls):
+        RedisServerHelper.stop()
+
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+
+
+    def _args(self, *argv):
+        return benchmark_pipeline.parse_args(
+            ["--users", "3", "--tweets-per-user", "5", "--twitter-latency", "0",
+             "--nlp-latency", "0", "--timeout", "60", "--redis-host", "127.0.0.1",
+             "--redis-port", "6379", "--flush", *argv])
+
+
+    def _services(self):
+        # Read the module dict so the lazy Google client isn't created.
+        return (twitter_utils.V2_API, twitter_utils._RATE_LIMIT_HOOK,
+                vars(google_nlp).get("LanguageClient"),
+                dict(workers.GOOGLE_NLP_REQUESTS_PER_MINUTE))
+
+
+    def test_run_benchmark(self):
+        services = self._services()
+        report = benchmark_pipeline.run_benchmark(self._args("--nlp-requests-per-minute", "6000"))
+        # The fakes are only swapped in while the benchmark runs.
+        self.assertEqual(self._services(), services)
+        self.assertEqual(report["users"], dict(seeded=3, completed=3))
+        self.assertEqual(report["tweets"], 15)
+        self.assertEqual(report["twitter"]["requests"], 3)
+        self.assertEqual(set(report["latency_seconds"]),
+                         {"p50", "p90", "p99", "max", "mean"})
+        for stage in ("scrape", "entity", "classify"):
+            self.assertGreater(report["stages"][stage]["consumed"], 0, stage)
+
+
+    def test_existing_database(self):
+        database = Path(self.workdir.name) / "bench.db"
+        database.write_text("not a database")
+        with self.assertRaises(RuntimeError):
+            benchmark_pipeline.run_benchmark(self._args("--database", str(database)))
+        self.assertEqual(database.read_text(), "not a database")
+
+        report = benchmark_pipeline.run_benchmark(
+            self._args("--database", str(database), "--overwrite-database"))
+        self.assertEqual(report["users"]["completed"], 3)
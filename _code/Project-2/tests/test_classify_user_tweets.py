@@ -0,0 +1,180 @@
+"""
+    Unit tests for the classification pipeline application.
+"""
+import unittest
+from unittest import mock
+
+from applications import classify_user_tweets
+from applications.classify_user_tweets import (
+    ClassifyUsers,
+    WorkerSupervisor,
+    parse_worker_counts
+)
+from ec601_proj2.workers import Queues
+
+from .test_workers import DatabaseTestCase
+
+
+class ParseWorkerCountsTests(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_worker_counts("scrape=2, entity=8,classify=4"),
+                         dict(scrape=2, entity=8, classify=4))
+        self.assertEqual(parse_worker_counts("entity=1"), dict(entity=1))
+
+
+    def test_invalid(self):
+        for spec in ("", "scrape", "scrape=", "scrape=two", "scrape=0", "entity=-1",
+                     "database=1", "scrape=1,tweets=2"):
+            with self.assertRaises(ValueError, msg=spec):
+                parse_worker_counts(spec)
+
+
+class FakeProcess:
+
+    pids = 100
+
+    def __init__(self, target=None, args=(), name=None, daemon=None):
+        self.name = name
+        self.pid = None
+        self.exitcode = None
+        self.alive = False
+
+
+    def start(self):
+        FakeProcess.pids += 1
+        self.pid = FakeProcess.pids
+        self.alive = True
+
+
+    def is_alive(self):
+        return self.alive
+
+
+    def exit(self, code):
+        self.alive = False
+        self.exitcode = code
+
+
+class WorkerSupervisorTests(unittest.TestCase):
+
+    def setUp(self):
+        patch = mock.patch.object(classify_user_tweets.multiprocessing, "Process", FakeProcess)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.supervisor = WorkerSupervisor(mock.Mock(), None, dict(scrape=2, entity=1))
+        for stage, count in self.supervisor.counts.items():
+            self.supervisor._processes[stage] = [self.supervisor._start_process(stage)
+                                                 for _ in range(count)]
+
+
+    def _pids(self, stage):
+        return [p.pid for p in self.supervisor._processes[stage]]
+
+
+    def test_restart_exited_workers(self):
+        scrape = self._pids("scrape")
+        entity = self._pids("entity")
+        self.supervisor._processes["scrape"][0].exit(1)
+        self.supervisor._last_start.clear()
+
+        self.supervisor._check_processes()
+        procs = self.supervisor._processes["scrape"]
+        self.assertEqual(len(procs), 2)
+        self.assertTrue(all(p.is_alive() for p in procs))
+        self.assertEqual(self._pids("scrape")[0], scrape[1])
+        self.assertNotIn(self._pids("scrape")[1], scrape)
+        self.assertEqual(self._pids("entity"), entity)
+
+
+    def test_restart_delay(self):
+        self.supervisor._processes["entity"][0].exit(1)
+
+        # The stage was just started, so it isn't restarted yet.
+        self.supervisor._check_processes()
+        self.assertEqual(self.supervisor._processes["entity"], [])
+
+        self.supervisor._last_start["entity"] -= WorkerSupervisor.RESTART_DELAY
+        self.supervisor._check_processes()
+        self.assertEqual(len(self.supervisor._processes["entity"]), 1)
+        self.assertTrue(self.supervisor._processes["entity"][0].is_alive())
+
+
+class StopLoop(Exception):
+    pass
+
+
+class EventDrivenTests(DatabaseTestCase):
+
+    # Queue each item is pushed to, and the worker method that should
+    # handle it.
+    CONSUMERS = {
+        Queues.SCRAPE_USER_TWEETS_RESULTS: ("db_worker", "store_scraped_tweets"),
+        Queues.ENTITY_ANALYSIS_REQUEST: ("entity_worker", "analyze_request"),
+        Queues.ENTITY_ANALYSIS_RESULTS: ("db_worker", "store_entity_analysis_results"),
+        Queues.CLASSIFICATION_REQUESTS: ("classify_worker", "classify_request"),
+        Queues.CLASSIFICATION_RESULTS: ("db_worker", "store_classification_results"),
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.classifier = ClassifyUsers(self.redis_client, self.database)
+        self.mocks = {}
+        for worker in ("db_worker", "twitter_worker", "entity_worker", "classify_worker"):
+            worker = getattr(self.classifier, worker)
+            self._patch(worker, "process", return_value=False)
+        for queue, (worker, method) in self.CONSUMERS.items():
+            # The loop runs until an item reaches its consumer.
+            self.mocks[queue] = self._patch(getattr(self.classifier, worker), method,
+                                            side_effect=StopLoop)
+        self._patch(self.classifier.db_worker, "queue_entity_analysis_requests")
+        self.queue_classification = self._patch(self.classifier.db_worker,
+                                                "queue_classification_requests")
+
+
+    def _patch(self, obj, name, **kwargs):
+        patch = mock.patch.object(obj, name, **kwargs)
+        self.addCleanup(patch.stop)
+        return patch.start()
+
+
+    def _run(self):
+        with self.assertRaises(StopLoop):
+            self.classifier._run_event_driven()
+
+
+    def test_dispatch(self):
+        for queue, consumer in self.mocks.items():
+            self.redis_client.rpush(queue, b"item")
+            self._run()
+            consumer.assert_called_once()
+            if queue in (Queues.ENTITY_ANALYSIS_REQUEST, Queues.CLASSIFICATION_REQUESTS):
+                consumer.assert_called_once_with(b"item")
+            else:
+                # Results are put back for the database worker to drain.
+                self.assertEqual(self.redis_client.lrange(queue, 0, -1), [b"item"])
+                self.redis_client.delete(queue)
+
+        for queue, consumer in self.mocks.items():
+            self.assertEqual(consumer.call_count, 1, queue)
+
+
+    def test_rate_limited_queue_not_popped(self):
+        self._patch(self.classifier.entity_worker, "wait_time", return_value=60)
+        self.assertNotIn(Queues.ENTITY_ANALYSIS_REQUEST, self.classifier._blocking_keys())
+
+        self.redis_client.rpush(Queues.ENTITY_ANALYSIS_REQUEST, b"entity")
+        self.redis_client.rpush(Queues.CLASSIFICATION_REQUESTS, b"classify")
+        self._run()
+        self.mocks[Queues.CLASSIFICATION_REQUESTS].assert_called_once_with(b"classify")
+        self.mocks[Queues.ENTITY_ANALYSIS_REQUEST].assert_not_called()
+        self.assertEqual(self.redis_client.llen(Queues.ENTITY_ANALYSIS_REQUEST), 1)
+
+
+    def test_entity_results_dont_queue_classification(self):
+        store = self.mocks[Queues.ENTITY_ANALYSIS_RESULTS]
+        store.side_effect = None
+        for _ in range(3):
+            self.classifier._dispatch(Queues.ENTITY_ANALYSIS_RESULTS.encode(), b"item")
+        self.assertEqual(store.call_count, 3)
+        self.queue_classification.assert_not_called()
@@ -5,7 +5,7 @@ import os
 import unittest
 import peewee
 
-from ec601_proj2 import models
+from ec601_proj2 import migrations, models
 from ec601_proj2 import twitter_utils
 
 DB_FILENAME = "test.db"
@@ -40,6 +40,24 @@ class DatabaseTests(unittest.TestCase):
             self.assertEqual(getattr(user, attr), getattr(twitter_user, attr))
 
 
+    def test_add_users(self):
+        def twitter_user(user_id):
+            return twitter_utils.TwitterUser(id=user_id, name="User %s" % user_id,
+                                             username="user%s" % user_id,
+                                             description="", verified=False)
+
+        models.create_user(twitter_user("1"))
+
+        # Known users and repeats within the page are skipped.
+        page = [twitter_user(i) for i in ("1", "2", "3", "2")]
+        new_users = models.add_users(page)
+        self.assertEqual([u.id for u in new_users], ["2", "3"])
+        self.assertEqual(models.User.select().count(), 3)
+        self.assertEqual(models.User.get_by_id("3").username, "user3")
+
+        self.assertEqual(models.add_users(page), [])
+
+
     def test_create_tweet(self):
         twitter_user = twitter_utils.TwitterUser(
             id="5678",
@@ -153,3 +171,119 @@ class DatabaseTests(unittest.TestCase):
         user_model = models.User.get_by_id(twitter_user.id)
         self.assertEqual(len(user_model.user_topics), 1)
         self.assertEqual(user_model.user_topics[0].topic.name, topic_name)
+
+
+    def test_topic_unique(self):
+        topic_name = "/Arts & Entertainment"
+        models.Topic.create(name=topic_name)
+        self.assertRaises(
+            peewee.IntegrityError,
+            models.Topic.create,
+            name=topic_name
+        )
+
+
+    def test_intern_cache_lru(self):
+        cache = models.InternCache(maxsize=2)
+        loader = lambda keys: {k: len(k) for k in keys}
+
+        ids = cache.resolve(["a", "bb"], loader)
+        self.assertEqual(ids, {"a": 1, "bb": 2})
+        self.assertEqual(cache.stats(), dict(hits=0, misses=2, size=2))
+
+        cache.resolve(["a"], loader)
+        cache.resolve(["ccc"], loader)
+        # "bb" was the least recently used entry.
+        self.assertIsNone(cache.get("bb"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 3)
+
+
+    def test_get_entity_ids(self):
+        existing = models.Entity.create(name="Twitter", type=1)
+        models.warm_intern_caches()
+        # The counters aren't reset with the cache.
+        hits, misses = models.ENTITY_IDS.hits, models.ENTITY_IDS.misses
+
+        keys = {("Twitter", 1), ("Biden", 1)}
+        ids = models.get_entity_ids(keys)
+        self.assertEqual(ids[("Twitter", 1)], existing.id)
+        self.assertEqual(models.Entity.get_by_id(ids[("Biden", 1)]).name, "Biden")
+        self.assertEqual(models.ENTITY_IDS.hits - hits, 1)
+        self.assertEqual(models.ENTITY_IDS.misses - misses, 1)
+
+        self.assertEqual(models.get_entity_ids(keys), ids)
+        self.assertEqual(models.ENTITY_IDS.hits - hits, 3)
+
+
+# Schema of database files created before migrations existed.
+VERSION_0_SCHEMA = [
+    'CREATE TABLE "entity" ("id" INTEGER NOT NULL PRIMARY KEY, "name" VARCHAR(255) NOT NULL, "type" INTEGER NOT NULL)',
+    'CREATE UNIQUE INDEX "entity_name_type" ON "entity" ("name", "type")',
+    'CREATE TABLE "topic" ("id" INTEGER NOT NULL PRIMARY KEY, "name" VARCHAR(255) NOT NULL)',
+    'CREATE TABLE "user" ("id" VARCHAR(255) NOT NULL PRIMARY KEY, "name" VARCHAR(255) NOT NULL, "username" VARCHAR(255) NOT NULL, "url" VARCHAR(255), "description" VARCHAR(255), "verified" INTEGER NOT NULL, "last_scraped" DATETIME, "scraped_following" INTEGER NOT NULL, "protected" INTEGER NOT NULL)',
+    'CREATE UNIQUE INDEX "user_username" ON "user" ("username")',
+    'CREATE TABLE "tweet" ("id" VARCHAR(255) NOT NULL PRIMARY KEY, "user_id" VARCHAR(255) NOT NULL, "created_at" DATETIME NOT NULL, "text" VARCHAR(255) NOT NULL, "analyzed" INTEGER NOT NULL, "classified" INTEGER NOT NULL, FOREIGN KEY ("user_id") REFERENCES "user" ("id"))',
+    'CREATE INDEX "tweet_user_id" ON "tweet" ("user_id")',
+    'CREATE TABLE "tweetentity" ("id" INTEGER NOT NULL PRIMARY KEY, "tweet_id" VARCHAR(255) NOT NULL, "entity_id" INTEGER NOT NULL, FOREIGN KEY ("tweet_id") REFERENCES "tweet" ("id"), FOREIGN KEY ("entity_id") REFERENCES "entity" ("id"))',
+    'CREATE INDEX "tweetentity_tweet_id" ON "tweetentity" ("tweet_id")',
+    'CREATE INDEX "tweetentity_entity_id" ON "tweetentity" ("entity_id")',
+    'CREATE TABLE "usertopic" ("id" INTEGER NOT NULL PRIMARY KEY, "user_id" VARCHAR(255) NOT NULL, "topic_id" INTEGER NOT NULL, "tweet_count" REAL NOT NULL, "user_identified" INTEGER NOT NULL, FOREIGN KEY ("user_id") REFERENCES "user" ("id"), FOREIGN KEY ("topic_id") REFERENCES "topic" ("id"))',
+    'CREATE INDEX "usertopic_user_id" ON "usertopic" ("user_id")',
+    'CREATE INDEX "usertopic_topic_id" ON "usertopic" ("topic_id")',
+]
+
+
+class MigrationTests(unittest.TestCase):
+
+    def tearDown(self):
+        for filename in (DB_FILENAME, "fresh.db"):
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+
+    def _schema(self, database):
+        cursor = database.execute_sql(
+            'SELECT "name", "sql" FROM "sqlite_master" WHERE "sql" IS NOT NULL ORDER BY "name"')
+        return cursor.fetchall()
+
+
+    def test_new_database(self):
+        database = models.init_db(DB_FILENAME)
+        self.assertEqual(database.user_version, migrations.SCHEMA_VERSION)
+        self.assertEqual(database.pragma("journal_mode"), "wal")
+        database.close()
+
+
+    def test_migrate_version_0(self):
+        database = peewee.SqliteDatabase(DB_FILENAME)
+        for sql in VERSION_0_SCHEMA:
+            database.execute_sql(sql)
+        database.execute_sql(
+            """INSERT INTO "user" VALUES ('1', 'Jake', 'thesnake', NULL, NULL, 0, NULL, 0, 0)""")
+        database.execute_sql(
+            """INSERT INTO "topic" ("id", "name") VALUES (1, '/News'), (2, '/Sports'), (3, '/News')""")
+        database.execute_sql(
+            """INSERT INTO "usertopic" ("user_id", "topic_id", "tweet_count", "user_identified")
+               VALUES ('1', 1, 2, 0), ('1', 3, 3, 1), ('1', 2, 1, 0), ('1', 2, 4, 0)""")
+        database.close()
+
+        database = models.init_db(DB_FILENAME)
+        self.assertEqual(database.user_version, migrations.SCHEMA_VERSION)
+        counts = {(ut.topic.name, ut.tweet_count, ut.user_identified)
+                  for ut in models.UserTopic.select()}
+        self.assertEqual(counts, {("/News", 5, True), ("/Sports", 5, False)})
+        self.assertEqual(models.Topic.select().count(), 2)
+        self.assertRaises(peewee.IntegrityError, models.Topic.create, name="/News")
+        migrated = self._schema(database)
+        database.close()
+
+        # Opening it again runs nothing.
+        database = models.init_db(DB_FILENAME)
+        self.assertEqual(migrations.migrate(database, models.TABLES), 0)
+        database.close()
+
+        fresh = models.init_db("fresh.db")
+        self.assertEqual(migrated, self._schema(fresh))
+        fresh.close()
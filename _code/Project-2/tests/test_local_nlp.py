@@ -0,0 +1,81 @@
+import asyncio
+import unittest
+
+from ec601_proj2 import google_nlp, local_nlp
+
+TWEET = "The Obama visit to Paris was great! 🍕 with @NASA and #SpaceX in Paris."
+
+class TestLocalNLPBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.client = google_nlp.create_client("local")
+
+
+    def test_create_client(self):
+        self.assertIsInstance(self.client, local_nlp.LocalLanguageClient)
+        with self.assertRaises(ValueError):
+            google_nlp.create_client("unknown")
+
+
+    def test_analyze_entities(self):
+        response = self.client.analyze_entities(
+            TWEET, encoding_type=google_nlp.EncodingType.UTF32)
+        self.assertIsInstance(response, google_nlp.language_v1.AnalyzeEntitiesResponse)
+
+        entities = {e.name: e for e in response.entities}
+        self.assertEqual(set(entities), {"Obama", "Paris", "NASA", "SpaceX"})
+        self.assertEqual(entities["Obama"].type_, google_nlp.Entity.Type.PERSON)
+        self.assertEqual(entities["Paris"].type_, google_nlp.Entity.Type.LOCATION)
+        self.assertEqual(response.entities[0].name, "Paris")
+        for entity in response.entities:
+            for mention in entity.mentions:
+                offset = mention.text.begin_offset
+                self.assertEqual(TWEET[offset:offset + len(mention.text.content)],
+                                 mention.text.content)
+
+        # Offsets past the emoji differ by encoding.
+        utf8 = self.client.analyze_entities(TWEET, encoding_type=google_nlp.EncodingType.UTF8)
+        nasa = [e for e in utf8.entities if e.name == "NASA"][0]
+        self.assertEqual(nasa.mentions[0].text.begin_offset,
+                         len(TWEET[:TWEET.index("@NASA")].encode()))
+
+        self.assertEqual(self.client.analyze_entities(TWEET),
+                         self.client.analyze_entities(TWEET))
+
+
+    def test_classify_text(self):
+        with self.assertRaises(google_nlp.InvalidArgument):
+            self.client.classify_text("Too short to classify")
+
+        text = " ".join(["Great game tonight, the team played the best season of football"] * 2)
+        response = self.client.classify_text(text)
+        self.assertEqual(response.categories[0].name, "/Sports")
+        self.assertAlmostEqual(sum(c.confidence for c in response.categories), 1, places=5)
+
+
+    def test_analyze_sentiment(self):
+        response = self.client.analyze_sentiment("I love it. This is terrible and bad.")
+        self.assertEqual(len(response.sentences), 2)
+        self.assertGreater(response.sentences[0].sentiment.score, 0)
+        self.assertLess(response.sentences[1].sentiment.score, 0)
+        self.assertEqual(google_nlp.categorize_sentiment(response.document_sentiment),
+                         google_nlp.SentimentCategory.MIXED)
+
+
+    def test_annotate_text(self):
+        features = dict(extract_entities=True, extract_document_sentiment=True)
+        response = self.client.annotate_text(TWEET, features=features)
+        self.assertEqual(len(response.entities), 4)
+        self.assertGreater(response.document_sentiment.score, 0)
+        self.assertEqual(len(response.tokens), 0)
+        self.assertEqual(len(response.categories), 0)
+
+        response = self.client.annotate_text(TWEET, features=dict(extract_syntax=True))
+        self.assertEqual(response.tokens[0].text.content, "The")
+        self.assertEqual(len(response.sentences), 2)
+
+
+    def test_async_client(self):
+        client = google_nlp.create_async_client("local")
+        response = asyncio.run(client.analyze_entities(TWEET))
+        self.assertEqual(response, self.client.analyze_entities(TWEET))
@@ -0,0 +1,79 @@
+import pstats
+import shutil
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from ec601_proj2.profiling import StageProfiler
+
+
+class SlowWorker:
+
+    STAGE = "scrape"
+
+    def __init__(self):
+        self.calls = 0
+
+
+    def busy_wait(self, seconds):
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            pass
+
+
+    def process(self):
+        self.calls += 1
+        self.busy_wait(0.05)
+        return True
+
+
+class TestStageProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = Path(tempfile.mkdtemp())
+
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+
+    def test_profile_and_dump(self):
+        profiler = StageProfiler(self.output_dir, sample_interval=0.001)
+        worker = SlowWorker()
+        profiler.profile(worker)
+        self.assertTrue(worker.process())
+        self.assertEqual(worker.calls, 1)
+
+        profiler.request_dump()
+        self.assertFalse(list(self.output_dir.iterdir()))
+        # Requested dumps are written after the next profiled call.
+        worker.process()
+        pstats_files = list(self.output_dir.glob("scrape.*.pstats"))
+        self.assertEqual(len(pstats_files), 1)
+
+        stats = pstats.Stats(str(pstats_files[0]))
+        functions = {name for _, _, name in stats.stats}
+        self.assertIn("busy_wait", functions)
+
+        collapsed = next(self.output_dir.glob("scrape.*.collapsed")).read_text().splitlines()
+        self.assertTrue(collapsed)
+        for line in collapsed:
+            stack, count = line.rsplit(" ", 1)
+            self.assertTrue(stack.startswith("scrape;test_profiling.py:process"))
+            self.assertGreater(int(count), 0)
+
+        profiler.close()
+        self.assertNotIn("process", vars(worker))
+
+
+    def test_duration(self):
+        profiler = StageProfiler(self.output_dir, duration=0.01, sample_interval=0)
+        worker = SlowWorker()
+        profiler.profile(worker)
+        worker.process()
+
+        # Profiling stopped after the first call and the stats were written.
+        self.assertNotIn("process", vars(worker))
+        self.assertEqual(len(list(self.output_dir.glob("scrape.*.pstats"))), 1)
+        self.assertEqual(len(list(self.output_dir.glob("scrape.*.collapsed"))), 1)
@@ -0,0 +1,107 @@
+"""
+    Unit tests for the web client's prefix search index.
+"""
+import os
+import unittest
+
+from ec601_proj2 import models
+from ec601_proj2.search_index import PrefixIndex, SearchIndex
+
+DB_FILENAME = "test.db"
+
+
+class PrefixIndexTests(unittest.TestCase):
+
+    def test_search(self):
+        index = PrefixIndex()
+        index.add([("apple", "1"), ("Apricot", "2"), ("banana", "3"), ("ap", "4")])
+        self.assertEqual(index.search("ap", 10), ["4", "1", "2"])
+        self.assertEqual(index.search("AP", 2), ["4", "1"])
+        self.assertEqual(index.search("b", 10), ["3"])
+        self.assertEqual(index.search("c", 10), [])
+        self.assertEqual(index.search("bananas", 10), [])
+
+
+    def test_refs_are_distinct(self):
+        index = PrefixIndex()
+        index.add([("jake", "1"), ("jake the snake", "1"), ("jane", "2")])
+        self.assertEqual(index.search("ja", 2), ["1", "2"])
+
+
+    def test_add_keeps_keys_sorted(self):
+        small = PrefixIndex()
+        large = PrefixIndex()
+        words = ["word%d" % i for i in range(200)]
+        # Small batches are inserted one key at a time, large ones merged.
+        for i in range(0, 200, 100):
+            batch = [(w, w) for w in words[i:i + 100]]
+            small.add(batch[:10])
+            small.add(batch[10:])
+            large.add(batch)
+        self.assertEqual(small.search("word1", 200), large.search("word1", 200))
+        self.assertEqual(len(large.search("word1", 200)), 111)
+
+
+    def test_add_replaces_keys(self):
+        index = PrefixIndex()
+        index.add([("apple", "1")])
+        # A search that already has the list keeps seeing the same keys.
+        for batch in ([("banana", "2")], [("word%d" % i, i) for i in range(100)]):
+            keys = index._keys
+            before = list(keys)
+            index.add(batch)
+            self.assertEqual(keys, before)
+            self.assertIsNot(index._keys, keys)
+        self.assertEqual(len(index), 102)
+
+
+class SearchIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.database = models.init_db(DB_FILENAME)
+
+
+    def tearDown(self):
+        self.database.drop_tables(models.TABLES)
+        self.database.close()
+        os.unlink(DB_FILENAME)
+
+
+    def _create_user(self, user_id, username, name):
+        models.User.create(id=user_id, username=username, name=name,
+                           description="About %s" % name, verified=False, protected=False)
+
+
+    def test_search(self):
+        self._create_user("1", "thesnake", "Jake")
+        self._create_user("2", "jane", "Jane Doe")
+        models.get_topic_ids({"/Arts & Entertainment/Music", "/Sports"})
+
+        index = SearchIndex(refresh_interval=3600)
+        index.refresh(0)
+        results = index.search("ja", 10)
+        self.assertEqual([u["id"] for u in results["users"]], ["1", "2"])
+        self.assertEqual(results["users"][0]["description"], "About Jake")
+        self.assertEqual(results["topics"], [])
+
+        self.assertEqual(index.search("/", 10)["topics"],
+                         ["/Arts & Entertainment/Music", "/Sports"])
+        self.assertEqual(index.search("mus", 10)["topics"], ["/Arts & Entertainment/Music"])
+        self.assertEqual(index.search("thes", 10)["users"][0]["username"], "thesnake")
+
+
+    def test_refresh(self):
+        self._create_user("1", "thesnake", "Jake")
+        index = SearchIndex(refresh_interval=3600)
+        index.refresh(0)
+
+        self._create_user("2", "jane", "Jane Doe")
+        models.get_topic_ids({"/Jazz"})
+
+        # Nothing is loaded until the generation changes.
+        index.refresh(0)
+        self.assertEqual(len(index.search("ja", 10)["users"]), 1)
+
+        index.refresh(1)
+        self.assertEqual(len(index.search("ja", 10)["users"]), 2)
+        self.assertEqual(index.search("ja", 10)["topics"], ["/Jazz"])
@@ -0,0 +1,123 @@
+"""
+    Unit tests for the web client's API.
+"""
+import json
+import os
+import unittest
+from unittest import mock
+
+# The API opens the database when it is imported.
+os.environ.setdefault("SQLITE_DATABASE", ":memory:")
+
+from applications.web_client import api
+from applications.web_client.api import ResponseCache
+from ec601_proj2 import models
+
+from .test_workers import DatabaseTestCase
+
+
+class ResponseCacheTests(unittest.TestCase):
+
+    def test_bounded_by_body_size(self):
+        cache = ResponseCache(max_bytes=10)
+        cache.put("a", 0, b"1234", "etag-a")
+        cache.put("b", 0, b"1234", "etag-b")
+        self.assertEqual(cache.get("a"), (0, b"1234", "etag-a"))
+
+        # "b" was the least recently used response.
+        cache.put("c", 0, b"1234", "etag-c")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.size, 8)
+
+        # Too large to keep at all, and it replaces the old body.
+        cache.put("a", 1, b"12345678901", "etag-a")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.size, 4)
+
+
+    def test_replace(self):
+        cache = ResponseCache(max_bytes=10)
+        cache.put("a", 0, b"1234", "etag")
+        cache.put("a", 1, b"123456", "etag")
+        self.assertEqual(cache.get("a")[0], 1)
+        self.assertEqual(cache.size, 6)
+
+
+class UserTopicsTests(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patches = [mock.patch.object(api, "REDIS_CLIENT", self.redis_client),
+                   mock.patch.object(api, "RESPONSE_CACHE", ResponseCache(1024 * 1024))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.client = api.API.test_client()
+
+        topic = models.Topic.create(name="/News")
+        other = models.Topic.create(name="/Sports")
+        # Three users tie on 3 tweets, so the id breaks the tie.
+        for i, tweet_count in enumerate([3, 5, 3, 1, 3]):
+            user = models.User.create(id=str(i), name="User %d" % i, username="user%d" % i,
+                                      verified=False, protected=False)
+            models.UserTopic.create(user=user, topic=topic, tweet_count=tweet_count)
+            models.UserTopic.create(user=user, topic=other, tweet_count=tweet_count)
+
+
+    def _pages(self, query):
+        usernames = []
+        cursor = None
+        while True:
+            url = "/api/user-topics?topic=/News&" + query
+            response = self.client.get(url + ("&cursor=" + cursor if cursor else ""))
+            self.assertEqual(response.status_code, 200)
+            body = response.get_json()
+            rows = body["data"].get("/News", [])
+            self.assertLessEqual(len(rows), 2)
+            usernames.extend(row["username"] for row in rows)
+            cursor = body["next_cursor"]
+            if cursor is None:
+                return usernames
+
+
+    def test_page_by_id(self):
+        self.assertEqual(self._pages("limit=2"),
+                         ["user0", "user1", "user2", "user3", "user4"])
+
+
+    def test_page_by_tweet_count(self):
+        # Ties are ordered by user topic id, highest first, and pages
+        # that split a tie neither repeat nor skip rows.
+        self.assertEqual(self._pages("limit=2&sort=tweet_count"),
+                         ["user1", "user4", "user2", "user0", "user3"])
+
+
+    def test_unpaged(self):
+        body = self.client.get("/api/user-topics?topic=/Sports").get_json()
+        self.assertEqual(list(body["data"]), ["/Sports"])
+        self.assertEqual(len(body["data"]["/Sports"]), 5)
+        self.assertNotIn("next_cursor", body)
+
+
+    def test_invalid_args(self):
+        for query in ("limit=abc", "limit=0", "limit=1001", "sort=name", "cursor=abc",
+                      "sort=tweet_count&cursor=" + api.encode_cursor("id", dict(user_topic_id=1))):
+            response = self.client.get("/api/user-topics?topic=/News&" + query)
+            self.assertEqual(response.status_code, 400, query)
+        self.assertEqual(self.client.get("/api/user-topics.ndjson?limit=x").status_code, 400)
+
+
+    def test_ndjson(self):
+        response = self.client.get("/api/user-topics.ndjson?topic=/News&sort=tweet_count")
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([row["username"] for row in rows],
+                         ["user1", "user4", "user2", "user0", "user3"])
+        self.assertEqual({row["topic"] for row in rows}, {"/News"})
+
+        # Each row's cursor resumes after it.
+        response = self.client.get("/api/user-topics.ndjson?topic=/News&sort=tweet_count"
+                                   "&limit=2&cursor=" + rows[1]["cursor"])
+        resumed = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(resumed, rows[2:4])
@@ -1,3 +1,5 @@
+import asyncio
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import json
 import os
@@ -11,14 +13,19 @@ from unittest import mock
 import uuid
 from playhouse.shortcuts import model_to_dict
 
+import msgpack
 import redis
+from requests.models import Response
 
 from ec601_proj2 import (
+    metrics,
     workers,
     models,
     twitter_utils,
     google_nlp
 )
+from ec601_proj2.frontier import Frontier, parse_priority_weights
+from ec601_proj2.topic_index import TopicIndex
 
 DB_FILENAME = "test.db"
 
@@ -32,6 +39,19 @@ def random_date(start: datetime, end: datetime) -> datetime:
     random_second = random.randrange(int_delta)
     return start + timedelta(seconds=random_second)
 
+@contextmanager
+def patch_nlp(method, **kwargs):
+    """
+        Patch one method of google_nlp.LanguageClient. A stub client is
+        swapped in first, so the Google client, which needs credentials,
+        is never created.
+    """
+    client = mock.NonCallableMock(spec=google_nlp.NLPBackend)
+    with mock.patch.object(google_nlp, "_language_client", client):
+        with mock.patch.object(client, method, **kwargs) as patched:
+            yield patched
+
+
 class RedisServerHelper:
 
     base_path = Path(__file__).absolute().parent / "redis"
@@ -118,6 +138,7 @@ class DatabaseTestCase(unittest.TestCase):
                 url="https://google.com",
                 description="",
                 verified = False,
+                protected=False,
             )
             user.save()
 
@@ -271,6 +292,24 @@ class TestDatabaseWorker(DatabaseTestCase):
 
 
 
+    def test_queue_entity_analysis_requests_chunked(self):
+        self._populate_users(1)
+        self._populate_db_with_user_tweets("0", 10)
+        pending = [t.id for t in models.Tweet.select().limit(2)]
+        self.redis_client.sadd(workers.Queues.DB_TWEET_PROCESSING_PENDING, *pending)
+
+        worker = workers.DatabaseWorker(self.redis_client, chunk_size=3)
+        worker.queue_entity_analysis_requests()
+
+        requests = self.redis_client.lrange(workers.Queues.ENTITY_ANALYSIS_REQUEST, 0, -1)
+        queued_ids = {tweet.id for tweet in
+                      map(workers.EntityAnalysisWorker.deserialize_request, requests)}
+        self.assertEqual(len(requests), 8)
+        self.assertFalse(queued_ids & set(pending))
+        self.assertEqual(
+            self.redis_client.scard(workers.Queues.DB_TWEET_PROCESSING_PENDING), 10)
+
+
     def test_store_entity_analysis_result(self):
         self._populate_users(1)
         self._populate_db_with_user_tweets("0", 1)
@@ -299,7 +338,7 @@ class TestDatabaseWorker(DatabaseTestCase):
         self.assertEqual(ent.type, entity.type_)
 
 
-    def test_queue_classification_request(self):
+    def test_queue_classification_request_plans_documents(self):
         self._populate_users(1)
         self._populate_db_with_user_tweets("0", 10)
         self._populate_database_with_entities(2)
@@ -320,18 +359,18 @@ class TestDatabaseWorker(DatabaseTestCase):
 
         req1 = self.redis_client.lpop(workers.Queues.CLASSIFICATION_REQUESTS)
         self.assertIsNotNone(req1)
-        req1 = workers.ClassificationRequest.from_json(req1)
+        req1 = workers.ClassificationRequest.decode(req1)
         self.assertEqual(req1.user_id, "0")
         expected_tweet_ids = {t.id for t in tweets[:5]}
-        request_tweet_ids = {t.id for t in req1.tweets}
+        request_tweet_ids = set(req1.tweet_ids)
         self.assertEqual(request_tweet_ids, expected_tweet_ids)
 
         req2 = self.redis_client.lpop(workers.Queues.CLASSIFICATION_REQUESTS)
         self.assertIsNotNone(req2)
-        req2 = workers.ClassificationRequest.from_json(req2)
+        req2 = workers.ClassificationRequest.decode(req2)
         self.assertEqual(req2.user_id, "0")
         expected_tweet_ids = {t.id for t in tweets[5:]}
-        request_tweet_ids = {t.id for t in req2.tweets}
+        request_tweet_ids = set(req2.tweet_ids)
         self.assertEqual(request_tweet_ids, expected_tweet_ids)
 
     def test_queue_classification_request(self):
@@ -356,6 +395,95 @@ class TestDatabaseWorker(DatabaseTestCase):
         self.assertIsNone(request)
 
 
+    def _count_classification_planning_queries(self, num_tweets):
+        self.database.drop_tables(models.TABLES)
+        self.database.create_tables(models.TABLES)
+        self.redis_client.flushdb()
+
+        self._populate_users(2)
+        self._populate_database_with_entities(3)
+        entities = list(models.Entity.select())
+        for user_id in ("0", "1"):
+            self._populate_db_with_user_tweets(user_id, num_tweets)
+
+        for tweet in models.Tweet.select():
+            tweet.analyzed = True
+            tweet.save()
+            for entity in entities:
+                models.TweetEntity.create(tweet=tweet, entity=entity)
+
+        with mock.patch.object(self.database, "execute_sql",
+                               wraps=self.database.execute_sql) as execute_sql:
+            self.worker.queue_classification_requests()
+
+        # Every tweet mentions every entity, so one document per user
+        # covers them all.
+        self.assertEqual(
+            self.redis_client.llen(workers.Queues.CLASSIFICATION_REQUESTS), 2)
+        return execute_sql.call_count
+
+
+    def test_queue_classification_request_query_count(self):
+        few = self._count_classification_planning_queries(3)
+        many = self._count_classification_planning_queries(50)
+        self.assertEqual(few, many)
+        self.assertEqual(many, 1)
+
+
+    def test_plan_classification_documents(self):
+        groups = {
+            "a": ["1", "2", "3"],
+            "b": ["2", "3", "4", "5"],
+            "c": ["6"],
+            "d": ["7"],
+            "e": ["8"],
+        }
+        tokens = {"1": 10, "2": 10, "3": 10, "4": 10, "5": 10,
+                  "6": 15, "7": 10, "8": 2}
+        documents, skipped = workers.plan_classification_documents(groups, tokens)
+        # The short tail is added to the last document rather than dropped.
+        self.assertEqual(documents, [["2", "3", "4", "5"], ["1", "6", "7", "8"]])
+        self.assertEqual(skipped, [])
+
+        # Only a user whose tweets are all too short is skipped.
+        documents, skipped = workers.plan_classification_documents(
+            {"a": ["1"], "b": ["2"]}, {"1": 5, "2": 5})
+        self.assertEqual(documents, [])
+        self.assertEqual(skipped, ["1", "2"])
+
+
+    def test_queue_classification_requests_planned(self):
+        self._populate_users(2)
+        self._populate_db_with_user_tweets("0", 6)
+        self._populate_database_with_entities(3)
+        entities = list(models.Entity.select())
+        tweets = list(models.Tweet.select())
+        for i, tweet in enumerate(tweets):
+            tweet.analyzed = True
+            tweet.save()
+            # Every tweet mentions entity 0, the first three entity 1 too.
+            models.TweetEntity.create(tweet=tweet, entity=entities[0])
+            if i < 3:
+                models.TweetEntity.create(tweet=tweet, entity=entities[1])
+
+        # A lone tweet can't reach the token minimum.
+        self._populate_db_with_user_tweets("1", 1)
+        lone = models.Tweet.get(models.Tweet.user_id == "1")
+        lone.analyzed = True
+        lone.save()
+        models.TweetEntity.create(tweet=lone, entity=entities[2])
+
+        self.worker.queue_classification_requests()
+
+        requests = self.redis_client.lrange(workers.Queues.CLASSIFICATION_REQUESTS, 0, -1)
+        self.assertEqual(len(requests), 1)
+        request = workers.ClassificationRequest.decode(requests[0])
+        self.assertEqual(set(request.tweet_ids), {t.id for t in tweets})
+        self.assertTrue(models.Tweet.get_by_id(lone.id).classified)
+        self.assertFalse(self.redis_client.sismember(
+            workers.Queues.DB_TWEET_PROCESSING_PENDING, lone.id))
+
+
     def test_store_classification_result(self):
         self._populate_users(1)
         self._populate_db_with_user_tweets("0", 10)
@@ -367,10 +495,10 @@ class TestDatabaseWorker(DatabaseTestCase):
         ]
 
         result = workers.ClassificationResult(user_id="0",
-                                              tweets=tweets,
+                                              tweet_ids=[t.id for t in tweets],
                                               categories=categories)
 
-        self.redis_client.rpush(workers.Queues.CLASSIFICATION_RESULTS, result.to_json())
+        self.redis_client.rpush(workers.Queues.CLASSIFICATION_RESULTS, result.encode())
         self.worker.store_classification_results()
         uts = models.UserTopic.select().where(models.UserTopic.user_id == "0")
         self.assertEqual(uts.count(), len(categories))
@@ -380,7 +508,96 @@ class TestDatabaseWorker(DatabaseTestCase):
         self.assertEqual(ut_cats, cats)
         for ut in uts:
             self.assertEqual(ut.tweet_count, len(tweets))
+        self.assertEqual(int(self.redis_client.get(workers.TOPICS_GENERATION_KEY)), 1)
+
+        # Nothing stored, nothing changed.
+        self.worker.store_classification_results()
+        self.assertEqual(int(self.redis_client.get(workers.TOPICS_GENERATION_KEY)), 1)
+
+
+    def test_store_classification_results_batched(self):
+        self._populate_users(2)
+        self._populate_db_with_user_tweets("0", 4)
+        self._populate_db_with_user_tweets("1", 4)
+        worker = workers.DatabaseWorker(self.redis_client, batch_size=2)
+
+        category = google_nlp.ClassificationCategory(name="Cat 1", confidence=0.5)
+        for user_id in ("0", "1"):
+            tweets = list(models.Tweet.select().where(models.Tweet.user_id == user_id))
+            for i in range(0, 4, 2):
+                result = workers.ClassificationResult(
+                    user_id=user_id,
+                    tweet_ids=[t.id for t in tweets[i:i + 2]],
+                    categories=[category])
+                self.redis_client.rpush(workers.Queues.CLASSIFICATION_RESULTS,
+                                        result.encode())
+
+        worker.store_classification_results()
+        self.assertEqual(self.redis_client.llen(workers.Queues.CLASSIFICATION_RESULTS), 0)
+        self.assertEqual(models.Topic.select().count(), 1)
+        for user_id in ("0", "1"):
+            ut = models.UserTopic.get(models.UserTopic.user_id == user_id)
+            self.assertEqual(ut.tweet_count, 4)
+
+        query = models.Tweet.select().where(models.Tweet.classified >> False)
+        self.assertEqual(query.count(), 0)
+
+
+    def test_topic_index(self):
+        self._populate_users(3)
+        category = google_nlp.ClassificationCategory(name="Cat 1", confidence=0.5)
+        for user_id, tweet_count in (("0", 3), ("1", 1), ("2", 2)):
+            self._populate_db_with_user_tweets(user_id, tweet_count)
+            tweets = models.Tweet.select().where(models.Tweet.user_id == user_id)
+            result = workers.ClassificationResult(user_id=user_id,
+                                                  tweet_ids=[t.id for t in tweets],
+                                                  categories=[category])
+            self.redis_client.rpush(workers.Queues.CLASSIFICATION_RESULTS, result.encode())
+        self.worker.store_classification_results()
+
+        index = TopicIndex(self.redis_client)
+        top = index.top_users(["Cat 1", "Cat 2"], 2)
+        self.assertEqual(list(top), ["Cat 1"])
+        self.assertEqual([(u["id"], u["tweet_count"]) for u in top["Cat 1"]],
+                         [("0", 3), ("2", 2)])
+        user = models.User.get_by_id("0")
+        self.assertEqual(top["Cat 1"][0]["username"], user.username)
+
+        # Later results add to the counts.
+        self._populate_db_with_user_tweets("1", 5)
+        tweets = models.Tweet.select().where((models.Tweet.user_id == "1") &
+                                             (models.Tweet.classified >> False))
+        result = workers.ClassificationResult(user_id="1",
+                                              tweet_ids=[t.id for t in tweets],
+                                              categories=[category])
+        self.redis_client.rpush(workers.Queues.CLASSIFICATION_RESULTS, result.encode())
+        self.worker.store_classification_results()
+        top = index.top_users(["Cat 1"], 10)["Cat 1"]
+        self.assertEqual([(u["id"], u["tweet_count"]) for u in top],
+                         [("1", 6), ("0", 3), ("2", 2)])
+
+        # The rebuilt index matches the one kept up to date.
+        index.clear()
+        self.assertEqual(index.top_users(["Cat 1"], 10), {})
+        self.assertEqual(index.rebuild(batch_size=2), 3)
+        self.assertEqual(index.top_users(["Cat 1"], 10)["Cat 1"], top)
+
+
+    def test_store_scraped_tweets_batched(self):
+        self._populate_users(3)
+        for i in range(3):
+            self._populate_queue_with_user_tweets(str(i), 5)
+
+        # Tweets from users we don't know about are dropped.
+        self._populate_queue_with_user_tweets("unknown", 1)
+
+        worker = workers.DatabaseWorker(self.redis_client, batch_size=4)
+        worker.store_scraped_tweets()
 
+        self.assertEqual(self.redis_client.llen(workers.Queues.SCRAPE_USER_TWEETS_RESULTS), 0)
+        self.assertEqual(models.Tweet.select().count(), 15)
+        query = models.User.select().where(models.User.last_scraped.is_null())
+        self.assertEqual(query.count(), 0)
 
 
 class TestScrapeTwitterWorker(DatabaseTestCase):
@@ -426,7 +643,7 @@ class TestScrapeTwitterWorker(DatabaseTestCase):
         self.db_worker.queue_users_to_scrape()
 
         self.scrape_worker.process()
-        exp = workers.get_twitter_rate_limt_expires(self.redis_client)
+        exp = self.scrape_worker.wait_time()
         self.assertIsNotNone(exp)
         self.assertGreater(exp, 0)
         self.assertEqual(mock_twitter.get_user_tweets.call_count, 1)
@@ -436,8 +653,9 @@ class TestScrapeTwitterWorker(DatabaseTestCase):
         self.assertEqual(mock_twitter.get_user_tweets.call_count, 1)
 
         # Simulate that the rate limit has reset expired.
-        workers.set_twitter_rate_limit_expires(self.redis_client, time.time() - 1)
-        self.assertLessEqual(workers.get_twitter_rate_limt_expires(self.redis_client), 0)
+        workers.set_twitter_rate_limit_expires(self.redis_client, time.time() - 1,
+                                               endpoint="users/:id/tweets")
+        self.assertLessEqual(self.scrape_worker.wait_time(), 0)
         tweets = list(self._generate_user_tweets("0", 2))
         mock_twitter.Tweet = twitter_utils.Tweet
         mock_twitter.get_user_tweets.side_effect = None
@@ -446,6 +664,67 @@ class TestScrapeTwitterWorker(DatabaseTestCase):
         self.assertEqual(mock_twitter.get_user_tweets.call_count, 2)
 
 
+class TestTwitterRateLimits(DatabaseTestCase):
+
+    def tearDown(self):
+        twitter_utils.set_rate_limit_hook(None)
+        return super().tearDown()
+
+
+    def _response(self, status_code, remaining, reset):
+        response = Response()
+        response.status_code = status_code
+        response._content = b'{"data": []}'
+        response.headers.update({
+            "x-rate-limit-limit": "900",
+            "x-rate-limit-remaining": str(remaining),
+            "x-rate-limit-reset": str(reset),
+        })
+        return response
+
+
+    def test_endpoint_family(self):
+        self.assertEqual(twitter_utils.endpoint_family("users/:1234/following"),
+                         "users/:id/following")
+        self.assertEqual(twitter_utils.endpoint_family("tweets/search/recent"),
+                         "tweets/search/recent")
+
+
+    def test_headers_recorded_per_endpoint(self):
+        workers.track_twitter_rate_limits(self.redis_client)
+        reset = time.time() + 600
+        twitter_utils._check_response(self._response(200, 0, reset), "users/:1/following")
+
+        wait = workers.get_twitter_rate_limt_expires(self.redis_client, "users/:id/following")
+        self.assertGreater(wait, 590)
+        # Other endpoint families keep their own budget.
+        self.assertLessEqual(
+            workers.get_twitter_rate_limt_expires(self.redis_client, "users/:id/tweets"), 0)
+
+
+    def test_rate_limit_error_has_endpoint(self):
+        response = self._response(429, 0, time.time() + 600)
+        with self.assertRaises(twitter_utils.TwitterRateLimitError) as ctx:
+            twitter_utils._check_response(response, "users/:1/tweets")
+        self.assertEqual(ctx.exception.endpoint, "users/:id/tweets")
+
+
+    def test_pace(self):
+        rate_limit = twitter_utils.RateLimit(endpoint="users/:id/tweets",
+                                             limit=900,
+                                             remaining=10,
+                                             reset_epoch_seconds=time.time() + 100)
+        workers.record_twitter_rate_limit(self.redis_client, rate_limit)
+        self.assertLessEqual(
+            workers.get_twitter_rate_limt_expires(self.redis_client, "users/:id/tweets"), 0)
+
+        # 10 requests left for 100 seconds, so one every 10 seconds.
+        wait = workers.get_twitter_rate_limt_expires(self.redis_client, "users/:id/tweets",
+                                                     pace=True)
+        self.assertGreater(wait, 9)
+        self.assertLessEqual(wait, 10)
+
+
 class TestEntityAnalysisWorker(DatabaseTestCase):
 
 
@@ -484,6 +763,112 @@ class TestEntityAnalysisWorker(DatabaseTestCase):
             self.assertEqual(result.entities[i].name, ent.name)
 
 
+    def _queue_tweets(self, texts):
+        self._populate_users(1)
+        self._populate_db_with_user_tweets("0", len(texts))
+        tweets = list(models.Tweet.select())
+        for tweet, text in zip(tweets, texts):
+            tweet.text = text
+            self.redis_client.rpush(workers.Queues.ENTITY_ANALYSIS_REQUEST,
+                                    workers.EntityAnalysisWorker.serialize_request(tweet))
+        return tweets
+
+
+    def _entities_response(self, text, names):
+        entities = []
+        for name in names:
+            offsets = [i for i in range(len(text)) if text.startswith(name, i)]
+            entities.append(google_nlp.Entity(
+                name=name, type_=1,
+                mentions=[dict(text=dict(content=name, begin_offset=offset))
+                          for offset in offsets]))
+        return google_nlp.language_v1.AnalyzeEntitiesResponse(entities=entities)
+
+
+    def test_analyze_entities_batched(self):
+        texts = ["Obama was in Paris", "No entities", "Back to Paris 🍕"]
+        tweets = self._queue_tweets(texts)
+        document, _ = google_nlp.join_texts(texts)
+
+        worker = workers.EntityAnalysisWorker(self.redis_client, batch_chars=1000)
+        response = self._entities_response(document, ["Obama", "Paris"])
+        with patch_nlp("analyze_entities",
+                       return_value=response) as analyze:
+            self.assertIs(worker.process(), True)
+            analyze.assert_called_once_with(
+                document, encoding_type=google_nlp.EncodingType.UTF32)
+
+        results = self.redis_client.lrange(workers.Queues.ENTITY_ANALYSIS_RESULTS, 0, -1)
+        results = {r.tweet.id: r for r in map(workers.EntityAnalysisResult.decode, results)}
+        self.assertEqual([[e.name for e in results[t.id].entities] for t in tweets],
+                         [["Obama", "Paris"], [], ["Paris"]])
+
+        self.db_worker.store_entity_analysis_results()
+        query = models.Tweet.select().where(models.Tweet.analyzed >> False)
+        self.assertEqual(query.count(), 0)
+
+
+    def test_analyze_entities_batched_rate_limited(self):
+        texts = ["tweet %d" % i for i in range(4)]
+        self._queue_tweets(texts)
+        requests = self.redis_client.lrange(workers.Queues.ENTITY_ANALYSIS_REQUEST, 0, -1)
+
+        # Two tweets per document, but only one request allowed.
+        worker = workers.EntityAnalysisWorker(self.redis_client, batch_chars=20,
+                                              requests_per_minute=60)
+        response = google_nlp.language_v1.AnalyzeEntitiesResponse()
+        with patch_nlp("analyze_entities",
+                       return_value=response) as analyze:
+            self.assertEqual(worker.process(), "wait")
+
+        self.assertEqual(analyze.call_count, 1)
+        self.assertEqual(self.redis_client.llen(workers.Queues.ENTITY_ANALYSIS_RESULTS), 2)
+        self.assertEqual(self.redis_client.lrange(workers.Queues.ENTITY_ANALYSIS_REQUEST, 0, -1),
+                         requests[2:])
+
+
+    def test_analyze_entities_batched_invalid_argument(self):
+        texts = ["Obama was in Paris", "bad tweet", "Back to Paris"]
+        tweets = self._queue_tweets(texts)
+        document, _ = google_nlp.join_texts(texts)
+
+        def analyze_entities(text, encoding_type):
+            if "bad tweet" in text:
+                raise google_nlp.InvalidArgument("unsupported language")
+            return self._entities_response(text, ["Obama", "Paris"])
+
+        worker = workers.EntityAnalysisWorker(self.redis_client, batch_chars=1000)
+        with patch_nlp("analyze_entities",
+                       side_effect=analyze_entities) as analyze:
+            self.assertIs(worker.process(), True)
+
+        # The document is retried one tweet at a time.
+        self.assertEqual([c.args[0] for c in analyze.call_args_list], [document] + texts)
+        self.assertEqual(self.redis_client.llen(workers.Queues.ENTITY_ANALYSIS_REQUEST), 0)
+        results = self.redis_client.lrange(workers.Queues.ENTITY_ANALYSIS_RESULTS, 0, -1)
+        results = {r.tweet.id: r for r in map(workers.EntityAnalysisResult.decode, results)}
+        self.assertEqual([[e.name for e in results[t.id].entities] for t in tweets],
+                         [["Obama", "Paris"], [], ["Paris"]])
+
+
+    def test_analyze_entities_batched_error(self):
+        texts = ["tweet %d" % i for i in range(4)]
+        self._queue_tweets(texts)
+        requests = self.redis_client.lrange(workers.Queues.ENTITY_ANALYSIS_REQUEST, 0, -1)
+
+        worker = workers.EntityAnalysisWorker(self.redis_client, batch_chars=20)
+        response = google_nlp.language_v1.AnalyzeEntitiesResponse()
+        with patch_nlp("analyze_entities",
+                       side_effect=[response, RuntimeError("connection reset")]):
+            with self.assertRaises(RuntimeError):
+                worker.process()
+
+        # The first document was stored and the rest put back in order.
+        self.assertEqual(self.redis_client.llen(workers.Queues.ENTITY_ANALYSIS_RESULTS), 2)
+        self.assertEqual(self.redis_client.lrange(workers.Queues.ENTITY_ANALYSIS_REQUEST, 0, -1),
+                         requests[2:])
+
+
 class TestClassificationWorker(DatabaseTestCase):
 
     def setUp(self):
@@ -495,9 +880,9 @@ class TestClassificationWorker(DatabaseTestCase):
         self._populate_users(1)
         self._populate_db_with_user_tweets("0", 5)
         tweets = list(models.Tweet.select().where(models.Tweet.user_id == "0"))
-        req = workers.ClassificationRequest(user_id="0", tweets=tweets)
+        req = workers.ClassificationRequest.from_tweets("0", tweets)
 
-        self.redis_client.rpush(workers.Queues.CLASSIFICATION_REQUESTS, req.to_json())
+        self.redis_client.rpush(workers.Queues.CLASSIFICATION_REQUESTS, req.encode())
         tweet_text = " ".join([t.text for t in tweets])
 
         with mock.patch("ec601_proj2.workers.google_nlp") as mock_nlp:
@@ -514,13 +899,471 @@ class TestClassificationWorker(DatabaseTestCase):
 
             result = self.redis_client.lpop(workers.Queues.CLASSIFICATION_RESULTS)
             self.assertIsNotNone(result)
-            result = workers.ClassificationResult.from_json(result)
+            result = workers.ClassificationResult.decode(result)
 
             self.assertEqual(result.user_id, "0")
             expected_tweets_ids = {t.id for t in tweets}
-            result_tweet_ids = {t.id for t in result.tweets}
+            result_tweet_ids = set(result.tweet_ids)
             self.assertEqual(expected_tweets_ids, result_tweet_ids)
 
             category_names = [c.name for c in result.categories]
             expected_categories = [c.name for c in categories]
-            self.assertEqual(expected_categories, category_names)
\ No newline at end of file
+            self.assertEqual(expected_categories, category_names)
+
+class TestAsyncNLPWorkers(DatabaseTestCase):
+
+    def _queue_entity_requests(self, num_tweets):
+        self._populate_users(1)
+        self._populate_db_with_user_tweets("0", num_tweets)
+        tweets = list(models.Tweet.select())
+        for tweet in tweets:
+            self.redis_client.rpush(workers.Queues.ENTITY_ANALYSIS_REQUEST,
+                                    workers.EntityAnalysisWorker.serialize_request(tweet))
+        return tweets
+
+
+    def test_analyze_entities_concurrently(self):
+        tweets = self._queue_entity_requests(12)
+        worker = workers.AsyncEntityAnalysisWorker(self.redis_client, concurrency=4)
+
+        in_flight = 0
+        max_in_flight = 0
+        async def analyze_entities(text):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            response = mock.Mock()
+            response.entities = list(self._generate_dummy_entities(1))
+            return response
+
+        client = mock.Mock()
+        client.analyze_entities = analyze_entities
+        asyncio.run(worker.run_async(client=client, drain=True))
+
+        self.assertEqual(max_in_flight, 4)
+        self.assertEqual(self.redis_client.llen(workers.Queues.ENTITY_ANALYSIS_REQUEST), 0)
+        results = self.redis_client.lrange(workers.Queues.ENTITY_ANALYSIS_RESULTS, 0, -1)
+        result_ids = {workers.EntityAnalysisWorker.deserialize_result(r).tweet.id
+                      for r in results}
+        self.assertEqual(result_ids, {t.id for t in tweets})
+
+
+    def test_analyze_entities_rate_limited(self):
+        self._queue_entity_requests(3)
+        worker = workers.AsyncEntityAnalysisWorker(self.redis_client, concurrency=2,
+                                                   requests_per_minute=60)
+
+        client = mock.Mock()
+        client.analyze_entities = mock.AsyncMock(
+            side_effect=google_nlp.ResourceExhausted("quota"))
+        stop = asyncio.Event()
+
+        async def run():
+            task = asyncio.create_task(worker.run_async(client=client, stop=stop))
+            await asyncio.sleep(0.1)
+            stop.set()
+            await task
+
+        asyncio.run(run())
+        # A 429 drains the shared bucket instead of blocking for 15 minutes.
+        self.assertEqual(workers.get_google_rate_limit_expires(self.redis_client), 0)
+        self.assertGreater(worker.wait_time(), 0)
+        self.assertEqual(worker.bucket.acquire(), (0, mock.ANY))
+        self.assertEqual(client.analyze_entities.call_count, 1)
+        self.assertEqual(self.redis_client.llen(workers.Queues.ENTITY_ANALYSIS_REQUEST), 3)
+
+
+    def test_analyze_entities_failures(self):
+        tweets = self._queue_entity_requests(3)
+        worker = workers.AsyncEntityAnalysisWorker(self.redis_client, concurrency=2)
+
+        calls = {}
+        async def analyze_entities(text):
+            calls[text] = calls.get(text, 0) + 1
+            if text == tweets[0].text:
+                raise RuntimeError("connection reset")
+            if text == tweets[1].text:
+                raise google_nlp.InvalidArgument("unsupported language")
+            response = mock.Mock()
+            response.entities = list(self._generate_dummy_entities(1))
+            return response
+
+        client = mock.Mock()
+        client.analyze_entities = analyze_entities
+        asyncio.run(worker.run_async(client=client, drain=True))
+
+        # Failing requests are retried, then stored with no entities.
+        self.assertEqual(calls[tweets[0].text], worker.MAX_REQUEST_ATTEMPTS)
+        self.assertEqual(calls[tweets[1].text], 1)
+        self.assertEqual(worker._failures, {})
+        results = self.redis_client.lrange(workers.Queues.ENTITY_ANALYSIS_RESULTS, 0, -1)
+        entities = {r.tweet.id: len(r.entities)
+                    for r in map(workers.EntityAnalysisWorker.deserialize_result, results)}
+        self.assertEqual(entities, {tweets[0].id: 0, tweets[1].id: 0, tweets[2].id: 1})
+
+
+    def test_classify_concurrently(self):
+        self._populate_users(1)
+        self._populate_db_with_user_tweets("0", 6)
+        tweets = list(models.Tweet.select())
+        for i in range(0, 6, 2):
+            req = workers.ClassificationRequest.from_tweets("0", tweets[i:i + 2])
+            self.redis_client.rpush(workers.Queues.CLASSIFICATION_REQUESTS, req.encode())
+
+        response = mock.Mock()
+        response.categories = [
+            google_nlp.ClassificationCategory(name="Cat 1", confidence=0.5)
+        ]
+        client = mock.Mock()
+        client.classify_text = mock.AsyncMock(return_value=response)
+
+        worker = workers.AsyncClassificationWorker(self.redis_client, concurrency=3)
+        asyncio.run(worker.run_async(client=client, drain=True))
+
+        self.assertEqual(client.classify_text.await_count, 3)
+        results = self.redis_client.lrange(workers.Queues.CLASSIFICATION_RESULTS, 0, -1)
+        self.assertEqual(len(results), 3)
+        result = workers.ClassificationResult.decode(results[0])
+        self.assertEqual([c.name for c in result.categories], ["Cat 1"])
+
+
+
+class TestQueuePayloads(DatabaseTestCase):
+
+    def _entity_result(self):
+        self._populate_users(1)
+        self._populate_db_with_user_tweets("0", 1)
+        tweet = models.Tweet.select()[0]
+        return workers.EntityAnalysisResult(tweet=tweet,
+                                            entities=list(self._generate_dummy_entities(3)))
+
+
+    def test_entity_analysis_result_roundtrip(self):
+        result = self._entity_result()
+        data = result.encode("msgpack")
+        self.assertTrue(data.startswith(workers.PAYLOAD_MAGIC))
+        self.assertLess(len(data), len(result.to_json()))
+
+        decoded = workers.EntityAnalysisResult.decode(data)
+        self.assertEqual(decoded.tweet.id, result.tweet.id)
+        self.assertEqual([(e.name, e.type_) for e in decoded.entities],
+                         [(e.name, e.type_) for e in result.entities])
+
+
+    def test_classification_payloads_roundtrip(self):
+        self._populate_users(1)
+        self._populate_db_with_user_tweets("0", 3)
+        tweets = list(models.Tweet.select())
+
+        tweet_ids = [t.id for t in tweets]
+
+        req = workers.ClassificationRequest.from_tweets("0", tweets)
+        decoded = workers.ClassificationRequest.decode(req.encode("msgpack"))
+        self.assertEqual(decoded.user_id, "0")
+        self.assertEqual(decoded.tweet_ids, tweet_ids)
+        self.assertEqual(decoded.text, " ".join([t.text for t in tweets]))
+
+        categories = [google_nlp.ClassificationCategory(name="Cat 1", confidence=0.5)]
+        result = workers.ClassificationResult(user_id="0", categories=categories,
+                                              tweet_ids=tweet_ids)
+        decoded = workers.ClassificationResult.decode(result.encode("msgpack"))
+        self.assertEqual([(c.name, c.confidence) for c in decoded.categories],
+                         [("Cat 1", 0.5)])
+        self.assertEqual(decoded.tweet_ids, tweet_ids)
+
+
+    def test_decode_legacy_classification_payloads(self):
+        self._populate_users(1)
+        self._populate_db_with_user_tweets("0", 3)
+        tweets = list(models.Tweet.select())
+        tweet_dicts = [model_to_dict(t, recurse=False) for t in tweets]
+        for tweet in tweet_dicts:
+            tweet["created_at"] = str(tweet["created_at"])
+
+        legacy = json.dumps(dict(user_id="0", tweets=tweet_dicts))
+        req = workers.ClassificationRequest.decode(legacy.encode())
+        self.assertEqual(req.tweet_ids, [t.id for t in tweets])
+        self.assertEqual(req.text, " ".join([t.text for t in tweets]))
+
+        v1 = workers.PAYLOAD_MAGIC + bytes([1]) + msgpack.packb(
+            ["0", [[t.id, t.text] for t in tweets]])
+        self.assertEqual(workers.ClassificationRequest.decode(v1), req)
+
+        legacy = json.dumps(dict(user_id="0", categories=[], tweets=tweet_dicts))
+        result = workers.ClassificationResult.decode(legacy.encode())
+        self.assertEqual(result.tweet_ids, [t.id for t in tweets])
+
+
+    def test_decode_legacy_json(self):
+        result = self._entity_result()
+        decoded = workers.EntityAnalysisResult.decode(result.to_json().encode())
+        self.assertEqual(decoded.tweet.id, result.tweet.id)
+        self.assertEqual(len(decoded.entities), 3)
+
+        with mock.patch.dict(os.environ, {"QUEUE_PAYLOAD_CODEC": "json"}):
+            self.assertEqual(result.encode(), result.to_json())
+
+
+    def test_decode_unknown_version(self):
+        data = workers.PAYLOAD_MAGIC + bytes([workers.PAYLOAD_VERSION + 1]) + b"\x90"
+        with self.assertRaises(ValueError):
+            workers.ClassificationResult.decode(data)
+
+
+class TestNLPResponseCache(DatabaseTestCase):
+
+    def _response(self):
+        return google_nlp.language_v1.AnalyzeEntitiesResponse(
+            entities=list(self._generate_dummy_entities(2)), language="en")
+
+
+    def test_get_put(self):
+        cache = workers.NLPResponseCache(self.redis_client, ttl=60)
+        self.assertIsNone(cache.get("analyze_entities", "Some  tweet"))
+
+        cache.put("analyze_entities", "Some  tweet", self._response())
+        self.assertEqual(cache.get("analyze_entities", " Some tweet\n"), self._response())
+        self.assertIsNone(cache.get("classify_text", "Some tweet"))
+
+        # A second process only shares the redis tier.
+        other = workers.NLPResponseCache(self.redis_client)
+        self.assertEqual(other.get("analyze_entities", "Some tweet"), self._response())
+        key = cache.key("analyze_entities", "Some tweet")
+        self.assertLessEqual(self.redis_client.ttl(key), 60)
+
+        # Each cache sends its counts with its next redis round trip.
+        cache.stats()
+        stats = other.stats()
+        self.assertEqual(stats["analyze_entities"]["hits"], 2)
+        self.assertEqual(stats["analyze_entities"]["misses"], 1)
+        self.assertEqual(stats["classify_text"]["hit_ratio"], 0.0)
+
+
+    def test_zero_ttl(self):
+        cache = workers.NLPResponseCache(self.redis_client, ttl=0)
+        self.assertEqual(cache.ttl, 0)
+        cache.put("analyze_entities", "Some tweet", self._response())
+        self.assertEqual(cache.get("analyze_entities", "Some tweet"), self._response())
+        self.assertEqual(self.redis_client.exists(cache.key("analyze_entities", "Some tweet")), 0)
+
+
+    def test_local_lru(self):
+        # With a ttl of 0 only the local LRU holds responses.
+        cache = workers.NLPResponseCache(self.redis_client, ttl=0, local_size=2)
+        for text in ("a", "b"):
+            cache.put("analyze_entities", text, self._response())
+        self.assertIsNotNone(cache.get("analyze_entities", "a"))
+
+        # "b" was the least recently used response.
+        cache.put("analyze_entities", "c", self._response())
+        self.assertIsNone(cache.get("analyze_entities", "b"))
+        self.assertIsNotNone(cache.get("analyze_entities", "a"))
+        self.assertIsNotNone(cache.get("analyze_entities", "c"))
+
+
+    def test_worker_skips_api_on_hit(self):
+        self._populate_users(1)
+        self._populate_db_with_user_tweets("0", 3)
+        tweets = list(models.Tweet.select())
+        for tweet in tweets:
+            tweet.text = "Same promo text"
+            self.redis_client.rpush(workers.Queues.ENTITY_ANALYSIS_REQUEST,
+                                    workers.EntityAnalysisWorker.serialize_request(tweet))
+
+        cache = workers.NLPResponseCache(self.redis_client)
+        worker = workers.EntityAnalysisWorker(self.redis_client, nlp_cache=cache)
+        with patch_nlp("analyze_entities",
+                       return_value=self._response()) as analyze:
+            while worker.process() is True:
+                pass
+
+        self.assertEqual(analyze.call_count, 1)
+        results = self.redis_client.lrange(workers.Queues.ENTITY_ANALYSIS_RESULTS, 0, -1)
+        results = [workers.EntityAnalysisResult.decode(r) for r in results]
+        self.assertEqual({r.tweet.id for r in results}, {t.id for t in tweets})
+        self.assertTrue(all(len(r.entities) == 2 for r in results))
+
+
+class TestTokenBucket(DatabaseTestCase):
+
+    def test_acquire(self):
+        bucket = workers.TokenBucket(self.redis_client, "test:bucket", rate=2, capacity=3)
+        self.assertEqual(bucket.acquire(2), (2, 0))
+        granted, wait = bucket.acquire(2)
+        self.assertEqual(granted, 1)
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 0.5)
+
+        time.sleep(wait)
+        self.assertEqual(bucket.acquire(), (1, 0))
+
+
+    def test_drain(self):
+        bucket = workers.TokenBucket(self.redis_client, "test:bucket", rate=1, capacity=5)
+        bucket.drain()
+        granted, wait = bucket.acquire()
+        self.assertEqual(granted, 0)
+        self.assertGreater(wait, 0.9)
+
+
+    def test_shared_between_workers(self):
+        worker_1 = workers.ClassificationWorker(self.redis_client, requests_per_minute=60)
+        worker_2 = workers.ClassificationWorker(self.redis_client, requests_per_minute=60)
+        self.assertEqual(worker_1.bucket.acquire(), (1, 0))
+        self.assertEqual(worker_2.bucket.acquire()[0], 0)
+
+
+class TestPipelineMetrics(DatabaseTestCase):
+
+    def test_aggregated_between_processes(self):
+        metrics_1 = metrics.Metrics(self.redis_client, flush_interval=60)
+        metrics_2 = metrics.Metrics(self.redis_client, flush_interval=60)
+        metrics_1.inc("pipeline_items_processed_total", 2, stage="scrape", step="a")
+        metrics_2.inc("pipeline_items_processed_total", 3, stage="scrape", step="a")
+        metrics_1.observe("pipeline_step_seconds", 0.02, stage="scrape", step="a")
+        metrics_2.observe("pipeline_step_seconds", 3, stage="scrape", step="a")
+        metrics_2.set("pipeline_rate_limit_wait_seconds", 1.5, stage="scrape")
+
+        # Nothing is written until the buffers are flushed.
+        self.assertEqual(self.redis_client.hlen(metrics.METRICS_KEY), 0)
+        metrics_1.flush()
+        metrics_2.flush()
+
+        self.redis_client.rpush(workers.Queues.ENTITY_ANALYSIS_REQUEST, "a", "b")
+        self.redis_client.sadd(workers.Queues.SCRAPE_USER_TWEETS_REQUEST, "1")
+        text = metrics.render_prometheus(self.redis_client, workers.Queues.all())
+        lines = text.splitlines()
+
+        self.assertIn('pipeline_items_processed_total{stage="scrape",step="a"} 5', lines)
+        self.assertIn('pipeline_rate_limit_wait_seconds{stage="scrape"} 1.5', lines)
+        self.assertIn("# TYPE pipeline_step_seconds histogram", lines)
+        buckets = [l for l in lines if l.startswith("pipeline_step_seconds_bucket")]
+        self.assertEqual(len(buckets), len(metrics.LATENCY_BUCKETS) + 1)
+        self.assertIn('pipeline_step_seconds_bucket{le="0.025",stage="scrape",step="a"} 1',
+                      lines)
+        self.assertIn('pipeline_step_seconds_bucket{le="+Inf",stage="scrape",step="a"} 2',
+                      lines)
+        self.assertTrue(buckets[-1].startswith('pipeline_step_seconds_bucket{le="+Inf"'))
+        self.assertIn('pipeline_step_seconds_count{stage="scrape",step="a"} 2', lines)
+        self.assertIn('pipeline_queue_depth{queue="worker:analyze_tweet_entities"} 2', lines)
+        self.assertIn('pipeline_queue_depth{queue="worker:scrape_user_tweets"} 1', lines)
+        self.assertIn('pipeline_queue_depth{queue="db:store_user_tweets"} 0', lines)
+
+
+    def test_worker_api_calls(self):
+        self._populate_users(1)
+        self._populate_db_with_user_tweets("0", 2)
+        tweets = list(models.Tweet.select())
+        for tweet in tweets:
+            req = workers.ClassificationRequest.from_tweets("0", [tweet])
+            self.redis_client.rpush(workers.Queues.CLASSIFICATION_REQUESTS, req.encode())
+
+        worker = workers.ClassificationWorker(self.redis_client)
+        response = google_nlp.language_v1.ClassifyTextResponse(
+            categories=[google_nlp.ClassificationCategory(name="/Cat", confidence=1)])
+        with patch_nlp("classify_text",
+                       side_effect=[response, google_nlp.ResourceExhausted("quota")]):
+            self.assertTrue(worker.process())
+            self.assertEqual(worker.process(), "wait")
+        worker.metrics.flush()
+
+        text = metrics.render_prometheus(self.redis_client, workers.Queues.all())
+        lines = text.splitlines()
+        self.assertIn('pipeline_api_calls_total{api="google",method="classify_text"} 2', lines)
+        self.assertIn('pipeline_api_failures_total{api="google",error="ResourceExhausted",'
+                      'method="classify_text"} 1', lines)
+        self.assertIn('pipeline_api_latency_seconds_count{api="google",'
+                      'method="classify_text"} 2', lines)
+        self.assertIn('pipeline_items_processed_total{stage="classify",'
+                      'step="classify_request"} 1', lines)
+        self.assertIn('pipeline_step_seconds_count{stage="classify",step="process"} 2', lines)
+        self.assertIn('pipeline_queue_depth{queue="worker:classify_user_tweets"} 1', lines)
+
+
+class TestDiscoveryFrontier(DatabaseTestCase):
+
+    @staticmethod
+    def _users(*ids, verified=False):
+        return [twitter_utils.TwitterUser(id=i, verified=verified) for i in ids]
+
+
+    def _claim_all(self, frontier):
+        claimed = []
+        while True:
+            claim = frontier.claim()
+            if claim is None:
+                return claimed
+            claimed.append(claim)
+
+
+    def test_priority(self):
+        frontier = Frontier(self.redis_client, dict(verified=10, depth=-5, seen=1))
+        frontier.seed(self._users("seed"))
+        self.assertEqual(frontier.claim(), ("seed", 0))
+
+        frontier.add(self._users("a", "b"), 1)
+        frontier.add(self._users("v", verified=True), 1)
+        # Seen a second time, and closer to a seed.
+        frontier.add(self._users("b"), 0)
+        frontier.complete("seed")
+
+        self.assertEqual(self._claim_all(frontier), [("v", 1), ("b", 0), ("a", 1)])
+        self.assertEqual(frontier.stats(), dict(queued=0, claimed=3, done=1))
+
+        # Crawled users aren't queued again.
+        frontier.add(self._users("seed"), 2)
+        self.assertIsNone(frontier.claim())
+
+
+    def test_add_counts_new_users(self):
+        frontier = Frontier(self.redis_client)
+        self.assertEqual(frontier.add(self._users("a", "b"), 1), 2)
+        # Seeing queued users again only updates their priority.
+        self.assertEqual(frontier.add(self._users("a", "b", "c"), 1), 1)
+        self.assertEqual(frontier.add(self._users("a", "a"), 2), 0)
+        self.assertEqual(frontier.stats()["queued"], 3)
+
+
+    def test_max_depth(self):
+        frontier = Frontier(self.redis_client, max_depth=1)
+        self.assertEqual(frontier.add(self._users("a"), 1), 1)
+        self.assertEqual(frontier.add(self._users("b"), 2), 0)
+
+        # Seeding doesn't reset the depth of users already seen.
+        self.assertEqual(frontier.seed(self._users("b", "c")), 1)
+        self.assertEqual(sorted(self._claim_all(frontier)), [("a", 1), ("c", 0)])
+
+
+    def test_claims(self):
+        frontier = Frontier(self.redis_client, lease=60)
+        frontier.add(self._users("a", "b"), 1)
+
+        # Claims from different processes never overlap.
+        other = Frontier(self.redis_client, lease=60)
+        first, second = frontier.claim(), other.claim()
+        self.assertNotEqual(first[0], second[0])
+        self.assertIsNone(frontier.claim())
+
+        other.release(second[0])
+        self.assertEqual(frontier.claim(), second)
+        self.assertTrue(frontier.renew(second[0]))
+
+        frontier.complete(second[0])
+        self.assertFalse(frontier.renew(second[0]))
+
+        # Expired leases go back in the frontier.
+        expiring = Frontier(self.redis_client, lease=0)
+        expiring.release(first[0])
+        self.assertEqual(expiring.claim(), first)
+        self.assertEqual(other.claim(), first)
+
+
+    def test_parse_priority_weights(self):
+        self.assertEqual(parse_priority_weights("seen=2,verified=1"),
+                         dict(verified=1, depth=0, seen=2))
+        with self.assertRaises(ValueError):
+            parse_priority_weights("followers=1")
+        with self.assertRaises(ValueError):
+            parse_priority_weights("seen=x")